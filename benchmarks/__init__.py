@@ -0,0 +1 @@
+"""Benchmarks for cara's hot paths, see run.py."""
@@ -0,0 +1,235 @@
+"""The benchmarks, covering cara's hot paths.
+
+Each benchmark is a generator that sets up, yields the operation to time, and
+cleans up after the timing is done. Register one with @benchmark, or with
+@benchmark(ops=n) if a single run of the operation does n of what's being
+measured, so results are always per operation.
+"""
+import asyncio
+import collections
+import functools
+
+from benchmarks.bench_capnp import Directory, Person, Result
+from cara import cara
+from cara import cara_loopback
+from cara import codec
+from cara import list_cache
+from cara import remote
+
+# Benchmark generators by name, and how many operations one run does.
+benchmarks = collections.OrderedDict()
+operations = {}
+
+# How many people the list benchmarks use.
+PEOPLE = 100
+
+
+def benchmark(func=None, ops=1):
+  if func is None:
+    return functools.partial(benchmark, ops=ops)
+  benchmarks[func.__name__] = func
+  operations[func.__name__] = ops
+  return func
+
+
+def PersonDict(id):
+  return {
+      'id': id,
+      'name': 'Person %d' % id,
+      'email': 'person%d@example.com' % id,
+      'age': 20 + id % 60,
+      'address': {
+          'street': '%d Main St' % id,
+          'city': 'Springfield',
+          'region': 'OR',
+          'postalCode': '97477',
+          'country': 'US',
+      },
+      'phones': [
+          {'number': '555-01%02d' % (id % 100), 'type': 0},
+          {'number': '555-02%02d' % (id % 100), 'type': 2},
+      ],
+      'tags': ['customer', 'newsletter', 'tier-%d' % (id % 3)],
+      'scores': [0.5, 0.75, float(id)],
+      'employment': {'employer': 'Acme'},
+  }
+
+
+def People(count=PEOPLE):
+  return [PersonDict(id) for id in range(count)]
+
+
+class DirectoryImpl(Directory):
+
+  def __init__(self):
+    self.people = People()
+
+  def lookup(self, id):
+    return self.people[id]
+
+  def find(self, name):
+    return {'value': self.people[0], 'elapsedMicros': 3}
+
+  def list(self, limit):
+    return self.people[:limit]
+
+  def add(self, person):
+    return person.id
+
+
+@benchmark
+def struct_from_dict():
+  person = PersonDict(1)
+  yield lambda: Person(person)
+
+
+@benchmark
+def nested_conversion():
+  people = People()
+  people_list = cara.List(Person)
+  yield lambda: people_list(people)
+
+
+@benchmark
+def attribute_access():
+  person = Person(PersonDict(1))
+  yield lambda: (person.name, person.address.city, person.phones[1].number,
+                 person.employment.employer)
+
+
+@benchmark
+def to_dict():
+  person = Person(PersonDict(1))
+  yield lambda: person.ToDict(with_field_names=True)
+
+
+@benchmark
+def list_get():
+  people = cara.List(Person)(People())
+  yield lambda: people.Get(name='Person %d' % (PEOPLE - 1))
+
+
+@benchmark
+def list_get_nested():
+  people = cara.List(Person)(People())
+  yield lambda: people.Get(address__street='%d Main St' % (PEOPLE - 1))
+
+
+@benchmark
+def generic_instantiation():
+  yield lambda: Result[Person]
+
+
+@benchmark
+def replace_types():
+  original = Result.__cache__
+
+  def ReplaceTypes():
+    # Without the cache, every instantiation replaces the types again.
+    Result.__cache__ = list_cache.ListCache()
+    return Result[Person]
+  yield ReplaceTypes
+  Result.__cache__ = original
+
+
+@benchmark
+def local_call():
+  directory = DirectoryImpl()
+  yield lambda: directory.lookup(1)
+
+
+@benchmark
+def local_call_list():
+  directory = DirectoryImpl()
+  yield lambda: directory.list(PEOPLE)
+
+
+def _Codec(name, make, ops=1):
+  """Registers the benchmark make(name) returns, named after the codec too."""
+  func = make(name)
+  func.__name__ = '%s_%s' % (func.__name__, name.replace('-', '_'))
+  return benchmark(func, ops=ops)
+
+
+def _Encode(name):
+  def encode():
+    encoding = codec.GetCodec(name)
+    person = Person(PersonDict(1))
+    yield lambda: encoding.Encode(Person, person)
+  return encode
+
+
+def _Decode(name):
+  def decode():
+    encoding = codec.GetCodec(name)
+    data = encoding.Encode(Person, Person(PersonDict(1)))
+    yield lambda: encoding.Decode(Person, data)
+  return decode
+
+
+for codec_name in codec.codecs:
+  _Codec(codec_name, _Encode)
+  _Codec(codec_name, _Decode)
+
+
+def _Loopback(encode, codecs=None):
+  """Sets up a loopback server with a Directory, and a client for it."""
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+  name = 'benchmark-%s-%s' % (encode, codecs)
+  server = cara_loopback.setup_server(cara_loopback.Server())
+  server.bind(name)
+  loop.run_until_complete(server.start())
+  cara_loopback.register_interface(
+      server, Directory, DirectoryImpl(), by_name=False)
+  client = cara_loopback.setup_client(
+      cara_loopback.Client(encode=encode, codecs=codecs))
+  client.connect(name)
+  loop.run_until_complete(client.start())
+  directory = remote.RemoteInterfaceClient.Bootstrap(Directory, client)
+  if codecs:
+    # Only the backend's own clients know the connection's codec.
+    directory = cara_loopback.cara_asyncio.RemoteInterfaceClient.Bootstrap(
+        Directory, client)
+
+  def Close():
+    client.close()
+    server.close()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+    asyncio.set_event_loop(None)
+  return loop, directory, Close
+
+
+# Remote calls are made 100 at a time, so the event loop's own overhead for
+# run_until_complete is spread out like it would be in a server.
+@benchmark(ops=100)
+def loopback_call():
+  loop, directory, close = _Loopback(encode=True)
+  calls = range(100)
+  yield lambda: loop.run_until_complete(
+      asyncio.gather(*[directory.lookup(1) for _ in calls]))
+  close()
+
+
+@benchmark(ops=100)
+def loopback_call_unencoded():
+  loop, directory, close = _Loopback(encode=False)
+  calls = range(100)
+  yield lambda: loop.run_until_complete(
+      asyncio.gather(*[directory.lookup(1) for _ in calls]))
+  close()
+
+
+def _LoopbackCall(name):
+  def loopback_call():
+    loop, directory, close = _Loopback(encode=True, codecs=[name])
+    calls = range(100)
+    yield lambda: loop.run_until_complete(
+        asyncio.gather(*[directory.lookup(1) for _ in calls]))
+    close()
+  return loopback_call
+
+
+for codec_name in codec.codecs:
+  _Codec(codec_name, _LoopbackCall, ops=100)
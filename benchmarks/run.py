@@ -0,0 +1,153 @@
+"""Runs the benchmarks, writing the results as JSON to compare across commits.
+
+  python -m benchmarks.run -o before.json
+  (change things)
+  python -m benchmarks.run -o after.json --compare before.json
+
+The schema in bench.capnp has to be compiled first, which
+`python setup.py benchmark` does before running this with --benchmark-args.
+
+Every benchmark is timed in --repeat runs of at least --min-time seconds each,
+and reported in seconds per operation. The median is what --compare uses, the
+best and the spread are there to judge how noisy the machine was.
+"""
+import argparse
+import contextlib
+import datetime
+import fnmatch
+import gc
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks import cases
+
+# Bumped when the format of the results changes.
+FORMAT_VERSION = 1
+
+
+def Time(func, ops=1, repeat=5, min_time=0.2):
+  """Times func, returning stats in seconds per operation."""
+  # Find how many calls take at least min_time, like timeit.autorange.
+  number = 1
+  while True:
+    elapsed = _Run(func, number)
+    if elapsed >= min_time:
+      break
+    number *= max(2, min(10, int(min_time / max(elapsed, 1e-9))))
+  times = [elapsed] + [_Run(func, number) for _ in range(repeat - 1)]
+  per_op = [elapsed / number / ops for elapsed in times]
+  return {
+      'ops': number * ops,
+      'repeat': repeat,
+      'best': min(per_op),
+      'median': statistics.median(per_op),
+      'mean': statistics.mean(per_op),
+      'stdev': statistics.stdev(per_op) if repeat > 1 else 0.0,
+  }
+
+
+def _Run(func, number):
+  gc_was_enabled = gc.isenabled()
+  gc.disable()
+  try:
+    start = time.perf_counter()
+    for _ in range(number):
+      func()
+    return time.perf_counter() - start
+  finally:
+    if gc_was_enabled:
+      gc.enable()
+
+
+def Run(patterns=None, repeat=5, min_time=0.2, log=None):
+  """Runs the benchmarks matching any of patterns, or all of them."""
+  results = {}
+  for name, setup in cases.benchmarks.items():
+    if patterns and not any(fnmatch.fnmatch(name, pattern)
+                            for pattern in patterns):
+      continue
+    with contextlib.contextmanager(setup)() as func:
+      results[name] = Time(func, cases.operations[name], repeat, min_time)
+    if log:
+      log('%-34s %12.3f us/op' % (name, results[name]['median'] * 1e6))
+  return {
+      'format': FORMAT_VERSION,
+      'commit': _Commit(),
+      'python': platform.python_version(),
+      'implementation': platform.python_implementation(),
+      'platform': platform.platform(),
+      'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+      'benchmarks': results,
+  }
+
+
+def Compare(baseline, results):
+  """(name, baseline median, median, ratio) for benchmarks in both."""
+  rows = []
+  for name, stats in results['benchmarks'].items():
+    before = baseline['benchmarks'].get(name)
+    if before is None:
+      continue
+    rows.append((name, before['median'], stats['median'],
+                 stats['median'] / before['median']))
+  return rows
+
+
+def _Commit():
+  try:
+    return subprocess.check_output(
+        ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+        universal_newlines=True).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('-k', dest='patterns', action='append',
+                      help='Only run benchmarks matching this glob.')
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--min-time', type=float, default=0.2,
+                      help='Seconds each repeat runs for at least.')
+  parser.add_argument('-o', '--output', help='Write the results here.')
+  parser.add_argument('--compare', help='Results to compare against.')
+  parser.add_argument('--max-ratio', type=float,
+                      help='Fail if a median is this many times the '
+                      'baseline\'s or more.')
+  parser.add_argument('--list', action='store_true',
+                      help='List the benchmarks and exit.')
+  args = parser.parse_args(argv)
+
+  if args.list:
+    print('\n'.join(cases.benchmarks))
+    return 0
+  results = Run(args.patterns, args.repeat, args.min_time,
+                log=lambda line: print(line, file=sys.stderr))
+  if args.output:
+    with open(args.output, 'w') as output:
+      json.dump(results, output, indent=2, sort_keys=True)
+  else:
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    print()
+  if not args.compare:
+    return 0
+
+  with open(args.compare) as baseline_file:
+    baseline = json.load(baseline_file)
+  status = 0
+  print('%-34s %12s %12s %8s' % ('benchmark', 'baseline', 'current', 'ratio'),
+        file=sys.stderr)
+  for name, before, after, ratio in Compare(baseline, results):
+    print('%-34s %9.3f us %9.3f us %7.2fx' % (
+        name, before * 1e6, after * 1e6, ratio), file=sys.stderr)
+    if args.max_ratio is not None and ratio >= args.max_ratio:
+      status = 1
+  return status
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -8,4 +8,6 @@ cara.Struct(...)
 cara.cara_pseud.register_client(...)
 """
 from cara.cara import *
+from cara import cara_asyncio
+from cara import cara_loopback
 from cara import cara_pseud
@@ -0,0 +1,267 @@
+"""Files of many structs of one type, read at random without loading them.
+
+  with archive.Writer('people.arc', Person) as writer:
+    for person in people:
+      writer.Append(person)
+
+  with archive.Archive('people.arc', Person) as people:
+    people[1000000]    # Decodes just that one.
+    people[10:20]      # And those.
+
+Records are Cap'n Proto messages (see cara.wire), one after the other, with
+where each is in an index after them:
+
+  header:   MAGIC, trailer offset, uint64
+  records:  one message each
+  index:    the start and end offset of each record, uint64 each
+  trailer:  struct id, record count, index offset, uint64 each, then MAGIC
+
+All integers are little endian. Archive memory-maps the file, so opening one
+only reads the header and trailer no matter how big it is, and each access
+only touches the record it's for and its place in the index.
+
+Writer appends to existing archives after their trailer, leaving the old
+index where it is, so until it's closed, or if it never is, readers see the
+archive as it was. Closing it writes an index of all the records after the
+new ones, then moves the new records over the old index and truncates the
+file after them and their index. The header only ever points at a trailer
+that's on disk, of records and an index that aren't being written over.
+Archives opened before that have to be opened again to read it afterwards.
+"""
+import array
+import mmap
+import os
+import struct
+import sys
+
+from cara import wire
+
+MAGIC = b'caraarc1'
+_HEADER = struct.Struct('<8sQ')
+_TRAILER = struct.Struct('<QQQ8s')
+_RANGE = struct.Struct('<QQ')
+# How much of the records Writer copies at once when moving them.
+_CHUNK_SIZE = 1 << 20
+
+
+class Archive(object):
+  """A read-only archive of struct_type records, memory-mapped.
+
+  Indexing with an int returns a record, and with a slice a list of them.
+  Records are regular structs by default, copied out of the file. With
+  lazy=True they're read-only views of it instead, decoding fields as they're
+  used; these keep the file mapped, even after the archive's closed, until
+  they're gone.
+  """
+
+  def __init__(self, path, struct_type, lazy=False):
+    self.path = path
+    self.struct_type = struct_type
+    self.lazy = lazy
+    with open(path, 'rb') as file:
+      self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      self._count, self._index = _ReadTrailer(self._mmap, path, struct_type)
+    except Exception:
+      self._mmap.close()
+      raise
+    self._buffer = memoryview(self._mmap)
+
+  def __len__(self):
+    return self._count
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self._Record(i) for i in range(*index.indices(self._count))]
+    if index < 0:
+      index += self._count
+    if not 0 <= index < self._count:
+      raise IndexError('Record %d of %d' % (index, self._count))
+    return self._Record(index)
+
+  def __iter__(self):
+    for i in range(self._count):
+      yield self._Record(i)
+
+  def _Record(self, index):
+    if self._mmap is None:
+      raise ValueError('archive is closed')
+    start, end = _RANGE.unpack_from(
+        self._mmap, self._index + index * _RANGE.size)
+    if self.lazy:
+      return wire.Read(self.struct_type, self._buffer[start:end])
+    # Copy the record so nothing in the struct refers to the file.
+    view = wire.Read(self.struct_type, self._mmap[start:end])
+    return self.struct_type(view)
+
+  def close(self):
+    if self._mmap is None:
+      return
+    self._buffer.release()
+    try:
+      self._mmap.close()
+    except BufferError:
+      # Lazy records still use it, it's unmapped once they're gone.
+      pass
+    self._mmap = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+
+class Writer(object):
+  """Appends struct_type records to an archive, creating it if need be.
+
+  The records are only readable once the writer is closed, which writes the
+  index. Until then, readers see the archive as it was.
+  """
+
+  def __init__(self, path, struct_type):
+    self.path = path
+    self.struct_type = struct_type
+    self._offsets = array.array('Q')
+    if os.path.exists(path) and os.path.getsize(path):
+      self._file = open(path, 'r+b')
+      try:
+        with mmap.mmap(self._file.fileno(), 0,
+                       access=mmap.ACCESS_READ) as mapped:
+          count, index = _ReadTrailer(mapped, path, struct_type)
+          self._offsets.frombytes(
+              mapped[index:index + count * _RANGE.size])
+      except Exception:
+        self._file.close()
+        raise
+      if sys.byteorder != 'little':
+        self._offsets.byteswap()
+      # Where the new records end up once it's closed, over the old index.
+      self._start = index
+      # Anything after the trailer was left by a writer that wasn't closed.
+      self._end = index + count * _RANGE.size + _TRAILER.size
+    else:
+      self._file = open(path, 'w+b')
+      # No trailer until it's closed.
+      self._file.write(_HEADER.pack(MAGIC, 0))
+      self._start = self._end = _HEADER.size
+    # Where the new records are, and how many of the offsets are theirs.
+    self._first = self._end
+    self._old = len(self._offsets)
+    self._file.seek(self._end)
+
+  def __len__(self):
+    return len(self._offsets) // 2
+
+  def Append(self, value):
+    data = wire.Build(self.struct_type, value)
+    self._file.write(data)
+    self._offsets.append(self._end)
+    self._end += len(data)
+    self._offsets.append(self._end)
+
+  def Extend(self, values):
+    for value in values:
+      self.Append(value)
+
+  def close(self):
+    if self._file is None:
+      return
+    try:
+      end = self._end
+      if self._first == self._start:
+        # New, so the records are where they belong.
+        end = self._Commit(self._end)
+      elif len(self._offsets) > self._old:
+        end = self._Compact()
+      self._file.truncate(end)
+    finally:
+      self._file.close()
+      self._file = None
+
+  def _Compact(self):
+    """Writes the index, then moves the new records over the old one.
+
+    Every step only writes where the trailer in the header doesn't point,
+    and the header only points at the next trailer once it's on disk.
+
+    Returns: Where the last trailer ends.
+    """
+    end = self._Commit(self._end)
+    if self._start + self._end - self._first > self._first:
+      # Too many to move over the old index without writing over themselves,
+      # so they're copied past the index first.
+      self._Move(end)
+      self._Commit(self._end)
+    else:
+      self._Move(self._start)
+      self._Commit(end)
+    self._Move(self._start)
+    return self._Commit(self._end)
+
+  def _Move(self, position):
+    """Copies the new records to position, and points the offsets at them."""
+    if position == self._first:
+      return
+    size = self._end - self._first
+    for done in range(0, size, _CHUNK_SIZE):
+      self._file.seek(self._first + done)
+      chunk = self._file.read(min(size - done, _CHUNK_SIZE))
+      self._file.seek(position + done)
+      self._file.write(chunk)
+    for i in range(self._old, len(self._offsets)):
+      self._offsets[i] += position - self._first
+    self._first = position
+    self._end = position + size
+
+  def _Commit(self, position):
+    """Writes the index at position, and points the header at it.
+
+    Returns: Where its trailer ends.
+    """
+    offsets = self._offsets
+    if sys.byteorder != 'little':
+      offsets = array.array('Q', offsets)
+      offsets.byteswap()
+    self._file.seek(position)
+    self._file.write(offsets.tobytes())
+    trailer = self._file.tell()
+    self._file.write(_TRAILER.pack(
+        self.struct_type.id, len(self), position, MAGIC))
+    end = self._file.tell()
+    # Everything else is on disk before the header points at it, and the
+    # header is on disk before what it pointed at before is written over.
+    self._file.flush()
+    os.fsync(self._file.fileno())
+    self._file.seek(0)
+    self._file.write(_HEADER.pack(MAGIC, trailer))
+    self._file.flush()
+    os.fsync(self._file.fileno())
+    return end
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+
+def _ReadTrailer(mapped, path, struct_type):
+  """Checks the archive in mapped is of struct_type, returning its index.
+
+  Returns: (number of records, offset of the index).
+  """
+  if len(mapped) < _HEADER.size or mapped[:len(MAGIC)] != MAGIC:
+    raise ValueError('%s is not an archive' % path)
+  _, trailer = _HEADER.unpack_from(mapped)
+  if not trailer or trailer + _TRAILER.size > len(mapped):
+    raise ValueError('%s has no index, it was not closed after writing' % (
+        path))
+  type_id, count, index, magic = _TRAILER.unpack_from(mapped, trailer)
+  if magic != MAGIC or index + count * _RANGE.size != trailer:
+    raise ValueError('%s has no index, it was not closed after writing' % (
+        path))
+  if type_id != struct_type.id:
+    raise ValueError('%s is an archive of %#x, not %s' % (
+        path, type_id, struct_type.__name__))
+  return count, index
@@ -3,10 +3,14 @@ import copy
 import enum
 import inspect
 import sys
+import threading
+import time
 
 import mutablerecords
 from . import generics
+from . import instrumentation
 from . import list_cache
+from . import locks
 from . import type_registry
 from .generics import MethodTemplate  # noqa
 
@@ -15,17 +19,58 @@ AnnotationValue = mutablerecords.HashableRecord(
 Method = mutablerecords.HashableRecord(
     'Method', ['id', 'name', 'params', 'results'], {'annotations': list})
 Param = mutablerecords.HashableRecord(
-    'Param', ['id', 'name', 'type'], {'annotations': list})
+    'Param', ['id', 'name', 'type'],
+    {'annotations': list, 'offset': None, 'discriminant': None})
 Enumerant = mutablerecords.HashableRecord(
     'Enumerant', ['name', 'ordinal'], {'annotations': list})
 Group = mutablerecords.HashableRecord(
-    'Group', ['id', 'name', 'fields'], {'annotations': list})
+    'Group', ['id', 'name', 'fields'],
+    {'annotations': list, 'discriminant': None, 'discriminant_offset': None})
 Union = mutablerecords.HashableRecord(
     'Union', ['fields'], {'annotations': list})
+# Where a struct's fields are in the Cap'n Proto wire format, see cara.wire.
+# Sizes are in words, the discriminant_offset of a union in 16 bit units.
+StructLayout = mutablerecords.HashableRecord(
+    'StructLayout', ['data_words', 'pointer_words'],
+    {'discriminant_offset': None})
+
+class _GlobalTypeRegistry(dict):
+  """Registry of struct/interface ID to declaration.
+
+  Lazily loaded modules (see cara.lazy) defer theirs until they're looked up,
+  which loads the module. Iterating only has the ones loaded so far.
+  """
+
+  def __init__(self):
+    super().__init__()
+    self.deferred = {}
+
+  def Defer(self, id, load):
+    self.deferred[id] = load
+
+  def __missing__(self, id):
+    load = self.deferred.get(id)
+    if load is None:
+      raise KeyError(id)
+    load()
+    self.deferred.pop(id, None)
+    return super().__getitem__(id)
+
+  def __contains__(self, id):
+    return super().__contains__(id) or id in self.deferred
+
+  def get(self, id, default=None):
+    try:
+      return self[id]
+    except KeyError:
+      return default
+
 
 # Add $Cara.registerGlobally to a struct or interface to put it here.
-# Registry of struct/interface ID to declaration.
-GlobalTypeRegistry = {}
+GlobalTypeRegistry = _GlobalTypeRegistry()
+
+# $Cara.stream, see cara.capnp.
+_STREAM_ANNOTATION_ID = 0xd7f1a2c48e3b9a60
 
 
 class BuiltinType(object):
@@ -208,6 +253,11 @@ class StructMeta(DeclarationMeta):
         'fields': cls.__fields__.values(),
         'annotations': cls.__annotations__
     }
+    if cls.__layout__ is not None:
+      kwargs.update(
+          data_words=cls.__layout__.data_words,
+          pointer_words=cls.__layout__.pointer_words,
+          discriminant_offset=cls.__layout__.discriminant_offset)
     cls.ApplyTemplatesToKwargs(kwargs, template_map, memo=memo)
     new_decl = Struct(cls.__name__, cls.id)
     new_decl.ApplyTemplatesToNested(cls.__nested__, template_map, memo=memo)
@@ -224,31 +274,53 @@ class StructMeta(DeclarationMeta):
         generics.ReplaceObject(field, template_map, memo=memo)
         for field in kwargs['fields']]
 
-  def FinishDeclaration(cls, fields=None, annotations=None):
-    """Put all Field instances into __fields__."""
+  def FinishDeclaration(cls, fields=None, annotations=None, data_words=None,
+                        pointer_words=None, discriminant_offset=None):
+    """Put all Field instances into __fields__.
+
+    The sizes and offsets of the wire format are only generated by newer
+    versions of capnpc-cara, __layout__ is None without them.
+    """
     cls.__annotations__ = annotations or []
-    if any(ann.annotation.id == 0xebd6c4912189be2c
-           for ann in cls.__annotations__):
-      GlobalTypeRegistry[cls.id] = cls
+    cls.__layout__ = None
+    if data_words is not None:
+      cls.__layout__ = StructLayout(
+          data_words, pointer_words, discriminant_offset=discriminant_offset)
     fields = fields or []
 
     # Unions are always the first field.
     cls.__union_fields__ = set()
+    fields = list(fields)
     if fields and isinstance(fields[0], Union):
         # Store the union field ID's, then act like they don't exist.
         cls.__union_fields__ = {field.id for field in fields[0].fields}
         fields[0:1] = fields[0].fields
-
-    cls_fields = cls.__fields__ = {}
-    idfields = cls.__id_fields__ = [None] * len(fields)
+    elif cls.__layout__ is not None:
+        # Already flattened by a previous declaration, like ReplaceTypes does.
+        cls.__union_fields__ = {field.id for field in fields
+                                if field.discriminant is not None}
+
+    # Filled in before they're set, for threads using the struct already.
+    cls_fields = {}
+    idfields = [None] * len(fields)
     for field in fields:
       if isinstance(field, Group):
         struct = Struct('%s.%s' % (cls.__name__, field.name), cls.id)
+        # A group's fields are in the same sections as its parent's.
         struct.FinishDeclaration(
-            fields=field.fields, annotations=field.annotations)
-        field = Field(id=field.id, name=field.name, type=struct)
+            fields=field.fields, annotations=field.annotations,
+            data_words=data_words, pointer_words=pointer_words,
+            discriminant_offset=field.discriminant_offset)
+        field = Field(id=field.id, name=field.name, type=struct,
+                      discriminant=field.discriminant)
       cls_fields[field.name] = field
       idfields[field.id] = field
+    cls.__fields__ = cls_fields
+    cls.__id_fields__ = idfields
+    # Registered once it's finished, for other threads looking it up.
+    if any(ann.annotation.id == 0xebd6c4912189be2c
+           for ann in cls.__annotations__):
+      GlobalTypeRegistry[cls.id] = cls
 
   def __eq__(cls, other):
     return cls is other or (
@@ -264,7 +336,16 @@ class StructMeta(DeclarationMeta):
 
 class Field(mutablerecords.HashableRecord(
     'Field', ['id', 'name', 'type'],
-    {'annotations': list, 'default': None})):
+    {'annotations': list, 'default': None, 'offset': None,
+     'discriminant': None})):
+  """A struct's field.
+
+  offset is where it is in the struct's data or pointer section, in multiples
+  of its size, and discriminant is its value of the union's discriminant if
+  it's in one. Both come from capnpc-cara, for cara.wire. Groups have no
+  offset, their fields are in their parent's sections.
+  """
+
   @property
   def default_value(self):
     if self.default is not None:
@@ -277,6 +358,7 @@ class Field(mutablerecords.HashableRecord(
 
 class BaseStruct(dict, metaclass=StructMeta):
   __slots__ = ()
+  __layout__ = None
 
   @classmethod
   def Create(cls, *args, **kwargs):
@@ -499,13 +581,27 @@ class BaseList(list):
 
 
 __list_cache__ = list_cache.ListCache()
+# For making lists, see cara.locks.
+_locks = locks.Striped()
+# Held while instantiating generics, and the instantiations the thread
+# holding it is making, see BaseTemplated.ReplaceTypes.
+_instantiation_lock = threading.RLock()
+_instantiating = threading.local()
 
 
 def List(sub_type):
   cached = __list_cache__.get(sub_type, None)
   if cached is not None:
     return cached
+  with _locks.For(sub_type):
+    # Another thread may have made it while this one waited.
+    cached = __list_cache__.get(sub_type, None)
+    if cached is None:
+      cached = _NewList(sub_type)
+    return cached
+
 
+def _NewList(sub_type):
   if isinstance(sub_type, BaseTemplated):
     name = sub_type.name
   elif isinstance(sub_type, generics.Templated):
@@ -586,16 +682,20 @@ class InterfaceMeta(DeclarationMeta):
     """Put all Method instances into __methods__."""
     cls.__superclasses__ = tuple(superclasses or ())
     cls.__annotations__ = annotations or []
-    if any(ann.annotation.id == 0xebd6c4912189be2c
-           for ann in cls.__annotations__):
-      GlobalTypeRegistry[cls.id] = cls
-    cls_methods = cls.__methods__ = {}
-    id_methods = cls.__id_methods__ = {}
+    # Filled in before they're set, for threads using the interface already.
+    cls_methods = {}
+    id_methods = {}
     for method in methods or []:
       cls_methods[method.name] = method
       id_methods[method.id] = method
+    cls.__methods__ = cls_methods
+    cls.__id_methods__ = id_methods
     # Lastly, only allow __new__ to be overridden on the declaration class.
     cls.__new__ = cls.NewWrapper
+    # Registered once it's finished, for other threads looking it up.
+    if any(ann.annotation.id == 0xebd6c4912189be2c
+           for ann in cls.__annotations__):
+      GlobalTypeRegistry[cls.id] = cls
 
   def __eq__(cls, other):
     return cls is other or (
@@ -719,7 +819,11 @@ class BaseInterface(metaclass=InterfaceMeta):
       def _Wrapper(templates):
         return self._WrapMethod(method[templates])
       return generics.GetItemWrapper(_Wrapper)
+    return self._MethodWrapper(
+        self._GetImplementation(method), method, type(self))
 
+  def _GetImplementation(self, method):
+    """The function implementing method, before any conversions."""
     # Allow wrapping an object.
     if hasattr(self, '__wrapped__'):
       obj = self.__wrapped__
@@ -727,21 +831,30 @@ class BaseInterface(metaclass=InterfaceMeta):
       obj = self
     if inspect.isfunction(obj):
       # Allow wrapping a function.
-      return self._MethodWrapper(obj, method)
+      return obj
     if obj is self:
         # skip our getattribute when we're a direct subclass.
-        func = super().__getattribute__(method.name)
+        return super().__getattribute__(method.name)
     elif isinstance(obj, dict):
         # Allow wrapping a dict with functions instead of a class instance.
-        func = obj[method.name]
+        return obj[method.name]
     else:
-        func = getattr(obj, method.name)
-    return self._MethodWrapper(func, method)
+        return getattr(obj, method.name)
 
   @staticmethod
-  def _MethodWrapper(func, method):
+  def _MethodWrapper(func, method, interface=None):
+    """Wraps func to convert its params and results for method.
+
+    Calls are timed for instrumentation while it's enabled, under the name of
+    interface (and the interface declaring method) if one is given.
+    """
+    stream_type = StreamType(method)
+
     def ConvertResult(result):
       """Convert result to proper types."""
+      if stream_type is not None:
+        # Elements are converted as they're produced instead.
+        return _ConvertStream(stream_type, result)
       if not isinstance(method.results, list):
         # Single result struct.
         return _ConvertToType(method.results, result)
@@ -779,14 +892,14 @@ class BaseInterface(metaclass=InterfaceMeta):
           {param.name: _ConvertToType(param.type, result[param.name])
            for param in method.results if param.name in result})
 
-    def _Wrapper(*args, **kwargs):
+    def ConvertParams(args, kwargs):
+      """Convert input params to proper types."""
       def _GetParam(name, params):
           param = next((param for param in params if param.name == name), None)
           if param is None:
             raise TypeError('Param %s does not exist for method %s' % (
                 name, method.name))
           return param
-      # Convert input params to proper types first.
       if isinstance(method.params, list):
         args = [_ConvertToType(param.type, arg)
                 for param, arg in zip(method.params, args)]
@@ -802,7 +915,72 @@ class BaseInterface(metaclass=InterfaceMeta):
           # unless the kwargs are actually for the input parameter.
           args = (_ConvertToType(method.params, kwargs),)
           kwargs = {}
+      return args, kwargs
+
+    async def ConvertAwaitable(awaitable):
+      """Await a handler's result, then convert it like a synchronous one."""
+      return _ConvertToType(ConvertResult, await awaitable)
+
+    async def TimedAwaitable(timer, awaitable):
+      phase = 'handler'
+      try:
+        result = await awaitable
+        timer.Lap(phase)
+        phase = 'results'
+        result = _ConvertToType(ConvertResult, result)
+        timer.Lap(phase)
+        return result
+      except BaseException:
+        timer.Lap(phase, error=True)
+        raise
+
+    def Timed(recorder, args, kwargs):
+      """The same as _Wrapper, timing each phase of the call."""
+      timer = _Timer(recorder, _MethodKey(interface, method))
+      phase = 'params'
+      try:
+        args, kwargs = ConvertParams(args, kwargs)
+        timer.Lap(phase)
+        phase = 'handler'
+        result = func(*args, **kwargs)
+        if inspect.isawaitable(result):
+          if not type_conversion_registry.IsInstanceOfAny(result):
+            return TimedAwaitable(timer, result)
+          if hasattr(result, 'add_done_callback'):
+            # Converted by the backend once it's done, so only the handler
+            # can be timed.
+            result.add_done_callback(timer.LapFuture)
+            return _ConvertToType(ConvertResult, result)
+        timer.Lap(phase)
+        phase = 'results'
+        result = _ConvertToType(ConvertResult, result)
+        timer.Lap(phase)
+        return result
+      except BaseException:
+        timer.Lap(phase, error=True)
+        raise
+
+    if inspect.iscoroutinefunction(func):
+      async def _AsyncWrapper(*args, **kwargs):
+        recorder = instrumentation.recorder
+        if recorder is not None and interface is not None:
+          return await Timed(recorder, args, kwargs)
+        args, kwargs = ConvertParams(args, kwargs)
+        result = await func(*args, **kwargs)
+        return _ConvertToType(ConvertResult, result)
+      return _AsyncWrapper
+
+    def _Wrapper(*args, **kwargs):
+      recorder = instrumentation.recorder
+      if recorder is not None and interface is not None:
+        return Timed(recorder, args, kwargs)
+      args, kwargs = ConvertParams(args, kwargs)
       result = func(*args, **kwargs)
+      if (inspect.isawaitable(result)
+          and not type_conversion_registry.IsInstanceOfAny(result)):
+        # Backends may register their own futures for conversion, anything
+        # else that can be awaited is converted once it's done.
+        return ConvertAwaitable(result)
       return _ConvertToType(ConvertResult, result)
     return _Wrapper
 
@@ -819,6 +997,84 @@ class BaseInterface(metaclass=InterfaceMeta):
   __repr__ = __str__
 
 
+class _Timer(object):
+  """Times the phases of one call, reporting each to the recorder."""
+  __slots__ = ('recorder', 'key', 'start')
+
+  def __init__(self, recorder, key):
+    self.recorder = recorder
+    self.key = key
+    self.start = time.perf_counter()
+
+  def Lap(self, phase, error=False):
+    now = time.perf_counter()
+    self.recorder.Record(self.key, phase, now - self.start, error)
+    self.start = now
+
+  def LapFuture(self, future):
+    self.Lap('handler', future.cancelled() or future.exception() is not None)
+
+
+# Keys of methods for instrumentation, by (interface, method name).
+_method_keys = {}
+
+
+def _MethodKey(interface, method):
+  """(interface name, method name) for instrumentation.
+
+  Names the interface declaring method rather than a subclass implementing it.
+  """
+  key = _method_keys.get((interface, method.name))
+  if key is None:
+    declaring = _find_interface_base_class(interface)
+    for iface in (declaring,) + tuple(declaring.__superclasses__):
+      if method.name in iface.__methods__:
+        declaring = iface
+        break
+    key = _method_keys[interface, method.name] = (
+        declaring.__name__, method.name)
+  return key
+
+
+def StreamType(method):
+  """The type of the elements a $Cara.stream method produces, or None."""
+  if not any(ann.annotation.id == _STREAM_ANNOTATION_ID
+             for ann in method.annotations):
+    return None
+  results = method.results
+  if not (isinstance(results, list) and len(results) == 1
+          and isinstance(results[0].type, type)
+          and issubclass(results[0].type, BaseList)):
+    raise TypeError('Streaming method %s must have a single List result.' %
+                    method.name)
+  return results[0].type.sub_type
+
+
+def _ConvertStream(type, stream):
+  if hasattr(stream, '__aiter__'):
+    return _AsyncStream(type, stream)
+  return (_ConvertToType(type, element) for element in stream)
+
+
+class _AsyncStream(object):
+  """Converts the elements of an async iterator as they're produced."""
+
+  def __init__(self, type, stream):
+    self._type = type
+    self._stream = stream.__aiter__()
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self):
+    return _ConvertToType(self._type, await self._stream.__anext__())
+
+  async def aclose(self):
+    close = getattr(self._stream, 'aclose', None)
+    if close is not None:
+      await close()
+
+
 @NestedCatchingModifier
 class BaseTemplated(BaseDeclaration):
   required_attributes = ('templates',)
@@ -871,6 +1127,11 @@ class BaseTemplated(BaseDeclaration):
     new_decl = self.__cache__.get(local_tpl_map, None)
     if new_decl is not None:
       return new_decl
+    # Instantiations this thread is still finishing, which only it sees.
+    pending = getattr(_instantiating, 'pending', None)
+    for template, tpl_map, decl in pending or ():
+      if template is self and tpl_map == local_tpl_map:
+        return decl
 
     def LocalFinishDeclaration(kwargs):
       # Update fields and methods first, but only if templated.
@@ -893,22 +1154,41 @@ class BaseTemplated(BaseDeclaration):
         id=self.id)
     new_decl.__nested__ = generics.MARKER(
         'Nested classes are not available yet.')
-    # Put it in the cache early so we can avoid any recursion problems from the
-    # ApplyTemplates call in LocalFinishDeclaration
-    self.__cache__[local_tpl_map] = new_decl
     if not self._finished:
+      # Still being declared, so it's finished along with self.
+      self.__cache__[local_tpl_map] = new_decl
       self.__dependent_decls__.append(LocalFinishDeclaration)
-    else:
-      attribs = (set(type(self).optional_attributes.keys())
-                 - set(BaseTemplated.optional_attributes.keys()))
-      kwargs = {arg: getattr(self, arg) for arg in attribs}
-      LocalFinishDeclaration(kwargs)
+      return new_decl
 
+    # Finishing it can instantiate it again, recursively, and others that use
+    # it, so they're all kept to this thread until the first one is finished,
+    # then published together. One thread instantiates at a time, so they
+    # only ever refer to each other and to instantiations published before.
+    attribs = (set(type(self).optional_attributes.keys())
+               - set(BaseTemplated.optional_attributes.keys()))
+    kwargs = {arg: getattr(self, arg) for arg in attribs}
+    if pending is not None:
+      pending.append((self, local_tpl_map, new_decl))
+      LocalFinishDeclaration(kwargs)
+      return new_decl
+    with _instantiation_lock:
+      # Another thread may have made it while this one waited.
+      published = self.__cache__.get(local_tpl_map, None)
+      if published is not None:
+        return published
+      pending = _instantiating.pending = [(self, local_tpl_map, new_decl)]
+      try:
+        LocalFinishDeclaration(kwargs)
+      finally:
+        del _instantiating.pending
+      for template, tpl_map, decl in pending:
+        template.__cache__[tpl_map] = decl
     return new_decl
 
 
 class TemplatedStruct(BaseTemplated):
-  optional_attributes = {'fields': list}
+  optional_attributes = {'fields': list, 'data_words': None,
+                         'pointer_words': None, 'discriminant_offset': None}
   base_type = Struct
 
 
@@ -0,0 +1,573 @@
+"""Native asyncio backend, over TCP or Unix sockets.
+
+The same setup_server/setup_client/register_interface surface as cara_pseud,
+without pseud, ZeroMQ or tornado in the way:
+
+  server = cara_asyncio.setup_server(cara_asyncio.Server())
+  server.bind('tcp://127.0.0.1:5000')  # or 'unix:///tmp/calculator'
+  await server.start()
+  cara_asyncio.register_interface(server, Calculator, MyCalculator())
+
+  client = cara_asyncio.setup_client(cara_asyncio.Client())
+  client.connect('tcp://127.0.0.1:5000')
+  await client.start()
+  result = await Calculator(client).add(2, 5)
+
+Messages are msgpack arrays written back to back on the stream, and either side
+of a connection can call the rpcs registered on the other side.
+
+Clients created with codecs=[...] negotiate one of those codecs (see
+cara.codec) with the server when they start, and then send the params and
+results of calls that don't involve interfaces encoded with it.
+
+Peers created with batch=True hold their outgoing messages until the end of
+the current loop iteration (or batch_delay seconds, or max_batch messages) and
+send them as a single batch message. Replies to the calls in a batch that are
+ready right away go back in a single batch as well.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import inspect
+import itertools
+import logging
+import os
+import random
+import signal
+import socket
+
+from cara import cara
+from cara import codec
+from cara import remote
+from cara.remote import register_interface  # noqa
+import msgpack
+import mutablerecords
+
+# Message types, always the first element of a message.
+REQUEST, RESPONSE, ERROR, NOTIFY, BATCH = range(5)
+
+RemoteInterfaceDescriptor = mutablerecords.HashableRecord(
+    'RemoteInterfaceDescriptor', ['remote_id', 'client'])
+
+
+class RemoteError(Exception):
+  """The other side raised an exception while handling a call."""
+
+
+class PendingCall(asyncio.Future):
+  """Future for a call that is waiting on its response.
+
+  Converting it to a type stores the conversion on the future itself, which
+  is applied when the response arrives instead of chaining another future.
+  """
+  convert = None
+
+
+def _ConvertPendingCall(type, future):
+  convert = functools.partial(cara._ConvertToType, type)
+  if future.convert is not None:
+    convert = _Compose(convert, future.convert)
+  future.convert = convert
+  return future
+
+
+def _Compose(outer, inner):
+  return lambda value: outer(inner(value))
+
+
+def _ParseEndpoint(endpoint):
+  """Splits an endpoint into ('tcp', (host, port)) or ('unix', path)."""
+  if isinstance(endpoint, bytes):
+    endpoint = endpoint.decode('utf-8')
+  scheme, _, address = endpoint.partition('://')
+  if scheme == 'tcp':
+    host, _, port = address.rpartition(':')
+    return scheme, (host.strip('[]') or None, int(port))
+  if scheme in ('unix', 'ipc'):
+    return 'unix', address
+  raise ValueError('Unsupported endpoint %s, expected tcp://host:port or '
+                   'unix://path' % endpoint)
+
+
+class Connection(object):
+  """A stream between two peers, where either one can call the other.
+
+  Attribute access turns into calls of the other side's rpcs, like pseud's
+  clients: connection.call(...) calls the rpc registered as 'call'.
+  """
+
+  def __init__(self, peer, reader, writer, loop=None):
+    self.peer = peer
+    self.reader = reader
+    self.writer = writer
+    self.loop = loop or asyncio.get_event_loop()
+    self.pending = {}
+    self._ids = itertools.count()
+    # The codec negotiated for this connection, if any.
+    self.codec = None
+    self._packer = msgpack.Packer(default=self._Default, use_bin_type=True)
+    self._reading = None
+    # Packed messages waiting to be written, when batching.
+    self._outbox = []
+    self._flush = None
+    # Replies to the batch being dispatched, if any.
+    self._replies = None
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    return functools.partial(self.Request, name)
+
+  def Start(self):
+    self._reading = self.loop.create_task(self._ReadLoop())
+    return self._reading
+
+  def Request(self, name, *args, **kwargs):
+    """Calls the other side's rpc, returning a future for its result."""
+    msg_id = next(self._ids)
+    future = self.pending[msg_id] = PendingCall(loop=self.loop)
+    self._Send((REQUEST, msg_id, name, args, kwargs))
+    return future
+
+  def Notify(self, name, *args, **kwargs):
+    """Calls the other side's rpc without waiting for (or getting) a result."""
+    self._Send((NOTIFY, None, name, args, kwargs))
+
+  def Close(self):
+    self.Flush()
+    self.writer.close()
+
+  def Flush(self):
+    """Writes out the messages held back for batching."""
+    if self._flush is not None:
+      self._flush.cancel()
+      self._flush = None
+    outbox, self._outbox = self._outbox, []
+    self._Write(outbox)
+
+  def _Default(self, obj):
+    for code, (type, encode, _) in self.peer.translation_table.items():
+      if isinstance(obj, type):
+        return msgpack.ExtType(code, encode(obj))
+    raise TypeError('Cannot serialize %r' % (obj,))
+
+  def _ExtHook(self, code, data):
+    _, _, decode = self.peer.translation_table[code]
+    return decode(self, data)
+
+  def _Send(self, message):
+    # Packed right away so serialization errors are raised to the sender.
+    data = self._packer.pack(message)
+    if self._replies is not None:
+      self._replies.append(data)
+    elif self.peer.batch:
+      self._outbox.append(data)
+      if len(self._outbox) >= self.peer.max_batch:
+        self.Flush()
+      elif self._flush is None:
+        self._flush = self.loop.call_later(self.peer.batch_delay, self.Flush)
+    else:
+      self.writer.write(data)
+
+  def _Write(self, messages):
+    if len(messages) == 1:
+      self.writer.write(messages[0])
+    elif messages:
+      self.writer.write(
+          self._packer.pack((BATCH, len(messages), b''.join(messages))))
+
+  def _NewUnpacker(self):
+    return msgpack.Unpacker(
+        raw=False, strict_map_key=False, ext_hook=self._ExtHook)
+
+  async def _ReadLoop(self):
+    unpacker = self._NewUnpacker()
+    try:
+      while True:
+        data = await self.reader.read(65536)
+        if not data:
+          break
+        unpacker.feed(data)
+        for message in unpacker:
+          self._Dispatch(message)
+    except (ConnectionError, asyncio.CancelledError):
+      pass
+    finally:
+      self._Lost()
+
+  def _Lost(self):
+    if self._flush is not None:
+      self._flush.cancel()
+      self._flush = None
+    self._outbox = []
+    self.writer.close()
+    pending, self.pending = self.pending, {}
+    for future in pending.values():
+      if not future.done():
+        future.set_exception(ConnectionError('Connection closed'))
+    self.peer._Disconnected(self)
+
+  def _Dispatch(self, message):
+    kind, msg_id = message[0], message[1]
+    if kind == REQUEST:
+      self._HandleRequest(msg_id, *message[2:])
+    elif kind == RESPONSE:
+      self._Resolve(msg_id, message[2])
+    elif kind == ERROR:
+      self._Resolve(msg_id, error=RemoteError(*message[2:]))
+    elif kind == NOTIFY:
+      self._HandleNotify(*message[2:])
+    elif kind == BATCH:
+      self._DispatchBatch(message[2])
+
+  def _DispatchBatch(self, data):
+    unpacker = self._NewUnpacker()
+    unpacker.feed(data)
+    self._replies = []
+    try:
+      for message in unpacker:
+        self._Dispatch(message)
+    finally:
+      replies, self._replies = self._replies, None
+    # Replies that weren't ready are sent on their own when they are.
+    self._Write(replies)
+
+  def _HandleRequest(self, msg_id, name, args, kwargs):
+    rpc = self.peer.rpcs.get(name)
+    try:
+      if rpc is None:
+        raise LookupError('No rpc named %s' % name)
+      result = rpc(*args, **kwargs)
+    except Exception as e:
+      self._SendError(msg_id, e)
+      return
+    if isinstance(result, concurrent.futures.Future):
+      result = asyncio.wrap_future(result, loop=self.loop)
+    if inspect.isawaitable(result):
+      future = asyncio.ensure_future(result, loop=self.loop)
+      future.add_done_callback(functools.partial(self._Respond, msg_id))
+      return
+    self._SendResult(msg_id, result)
+
+  def _HandleNotify(self, name, args, kwargs):
+    rpc = self.peer.rpcs.get(name)
+    try:
+      if rpc is None:
+        raise LookupError('No rpc named %s' % name)
+      rpc(*args, **kwargs)
+    except Exception:
+      # Nobody to send the error to.
+      logging.exception('Notification %s failed', name)
+
+  def _Respond(self, msg_id, future):
+    if future.cancelled():
+      self._SendError(msg_id, asyncio.CancelledError())
+    elif future.exception() is not None:
+      self._SendError(msg_id, future.exception())
+    else:
+      self._SendResult(msg_id, future.result())
+
+  def _SendResult(self, msg_id, result):
+    try:
+      self._Send((RESPONSE, msg_id, result))
+    except Exception as e:
+      self._SendError(msg_id, e)
+
+  def _SendError(self, msg_id, error):
+    self._Send((ERROR, msg_id, type(error).__name__, str(error)))
+
+  def _Resolve(self, msg_id, result=None, error=None):
+    future = self.pending.pop(msg_id, None)
+    if future is None or future.done():
+      return
+    if error is None and future.convert is not None:
+      try:
+        result = future.convert(result)
+      except Exception as e:
+        error = e
+    if error is not None:
+      future.set_exception(error)
+    else:
+      future.set_result(result)
+
+
+class _Peer(object):
+  """Common parts of Server and Client, the rpcs they answer to.
+
+  Args:
+    loop: The event loop, defaults to the current one.
+    batch: Whether to batch outgoing messages.
+    max_batch: Send a batch as soon as it has this many messages.
+    batch_delay: Seconds to hold a batch for, 0 sends it once the loop gets
+      through the callbacks that are ready.
+    ttl: Seconds an exported interface may go unused before it's dropped,
+      for peers that go away without releasing them. None keeps them until
+      they're released.
+    codecs: Codec names, see cara.codec. A Client offers them to the server
+      in order of preference, and doesn't use one without them. A Server
+      accepts only these, or any registered codec if they're None.
+  """
+  handler = None
+
+  def __init__(self, loop=None, batch=False, max_batch=128, batch_delay=0,
+               ttl=None, codecs=None):
+    self.loop = loop
+    self.batch = batch
+    self.max_batch = max_batch
+    self.batch_delay = batch_delay
+    self.ttl = ttl
+    self.codecs = codecs
+    self.rpcs = {}
+    self.translation_table = {}
+    self.connections = set()
+    self._sweeping = None
+
+  def register_rpc(self, func=None, name=None):
+    if func is None:
+      return functools.partial(self.register_rpc, name=name)
+    self.rpcs[name or func.__name__] = func
+    return func
+
+  def _Connected(self, reader, writer):
+    connection = Connection(
+        self, reader, writer, loop=self.loop or asyncio.get_event_loop())
+    self.connections.add(connection)
+    connection.Start()
+    return connection
+
+  def _Disconnected(self, connection):
+    self.connections.discard(connection)
+
+  def _StartSweeping(self):
+    if self.ttl is None or self.handler is None or self._sweeping:
+      return
+    self._sweeping = (self.loop or asyncio.get_event_loop()).call_later(
+        self.ttl, self._Sweep)
+
+  def _Sweep(self):
+    self._sweeping = None
+    self.handler.Sweep()
+    self._StartSweeping()
+
+  def close(self):
+    if self._sweeping is not None:
+      self._sweeping.cancel()
+      self._sweeping = None
+    for connection in list(self.connections):
+      connection.Close()
+
+
+class Server(_Peer):
+  """Listens on any number of endpoints, each connection is a Connection."""
+
+  def __init__(self, loop=None, **kwargs):
+    super().__init__(loop=loop, **kwargs)
+    self.endpoints = []
+    self.servers = []
+    # Listening sockets and worker pids, with start_workers.
+    self.sockets = []
+    self.workers = []
+
+  def bind(self, endpoint):
+    self.endpoints.append(endpoint)
+
+  async def start(self):
+    for endpoint in self.endpoints:
+      scheme, address = _ParseEndpoint(endpoint)
+      if scheme == 'tcp':
+        server = await asyncio.start_server(self._Connected, *address)
+      else:
+        server = await asyncio.start_unix_server(self._Connected, address)
+      self.servers.append(server)
+    self._StartSweeping()
+
+  def start_workers(self, workers):
+    """Forks processes that all serve the bound endpoints.
+
+    Call this instead of start, after registering the interfaces and outside
+    of a running event loop. The workers share the listening sockets, so each
+    connection belongs to one worker, and so does every interface exported
+    over it. Workers are numbered from 1 and tag their export ids with their
+    number (see remote.ExportOwner), since they'd otherwise all count from
+    the same forked state.
+
+    Returns: The pids of the workers.
+    """
+    self.sockets = [_Listen(endpoint) for endpoint in self.endpoints]
+    for number in range(1, workers + 1):
+      pid = os.fork()
+      if pid == 0:
+        self._RunWorker(number)
+      self.workers.append(pid)
+    return self.workers
+
+  def stop_workers(self):
+    """Stops the workers from start_workers and waits for them to exit."""
+    for pid in self.workers:
+      os.kill(pid, signal.SIGTERM)
+    for pid in self.workers:
+      os.waitpid(pid, 0)
+    self.workers = []
+    for sock in self.sockets:
+      sock.close()
+    self.sockets = []
+
+  def _RunWorker(self, number):
+    status = 1
+    try:
+      # Don't pick the same answer ids as every other worker.
+      random.seed()
+      self.handler.owner = number
+      self.loop = asyncio.new_event_loop()
+      asyncio.set_event_loop(self.loop)
+      self.loop.add_signal_handler(signal.SIGTERM, self.loop.stop)
+      self.loop.run_until_complete(self._Serve())
+      self.loop.run_forever()
+      self.close()
+      status = 0
+    except BaseException:
+      logging.exception('Worker %d failed', number)
+    finally:
+      os._exit(status)
+
+  async def _Serve(self):
+    for sock in self.sockets:
+      if sock.family == socket.AF_UNIX:
+        server = await asyncio.start_unix_server(self._Connected, sock=sock)
+      else:
+        server = await asyncio.start_server(self._Connected, sock=sock)
+      self.servers.append(server)
+    self._StartSweeping()
+
+  @property
+  def addresses(self):
+    """The bound addresses, useful when binding to port 0."""
+    if self.sockets:
+      return [sock.getsockname() for sock in self.sockets]
+    return [sock.getsockname()
+            for server in self.servers for sock in server.sockets]
+
+  def close(self):
+    for server in self.servers:
+      server.close()
+    super().close()
+
+
+def _Listen(endpoint):
+  scheme, address = _ParseEndpoint(endpoint)
+  if scheme == 'tcp':
+    host, port = address
+    family = socket.AF_INET6 if host and ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host or '', port))
+  else:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(address)
+  sock.listen(100)
+  sock.setblocking(False)
+  return sock
+
+
+class Client(_Peer):
+  """Connects to a single endpoint, attribute access calls the server's rpcs."""
+
+  connection = None
+
+  def connect(self, endpoint):
+    self.endpoint = endpoint
+
+  async def start(self):
+    scheme, address = _ParseEndpoint(self.endpoint)
+    if scheme == 'tcp':
+      reader, writer = await asyncio.open_connection(*address)
+    else:
+      reader, writer = await asyncio.open_unix_connection(address)
+    self.connection = self._Connected(reader, writer)
+    await self._Negotiate()
+    self._StartSweeping()
+
+  async def _Negotiate(self):
+    """Picks the codec for the connection with the server."""
+    if not self.codecs:
+      return
+    try:
+      name = await self.connection.Request(
+          'negotiate_codec', list(self.codecs))
+    except RemoteError:
+      # A server from before codecs, everything goes in the default format.
+      return
+    if name is not None:
+      self.connection.codec = codec.GetCodec(name)
+
+  def __getattr__(self, name):
+    if name.startswith('_') or self.connection is None:
+      raise AttributeError(name)
+    return getattr(self.connection, name)
+
+
+class RemoteInterfaceClient(remote.RemoteInterfaceClient):
+
+  def _Codec(self):
+    client = self.client
+    if isinstance(client, remote.ClientPool):
+      # The replicas are the same server, so they all pick the same codec.
+      client = client.clients[0]
+    elif isinstance(client, remote.PooledClient):
+      client = client.client
+    return getattr(client, 'codec', None)
+
+  def _Request(self, name, *args):
+    return self.client.Request(name, *args)
+
+  def _Notify(self, name, *args):
+    self.client.Notify(name, *args)
+
+
+def _SetupPeer(peer):
+  _RegisterAsyncioBackend()
+  handler = peer.handler = remote.RemoteInterfaceServer(
+      ttl=peer.ttl, codecs=peer.codecs)
+
+  def iface_to_mp(val):
+    return msgpack.packb(handler.export(val))
+
+  def mp_to_remote_iface(connection, val):
+    # Interfaces always come from the other side of the connection they
+    # arrived on, so that's where calls on them go back to.
+    return RemoteInterfaceDescriptor(msgpack.unpackb(val), connection)
+
+  peer.translation_table = {
+      100: ((cara.BaseInterface, remote.RemoteInterfaceClient),
+            iface_to_mp, mp_to_remote_iface),
+  }
+  peer.register_rpc(handler.call, 'call')
+  # For promise pipelining.
+  peer.register_rpc(handler.call_promised, 'call_promised')
+  peer.register_rpc(handler.call_pipelined, 'call_pipelined')
+  peer.register_rpc(handler.finish, 'finish')
+  peer.register_rpc(handler.release, 'release')
+  # For $Cara.stream methods.
+  peer.register_rpc(handler.call_stream, 'call_stream')
+  peer.register_rpc(handler.stream_next, 'stream_next')
+  peer.register_rpc(handler.stream_cancel, 'stream_cancel')
+  # For calls encoded with a codec.
+  peer.register_rpc(handler.negotiate_codec, 'negotiate_codec')
+  peer.register_rpc(handler.call_encoded, 'call_encoded')
+  return peer
+
+
+def setup_server(server):
+  return _SetupPeer(server)
+
+
+def setup_client(client):
+  return _SetupPeer(client)
+
+
+def _RegisterAsyncioBackend():
+  # Responses are converted as they arrive, on the same future.
+  cara.type_conversion_registry.Register(PendingCall, _ConvertPendingCall)
+  remote.RegisterRemoteTypes()
+  cara.BaseInterface.remote_type_registry.Register(
+      RemoteInterfaceDescriptor, RemoteInterfaceClient.FromDescriptor)
@@ -0,0 +1,141 @@
+"""In-process backend, for testing and measuring cara without a network.
+
+The same setup_server/setup_client/register_interface surface as cara_pseud
+and cara_asyncio, with endpoints that are just names in this process:
+
+  server = cara_loopback.setup_server(cara_loopback.Server())
+  server.bind('calculator')
+  await server.start()
+  cara_loopback.register_interface(server, Calculator, MyCalculator())
+
+  client = cara_loopback.setup_client(cara_loopback.Client())
+  client.connect('calculator')
+  await client.start()
+  result = await Calculator(client).add(2, 5)
+
+Messages are handed to the other side on the next loop iteration. By default
+they're packed with msgpack exactly like cara_asyncio's, so serialization is
+part of the cost of a call. Clients created with encode=False skip that and
+only translate interfaces, leaving just cara's own overhead (and no batching).
+"""
+import asyncio
+
+from cara import cara_asyncio
+from cara.cara_asyncio import RemoteError, setup_client, setup_server  # noqa
+from cara.remote import register_interface  # noqa
+
+# Servers that were started, by endpoint.
+_servers = {}
+
+
+class _Writer(object):
+  """Stands in for a stream writer, writing to the other connection."""
+
+  def __init__(self, connection, other):
+    self.connection = connection
+    self.other = other
+    self.closed = False
+    if connection.encode:
+      self.receive = other._Receive
+    else:
+      self.receive = other._Dispatch
+
+  def write(self, data):
+    if not self.closed:
+      self.connection.loop.call_soon(self.receive, data)
+
+  def close(self):
+    if self.closed:
+      return
+    self.closed = True
+    self.connection.loop.call_soon(self.connection._Lost)
+    self.connection.loop.call_soon(self.other._Lost)
+
+
+class Connection(cara_asyncio.Connection):
+  """One end of a loopback connection, see cara_asyncio.Connection."""
+
+  def __init__(self, peer, encode=True, loop=None):
+    super().__init__(peer, None, None, loop=loop)
+    self.encode = encode
+    self.other = None
+    self._unpacker = self._NewUnpacker()
+    self._closed = False
+
+  def Start(self):
+    pass
+
+  def _Receive(self, data):
+    if self._closed:
+      return
+    self._unpacker.feed(data)
+    for message in self._unpacker:
+      self._Dispatch(message)
+
+  def _Send(self, message):
+    if self.encode:
+      super()._Send(message)
+    else:
+      self.writer.write(self._Translate(message))
+
+  def _Translate(self, value):
+    """Does what packing and unpacking would, for encode=False."""
+    for code, (type, encode, _) in self.peer.translation_table.items():
+      if isinstance(value, type):
+        _, _, decode = self.other.peer.translation_table[code]
+        return decode(self.other, encode(value))
+    if isinstance(value, dict):
+      return {key: self._Translate(val) for key, val in value.items()}
+    if isinstance(value, (list, tuple)):
+      return [self._Translate(val) for val in value]
+    return value
+
+  def _Lost(self):
+    if self._closed:
+      return
+    self._closed = True
+    super()._Lost()
+
+
+def _Connect(client, server, encode):
+  loop = client.loop or asyncio.get_event_loop()
+  ours = Connection(client, encode, loop=loop)
+  theirs = Connection(server, encode, loop=loop)
+  ours.other, theirs.other = theirs, ours
+  ours.writer, theirs.writer = _Writer(ours, theirs), _Writer(theirs, ours)
+  client.connections.add(ours)
+  server.connections.add(theirs)
+  return ours
+
+
+class Server(cara_asyncio.Server):
+  """Answers the clients connecting to any of its endpoint names."""
+
+  async def start(self):
+    for endpoint in self.endpoints:
+      if endpoint in _servers:
+        raise OSError('%s is already bound' % endpoint)
+      _servers[endpoint] = self
+    self._StartSweeping()
+
+  def close(self):
+    for endpoint in self.endpoints:
+      if _servers.get(endpoint) is self:
+        del _servers[endpoint]
+    super().close()
+
+
+class Client(cara_asyncio.Client):
+  """Connects to a Server in the same process, by endpoint name."""
+
+  def __init__(self, loop=None, encode=True, **kwargs):
+    super().__init__(loop=loop, **kwargs)
+    self.encode = encode
+
+  async def start(self):
+    server = _servers.get(self.endpoint)
+    if server is None:
+      raise ConnectionRefusedError('Nothing bound to %s' % self.endpoint)
+    self.connection = _Connect(self, server, self.encode)
+    await self._Negotiate()
+    self._StartSweeping()
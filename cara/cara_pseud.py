@@ -1,62 +1,63 @@
 import concurrent.futures
-import inspect
 
 from cara import cara
+from cara import remote
+from cara.remote import RemoteInterfaceServer, register_interface  # noqa
 import mutablerecords
 
 import msgpack
 import pseud
 import tornado.concurrent
+import tornado.ioloop
 
 RemoteInterfaceDescriptor = mutablerecords.HashableRecord(
     'RemoteInterfaceDescriptor', ['remote_id', 'client'])
 
 
-class RemoteInterfaceServer(mutablerecords.Record('Wrapper', [], {'objs': dict})):
+class RemoteInterfaceClient(remote.RemoteInterfaceClient):
 
-  def call(self, local_id, iface_id, method_id, args, kwargs):
-    return self.objs[local_id][iface_id, method_id](*args, **kwargs)
+  def _Request(self, name, *args):
+      if isinstance(self.client, (remote.ClientPool, remote.PooledClient)):
+          return super()._Request(name, *args)
+      handle = self.__dict__.get('_handle')
+      if handle is None:
+          handle = self.__dict__['_handle'] = _CallHandle(self.client)
+      return handle(name, *args)
 
-  def register(self, local_id, obj):
-    self.objs[local_id] = obj
 
+class _CallHandle(object):
+  """Sends rpcs the way a pseud AttributeWrapper does, but can be reused.
 
-class RemoteInterfaceClient(mutablerecords.HashableRecord(
-        'RemoteInterface', ['remote_id', 'client', 'interface'])):
+  The AttributeWrapper is a naughty object that modifies itself instead of
+  returning a new object when we do 'client.call', and pseud's clients create
+  a new one for every attribute.
+  """
+  __slots__ = ('rpc', 'user_id', 'prefix')
 
-  @classmethod
-  def FromDescriptor(cls, interface, descriptor):
-    return cls(descriptor.remote_id, descriptor.client, interface)
+  def __init__(self, client):
+      if isinstance(client, pseud.common.AttributeWrapper):
+          self.rpc = client.rpc
+          self.user_id = client.user_id
+          self.prefix = client.name
+      else:
+          self.rpc = client
+          self.user_id = None
+          self.prefix = ''
 
-  def __getattr__(self, attr):
-      iface_id, method = self.interface._get_method(attr)
-      if method is None:
-          raise AttributeError('%s has no attribute %s' % (self, attr))
-
-      def ProxyMethod(*args, **kwargs):
-          client = self.client
-          if client and isinstance(client, pseud.common.AttributeWrapper):
-              # The AttributeWrapper is a naughty object that modifies itself
-              # instead of returning a new object when we do 'client.call'.
-              client = pseud.common.AttributeWrapper(
-                  client.rpc, client.name or None, client.user_id)
-          return client.call(self.remote_id, iface_id, method.id, args, kwargs)
-      return cara.BaseInterface._MethodWrapper(ProxyMethod, method)
-  __getitem__ = __getattr__
-
-  def __deepcopy__(self, memo):
-    # Can't deep copy a remote client.
-    return super().__copy__()
+  def __call__(self, name, *args, **kwargs):
+      if self.prefix:
+          name = self.prefix + '.' + name
+      return self.rpc.send_work(
+          self.user_id or self.rpc.peer_routing_id, name, *args, **kwargs)
 
 
 def setup_server(server):
     _RegisterPseudBackend()
     # Register Interface with the server
-    handler = RemoteInterfaceServer()
+    handler = server.handler = RemoteInterfaceServer()
 
     def iface_to_mp(val):
-        handler.register(id(val), val)
-        return msgpack.packb(id(val))
+        return msgpack.packb(handler.export(val))
 
     def mp_to_remote_iface(val):
         # hack to deal with the fact that this is for both Interface and
@@ -74,17 +75,16 @@ def setup_server(server):
     }
 
     server.packer.translation_table = server_table
-    server.register_rpc(handler.call, 'call')
+    _RegisterHandler(server, handler)
     return server
 
 
 def setup_client(client):
     _RegisterPseudBackend()
-    handler = RemoteInterfaceServer()
+    handler = client.handler = RemoteInterfaceServer()
 
     def iface_to_mp(val):
-        handler.register(id(val), val)
-        return msgpack.packb((id(val), client.user_id))
+        return msgpack.packb((handler.export(val), client.user_id))
 
     def mp_to_remote_iface(val):
         remote_id = msgpack.unpackb(val)
@@ -94,10 +94,26 @@ def setup_client(client):
         101: (RemoteInterfaceClient, iface_to_mp, mp_to_remote_iface),
     }
     client.packer.translation_table = client_table
-    client.register_rpc(handler.call, 'call')
+    _RegisterHandler(client, handler)
     return client
 
 
+def _RegisterHandler(server, handler):
+    server.register_rpc(handler.call, 'call')
+    # For promise pipelining.
+    server.register_rpc(handler.call_promised, 'call_promised')
+    server.register_rpc(handler.call_pipelined, 'call_pipelined')
+    server.register_rpc(handler.finish, 'finish')
+    server.register_rpc(handler.release, 'release')
+    # For $Cara.stream methods.
+    server.register_rpc(handler.call_stream, 'call_stream')
+    server.register_rpc(handler.stream_next, 'stream_next')
+    server.register_rpc(handler.stream_cancel, 'stream_cancel')
+    # For calls encoded with a codec.
+    server.register_rpc(handler.negotiate_codec, 'negotiate_codec')
+    server.register_rpc(handler.call_encoded, 'call_encoded')
+
+
 def _RegisterPseudBackend():
   def ConvertFutureCorrectly(type, future):
     """Converts a future's result into the given type.
@@ -108,9 +124,14 @@ def _RegisterPseudBackend():
     new_future = tornado.concurrent.Future()
 
     def _Done(fut):
-        new_future.set_result(cara._ConvertToType(type, fut.result()))
-
-    future.add_done_callback(_Done)
+        if fut.exception() is None:
+            new_future.set_result(cara._ConvertToType(type, fut.result()))
+
+    if isinstance(future, concurrent.futures.Future):
+        # Its callbacks run in the executor's thread, not the IOLoop's.
+        tornado.ioloop.IOLoop.current().add_future(future, _Done)
+    else:
+        future.add_done_callback(_Done)
     # For exceptions only:
     tornado.concurrent.chain_future(future, new_future)
     return new_future
@@ -119,72 +140,8 @@ def _RegisterPseudBackend():
       tornado.concurrent.Future, ConvertFutureCorrectly)
   cara.type_conversion_registry.Register(
       concurrent.futures.Future, ConvertFutureCorrectly)
+  remote.RegisterRemoteTypes()
   # Next register the remote descriptor handler for when those method calls
   # return a remote interface.
   cara.BaseInterface.remote_type_registry.Register(
       RemoteInterfaceDescriptor, RemoteInterfaceClient.FromDescriptor)
-
-
-def register_interface(server, interface=None, obj_or_cls=None):
-    """Registers an object with the given server (or client).
-
-    Call this with a server and an object, and optionally an interface.
-
-    If called with only a server, it will become a decorator and must be called
-    on a class that can be constructed with no arguments. If the interface has a
-    single method, then it may also decorate a function.
-
-    If the interface is not specified, then the object must be a subclass of an
-    interface.
-
-    interface FooInterface {
-        bar @0 () -> ();
-    }
-
-    @register_interface(server)
-    class Foo(FooInterface):
-        ...
-
-    @register_interface(server, interface=FooInterface)
-    class Foo:
-        ...
-
-    @register_interface(server, interface=FooInterface)
-    def bar_func():
-        ...
-
-    register_interface(server, FooInterface, FooClass)
-    register_interface(server, FooInterface, bar_func)
-    """
-
-    def decorator(obj_or_cls):
-        nonlocal interface
-        if inspect.isclass(obj_or_cls):
-            obj = obj_or_cls()
-            interface = cara._find_interface_base_class(obj_or_cls, interface)
-        elif inspect.isfunction(obj_or_cls):
-            if interface is None:
-                raise TypeError('Interface must be specified for registering a '
-                                'single function.')
-            if len(interface.__methods__) != 1:
-                raise TypeError(
-                    'Interface %s has too many methods to be registered with '
-                    'only a function.' % interface)
-            obj = interface(obj_or_cls)
-        else:
-            # Should be an instance of a class.
-            interface = cara._find_interface_base_class(
-                obj_or_cls.__class__, interface)
-            obj = interface(obj_or_cls)
-
-        # interface is last since we want to override any overlapping names.
-        for iface in interface.__superclasses__ + (interface,):
-            for name, method in iface.__methods__.items():
-                func = getattr(obj, name)
-                if isinstance(method, cara.TemplatedMethod):
-                    func = func.__getitem__(
-                        (cara.AnyPointer,) * len(method.templates))
-                server.register_rpc(func, name=name)
-    if obj_or_cls is None:
-        return decorator
-    return decorator(obj_or_cls)
@@ -0,0 +1,534 @@
+"""Codecs for the values of cara types, driven by their schema.
+
+A codec turns a value of a cara type into bytes and back:
+
+  codec = codec.GetCodec('msgpack-positional')
+  data = codec.Encode(Person, person)
+  person = codec.Decode(Person, data)
+
+Every codec walks the declared fields (a struct's __id_fields__) instead of
+inspecting values, and builds an encoder for each type the first time it sees
+it. They differ in how structs are laid out and in the serialization format:
+
+  msgpack             {id: value} maps, the same as the default wire format.
+  msgpack-positional  [value, ...] arrays indexed by field id, with None for
+                      missing fields and trailing Nones left off. Void values
+                      are True, so they aren't mistaken for missing ones.
+  json                {name: value} objects, like ToDict(with_field_names=True),
+                      with Data as base64 text.
+  cbor                {id: value} maps in CBOR (RFC 8949).
+
+Backends negotiate one per connection (see cara_asyncio), and params and
+results of calls on remote interfaces are then sent encoded with it. Values
+that hold interfaces or AnyPointers can't be encoded, calls with those keep
+using the backend's own format.
+"""
+import base64
+import collections
+import inspect
+import json
+import math
+import struct
+import threading
+
+from cara import cara
+
+try:
+  import msgpack
+except ImportError:  # Only installed with the asyncio extra.
+  msgpack = None
+
+# How structs are laid out, see the module docstring.
+IDS, POSITIONS, NAMES = 'ids', 'positions', 'names'
+
+# The encoders and decoders each thread is making, see Codec._Build.
+_building = threading.local()
+
+# Codecs by name, in the order they're preferred when negotiating.
+codecs = collections.OrderedDict()
+
+
+class Codec(object):
+  """Encodes values of cara types as bytes, and decodes them back.
+
+  Subclasses set the class attributes and implement Dump and Load, for the
+  trees of builtin values that ToTree makes and FromTree takes.
+
+  Attributes:
+    name: What it's registered and negotiated as.
+    layout: How structs are laid out, IDS, POSITIONS or NAMES.
+    binary: Whether Data can be dumped as it is. If not, it's base64 text.
+  """
+  name = None
+  layout = IDS
+  binary = True
+
+  def __init__(self):
+    self._encoders = {}
+    self._decoders = {}
+    self._passes = {}
+
+  def Dump(self, tree):
+    """Serializes a tree of dicts, lists and builtin values to bytes."""
+    raise NotImplementedError
+
+  def Load(self, data):
+    """Deserializes bytes from Dump back into a tree."""
+    raise NotImplementedError
+
+  def Encode(self, type, value):
+    return self.Dump(self.ToTree(type, value))
+
+  def Decode(self, type, data):
+    return cara._ConvertToType(type, self.FromTree(type, self.Load(data)))
+
+  def EncodeMany(self, types, values):
+    """Encodes values of each of types as a single list."""
+    return self.Dump([self.ToTree(type, value)
+                      for type, value in zip(types, values)])
+
+  def DecodeMany(self, types, data):
+    return [cara._ConvertToType(type, tree)
+            for type, tree in zip(types, self.FromTrees(types, data))]
+
+  def ToTree(self, type, value):
+    """The tree of builtin values that Dump serializes for value."""
+    return self._Encoder(type)(value)
+
+  def FromTree(self, type, tree):
+    """Turns a tree from Load into something type converts from.
+
+    That's a dict keyed by field id for structs, so converting it is exactly
+    as much work as converting what the default wire format arrives as.
+    """
+    if self._Passes(type):
+      return tree
+    return self._Decoder(type)(tree)
+
+  def FromTrees(self, types, data):
+    """FromTree for each of the values EncodeMany encoded in data."""
+    return [self.FromTree(type, tree)
+            for type, tree in zip(types, self.Load(data))]
+
+  def _Encoder(self, type):
+    encoder = self._encoders.get(type)
+    if encoder is None:
+      encoder = self._Build(
+          self._encoders, type, self._NewEncoder,
+          lambda value: self._Encoder(type)(value))
+    return encoder
+
+  def _Build(self, cache, type, new, placeholder):
+    """Makes what cache has for type with new, and publishes it.
+
+    Recursive types find placeholder until it's made. Only this thread does,
+    other threads see it once it's made, and make their own meanwhile.
+    """
+    building = _building.__dict__.setdefault('building', {})
+    key = id(cache), type
+    if key in building:
+      return building[key]
+    building[key] = placeholder
+    try:
+      made = new(type)
+    finally:
+      del building[key]
+    return cache.setdefault(type, made)
+
+  def _NewEncoder(self, type):
+    if isinstance(type, cara.StructMeta):
+      return self._StructEncoder(type)
+    if isinstance(type, cara.InterfaceMeta):
+      return _InterfaceEncoder(type)
+    if _IsSubclass(type, cara.BaseList):
+      if self._Leaf(type.sub_type):
+        return list
+      encode = self._Encoder(type.sub_type)
+      return lambda value: [encode(element) for element in value]
+    if _IsSubclass(type, cara.BaseEnum):
+      return int
+    if type is cara.Data and not self.binary:
+      return _EncodeBase64
+    return _Identity
+
+  def _StructEncoder(self, struct_type):
+    encoders = {
+        field.id: None if self._Leaf(field.type) else self._Encoder(field.type)
+        for field in struct_type.__id_fields__}
+    # The fields that are set, by id, without going through the struct's own
+    # lookups by name. Anything but the struct type itself, like the lazy
+    # views of cara.wire, is converted first so every field is there.
+    items, keys = dict.items, dict.keys
+
+    if self.layout == POSITIONS:
+      for field in struct_type.__id_fields__:
+        if field.type is cara.Void:
+          encoders[field.id] = EncodeVoid
+
+      def EncodePositions(value):
+        if type(value) is not struct_type:
+          value = struct_type(value)
+        if not value:
+          return []
+        encoded = [None] * (max(keys(value)) + 1)
+        for id, val in items(value):
+          encode = encoders[id]
+          encoded[id] = val if encode is None else encode(val)
+        return encoded
+      return EncodePositions
+
+    if self.layout == NAMES:
+      names = {field.id: field.name for field in struct_type.__id_fields__}
+
+      def EncodeNames(value):
+        if type(value) is not struct_type:
+          value = struct_type(value)
+        return {names[id]: val if encoders[id] is None else encoders[id](val)
+                for id, val in items(value)}
+      return EncodeNames
+
+    def EncodeIds(value):
+      if type(value) is not struct_type:
+        value = struct_type(value)
+      return {id: val if encoders[id] is None else encoders[id](val)
+              for id, val in items(value)}
+    return EncodeIds
+
+  def _Leaf(self, type):
+    """Whether values of type are already in their encoded form."""
+    return not isinstance(type, (cara.StructMeta, cara.InterfaceMeta)) and not (
+        _IsSubclass(type, (cara.BaseList, cara.BaseEnum))) and not (
+            type is cara.Data and not self.binary)
+
+  def _Passes(self, type):
+    """Whether trees of type can be converted without decoding them first."""
+    passes = self._passes.get(type)
+    if passes is None:
+      passes = not (self.layout != IDS and _Reaches(type, _IsStruct)) and (
+          self.binary or not _Reaches(type, _IsData))
+      self._passes[type] = passes
+    return passes
+
+  def _Decoder(self, type):
+    decoder = self._decoders.get(type)
+    if decoder is None:
+      decoder = self._Build(
+          self._decoders, type, self._NewDecoder,
+          lambda tree: self._Decoder(type)(tree))
+    return decoder
+
+  def _NewDecoder(self, type):
+    if isinstance(type, cara.StructMeta):
+      return self._StructDecoder(type)
+    if _IsSubclass(type, cara.BaseList):
+      if self._Passes(type.sub_type):
+        return _Identity
+      decode = self._Decoder(type.sub_type)
+      return lambda tree: [decode(element) for element in tree]
+    if type is cara.Data and not self.binary:
+      return _DecodeBase64
+    return _Identity
+
+  def _StructDecoder(self, struct_type):
+    decoders = {}
+    fields = {}
+    for field in struct_type.__id_fields__:
+      decode = None if self._Passes(field.type) else self._Decoder(field.type)
+      decoders[field.id] = decode
+      # Names are turned into ids, so unboxing a single result can't mistake
+      # a struct for the dict of results.
+      fields[field.id] = fields[field.name] = field.id, decode
+
+    if self.layout == POSITIONS:
+      for field in struct_type.__id_fields__:
+        if field.type is cara.Void:
+          decoders[field.id] = DecodeVoid
+
+      def DecodePositions(tree):
+        return {id: val if decoders[id] is None else decoders[id](val)
+                for id, val in enumerate(tree) if val is not None}
+      return DecodePositions
+
+    def Decode(tree):
+      decoded = {}
+      for key, val in tree.items():
+        id, decode = fields[key]
+        decoded[id] = val if decode is None else decode(val)
+      return decoded
+    return Decode
+
+
+class MsgpackCodec(Codec):
+  """msgpack, with structs as {id: value} maps."""
+  name = 'msgpack'
+
+  def Dump(self, tree):
+    return msgpack.packb(tree, use_bin_type=True)
+
+  def Load(self, data):
+    return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+class PositionalMsgpackCodec(MsgpackCodec):
+  """msgpack, with structs as arrays of their fields in id order."""
+  name = 'msgpack-positional'
+  layout = POSITIONS
+
+
+class JsonCodec(Codec):
+  """JSON, with structs as objects keyed by field name."""
+  name = 'json'
+  layout = NAMES
+  binary = False
+
+  def Dump(self, tree):
+    return json.dumps(tree, separators=(',', ':')).encode('utf-8')
+
+  def Load(self, data):
+    return json.loads(data)
+
+
+class CborCodec(Codec):
+  """CBOR, with structs as {id: value} maps.
+
+  Only what the trees need is supported: integers up to 64 bits, float64,
+  text, bytes, arrays, maps, booleans and null. Tags are skipped on the way
+  in, and indefinite lengths are rejected.
+  """
+  name = 'cbor'
+
+  def Dump(self, tree):
+    out = bytearray()
+    _DumpCbor(tree, out)
+    return bytes(out)
+
+  def Load(self, data):
+    try:
+      tree, end = _LoadCbor(bytes(data), 0)
+    except (IndexError, struct.error):
+      raise ValueError('Truncated CBOR data')
+    if end != len(data):
+      raise ValueError('%d bytes of trailing data after CBOR value' % (
+          len(data) - end))
+    return tree
+
+
+_UINT = {1: struct.Struct('>B'), 2: struct.Struct('>H'), 4: struct.Struct('>I'),
+         8: struct.Struct('>Q')}
+_FLOAT64 = struct.Struct('>d')
+_CBOR_FLOATS = {26: struct.Struct('>f'), 27: _FLOAT64}
+_CBOR_SIMPLE = {20: False, 21: True, 22: None, 23: None}
+
+
+def _DumpCborHead(major, length, out):
+  major <<= 5
+  if length < 24:
+    out.append(major | length)
+    return
+  for info, size in ((24, 1), (25, 2), (26, 4), (27, 8)):
+    if length < 1 << (size * 8):
+      out.append(major | info)
+      out += _UINT[size].pack(length)
+      return
+  raise ValueError('%d is too large for CBOR' % length)
+
+
+def _DumpCbor(value, out):
+  if value is None:
+    out.append(0xf6)
+  elif value is True:
+    out.append(0xf5)
+  elif value is False:
+    out.append(0xf4)
+  elif isinstance(value, int):
+    if value >= 0:
+      _DumpCborHead(0, value, out)
+    else:
+      _DumpCborHead(1, -1 - value, out)
+  elif isinstance(value, float):
+    out.append(0xfb)
+    out += _FLOAT64.pack(value)
+  elif isinstance(value, str):
+    data = value.encode('utf-8')
+    _DumpCborHead(3, len(data), out)
+    out += data
+  elif isinstance(value, (bytes, bytearray, memoryview)):
+    _DumpCborHead(2, len(value), out)
+    out += value
+  elif isinstance(value, (list, tuple)):
+    _DumpCborHead(4, len(value), out)
+    for element in value:
+      _DumpCbor(element, out)
+  elif isinstance(value, dict):
+    _DumpCborHead(5, len(value), out)
+    for key, val in value.items():
+      _DumpCbor(key, out)
+      _DumpCbor(val, out)
+  else:
+    raise TypeError('Cannot encode %r as CBOR' % (value,))
+
+
+def _LoadCbor(data, pos):
+  """The value starting at data[pos], and where the next one starts."""
+  initial = data[pos]
+  pos += 1
+  major, info = initial >> 5, initial & 0x1f
+  if major == 7:
+    if info == 25:
+      return _CborHalf(_UINT[2].unpack_from(data, pos)[0]), pos + 2
+    if info in _CBOR_FLOATS:
+      decoder = _CBOR_FLOATS[info]
+      return decoder.unpack_from(data, pos)[0], pos + decoder.size
+    if info in _CBOR_SIMPLE:
+      return _CBOR_SIMPLE[info], pos
+    raise ValueError('Unsupported CBOR simple value %d' % info)
+  if info < 24:
+    length = info
+  elif info <= 27:
+    size = 1 << (info - 24)
+    length = _UINT[size].unpack_from(data, pos)[0]
+    pos += size
+  else:
+    raise ValueError('Unsupported CBOR length %d' % info)
+
+  if major == 0:
+    return length, pos
+  if major == 1:
+    return -1 - length, pos
+  if major == 2 or major == 3:
+    end = pos + length
+    if end > len(data):
+      raise IndexError(end)
+    value = data[pos:end]
+    return value if major == 2 else value.decode('utf-8'), end
+  if major == 4:
+    value = []
+    for _ in range(length):
+      element, pos = _LoadCbor(data, pos)
+      value.append(element)
+    return value, pos
+  if major == 5:
+    value = {}
+    for _ in range(length):
+      key, pos = _LoadCbor(data, pos)
+      value[key], pos = _LoadCbor(data, pos)
+    return value, pos
+  # A tag, the value it's on is all that matters here.
+  return _LoadCbor(data, pos)
+
+
+def _CborHalf(half):
+  """The value of an IEEE 754 half-precision float, from its 16 bits."""
+  exponent, mantissa = (half >> 10) & 0x1f, half & 0x3ff
+  if exponent == 0:
+    value = math.ldexp(mantissa, -24)
+  elif exponent == 0x1f:
+    value = float('nan') if mantissa else float('inf')
+  else:
+    value = math.ldexp(mantissa + 1024, exponent - 25)
+  return -value if half & 0x8000 else value
+
+
+def _Identity(value):
+  return value
+
+
+def EncodeVoid(value):
+  """Void values where None means missing, as in positional layouts."""
+  return True
+
+
+def DecodeVoid(tree):
+  return None
+
+
+def _EncodeBase64(value):
+  return base64.b64encode(value).decode('ascii')
+
+
+def _DecodeBase64(value):
+  return base64.b64decode(value)
+
+
+def _InterfaceEncoder(interface):
+  def Unencodable(value):
+    raise TypeError('Cannot encode %s, interfaces have to go through the '
+                    'backend.' % interface.__name__)
+  return Unencodable
+
+
+def _IsSubclass(type, base):
+  return inspect.isclass(type) and issubclass(type, base)
+
+
+def _IsStruct(type):
+  return isinstance(type, cara.StructMeta)
+
+
+def _IsData(type):
+  return type is cara.Data
+
+
+def _IsUnencodable(type):
+  return type is cara.AnyPointer or not (
+      isinstance(type, cara.StructMeta) or _IsSubclass(
+          type, (cara.BaseList, cara.BaseEnum, cara.BuiltinType)))
+
+
+def _Reaches(type, predicate, memo=None):
+  """Whether type, or any type in its fields or elements, matches predicate."""
+  if predicate(type):
+    return True
+  memo = set() if memo is None else memo
+  if type in memo:
+    return False
+  memo.add(type)
+  if isinstance(type, cara.StructMeta):
+    return any(_Reaches(field.type, predicate, memo)
+               for field in type.__id_fields__)
+  if _IsSubclass(type, cara.BaseList):
+    return _Reaches(type.sub_type, predicate, memo)
+  return False
+
+
+def Encodable(type):
+  """Whether codecs can encode values of type.
+
+  Interfaces have to be exported by a backend, and AnyPointers (or templates
+  that weren't filled in) could be anything.
+  """
+  return not _Reaches(type, _IsUnencodable)
+
+
+def RegisterCodec(codec):
+  """Adds a Codec instance, so it can be negotiated by its name."""
+  codecs[codec.name] = codec
+  return codec
+
+
+def GetCodec(name):
+  codec = codecs.get(name)
+  if codec is None:
+    raise LookupError('No codec named %s' % name)
+  return codec
+
+
+def Negotiate(offered, supported=None):
+  """The first of the offered codec names that's registered and supported.
+
+  Args:
+    offered: Codec names, in the order the other side prefers them.
+    supported: The codec names this side accepts, or None for all of them.
+  Returns: The name of the codec to use, or None if there isn't one.
+  """
+  for name in offered or ():
+    if name in codecs and (supported is None or name in supported):
+      return name
+  return None
+
+
+if msgpack is not None:
+  RegisterCodec(MsgpackCodec())
+  RegisterCodec(PositionalMsgpackCodec())
+RegisterCodec(CborCodec())
+RegisterCodec(JsonCodec())
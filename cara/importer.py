@@ -0,0 +1,230 @@
+"""Importing .capnp files directly, compiling them when they change.
+
+  from cara import importer
+  importer.Install()
+
+  from people import people_capnp  # Compiles people/people.capnp.
+
+Once installed, importing a foo_capnp module that has no foo_capnp.py finds
+foo.capnp in the same place instead, and compiles it with capnpc-cara. The
+generated module is kept in a cache keyed by the hash of the file, of every
+file it imports and of the generator, so later imports only compile it again
+after one of them changed.
+
+To compile every schema in directories ahead of time, with a process per CPU:
+
+  python -m cara.importer people/ orders/
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import importlib.abc
+import importlib.util
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+CARA_DIR = os.path.dirname(os.path.abspath(__file__))
+# Where capnp finds /capnp/c++.capnp and the like, and cara's /capnp/cara.capnp.
+IMPORT_PATH = (CARA_DIR, '/usr/local/include', '/usr/include')
+
+_IMPORT_RE = re.compile(rb'\b(?:import|embed)\s+"([^"]+)"')
+
+
+def ModuleName(filename):
+  """The module capnpc-cara generates for filename, like foo_capnp."""
+  name = re.sub(r'[^A-Za-z0-9_]', lambda match: (
+      'x' if match.group() == '+' else '_'), os.path.basename(filename))
+  if not re.match(r'[A-Za-z]', name):
+    name = 'V' + name
+  return name
+
+
+def DefaultCacheDir():
+  return os.environ.get('CARA_CACHE_DIR') or os.path.join(
+      os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+      'cara')
+
+
+def DefaultGenerator():
+  # In a checkout, setup.py build_generator builds it in gen/.
+  return os.environ.get('CARA_GENERATOR') or shutil.which('capnpc-cara') or (
+      os.path.join(os.path.dirname(CARA_DIR), 'gen', 'capnpc-cara'))
+
+
+class Compiler(object):
+  """Compiles .capnp files into a cache of generated modules.
+
+  Args:
+    cache_dir: Where to keep the generated modules, CARA_CACHE_DIR or
+      ~/.cache/cara by default.
+    generator: The capnpc-cara to compile with, CARA_GENERATOR, the one on
+      PATH or the one built in the checkout by default.
+    import_path: Directories to look for absolute imports in.
+  """
+
+  def __init__(self, cache_dir=None, generator=None, import_path=IMPORT_PATH):
+    self.cache_dir = cache_dir or DefaultCacheDir()
+    self.generator = generator or DefaultGenerator()
+    self.import_path = tuple(import_path)
+
+  def Key(self, filename):
+    """Hash of filename, everything it imports and the generator."""
+    digest = hashlib.sha256()
+    for option in ('CARA_LAZY_MODULES', 'CARA_SPECIALIZED_STRUCTS'):
+      digest.update(os.environ.get(option, '').encode() + b'\0')
+    if os.path.exists(self.generator):
+      digest.update(_Read(self.generator))
+    seen = set()
+    pending = [os.path.abspath(filename)]
+    while pending:
+      filename = pending.pop()
+      if filename in seen:
+        continue
+      seen.add(filename)
+      contents = _Read(filename)
+      digest.update(filename.encode() + b'\0' + contents)
+      if filename.endswith('.capnp'):
+        pending.extend(
+            self._Resolve(filename, imported.decode())
+            for imported in _IMPORT_RE.findall(contents))
+    return digest.hexdigest()
+
+  def _Resolve(self, importer, imported):
+    if not imported.startswith('/'):
+      return os.path.join(os.path.dirname(importer), imported)
+    for directory in self.import_path:
+      filename = os.path.join(directory, imported[1:])
+      if os.path.exists(filename):
+        return filename
+    raise ImportError('%s imports %s, which is not in any of %s' % (
+        importer, imported, ', '.join(self.import_path)))
+
+  def Compile(self, filename):
+    """Returns the generated module for filename, compiling it if needed."""
+    output = os.path.join(
+        self.cache_dir, self.Key(filename), ModuleName(filename) + '.py')
+    if os.path.exists(output):
+      return output
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    # Compiled in a directory of its own and moved into place, so other
+    # processes compiling it too never see half of it.
+    with tempfile.TemporaryDirectory(dir=self.cache_dir) as tmpdir:
+      command = [
+          'capnp', 'compile', '-o', '%s:%s' % (self.generator, tmpdir),
+          '--src-prefix', os.path.dirname(filename) or '.']
+      for directory in self.import_path:
+        if os.path.isdir(directory):
+          command.extend(['-I', directory])
+      command.append(filename)
+      process = subprocess.run(
+          command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+      if process.returncode:
+        raise ImportError('Compiling %s failed:\n%s' % (
+            filename, process.stdout.decode(errors='replace')),
+                          path=filename)
+      os.replace(os.path.join(tmpdir, os.path.basename(output)), output)
+    return output
+
+  def CompileAll(self, directories, jobs=None):
+    """Compiles every .capnp file in directories, in a pool of processes.
+
+    Returns:
+      The generated module of each file, by file.
+    """
+    filenames = sorted(
+        os.path.join(directory, filename)
+        for directory in directories
+        for filename in os.listdir(directory)
+        if filename.endswith('.capnp'))
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+      return dict(zip(filenames, executor.map(self.Compile, filenames)))
+
+
+class Finder(importlib.abc.MetaPathFinder):
+  """Finds foo_capnp modules as foo.capnp files, see Install."""
+
+  def __init__(self, compiler):
+    self.compiler = compiler
+
+  def find_spec(self, name, path, target=None):
+    parent, _, name_part = name.rpartition('.')
+    if not name_part.endswith('_capnp'):
+      return None
+    if path is None:
+      path = sys.path
+    if parent == 'cara.capnp':
+      # Where /capnp/schema.capnp and friends are, for their generated modules.
+      path = list(path) + [
+          os.path.join(directory, 'capnp')
+          for directory in self.compiler.import_path]
+    for directory in path:
+      filename = self._Find(directory or '.', name_part)
+      if filename is not None:
+        break
+    else:
+      return None
+    return importlib.util.spec_from_file_location(
+        name, self.compiler.Compile(filename))
+
+  @staticmethod
+  def _Find(directory, module_name):
+    try:
+      filenames = os.listdir(directory)
+    except OSError:
+      return None
+    for filename in filenames:
+      if filename.endswith('.capnp') and ModuleName(filename) == module_name:
+        return os.path.join(directory, filename)
+    return None
+
+
+def Install(cache_dir=None, generator=None, import_path=IMPORT_PATH):
+  """Makes importing foo_capnp compile foo.capnp if there's no foo_capnp.py.
+
+  The arguments are Compiler's.
+
+  Returns:
+    The Finder added to sys.meta_path, after the usual ones.
+  """
+  finder = Finder(Compiler(cache_dir, generator, import_path))
+  sys.meta_path.append(finder)
+  return finder
+
+
+def _Read(filename):
+  with open(filename, 'rb') as file:
+    return file.read()
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+      prog='python -m cara.importer',
+      description='Compiles the .capnp files in directories into the cache.')
+  parser.add_argument('directories', nargs='+')
+  parser.add_argument('--cache-dir', help='Defaults to CARA_CACHE_DIR or '
+                      '~/.cache/cara.')
+  parser.add_argument('--generator', help='capnpc-cara to compile with.')
+  parser.add_argument('-I', '--import-path', action='append',
+                      help='Directory to look for absolute imports in, may be '
+                      'given several times.')
+  parser.add_argument('-j', '--jobs', type=int,
+                      help='Processes to compile in, one per CPU by default.')
+  args = parser.parse_args(argv)
+  compiler = Compiler(args.cache_dir, args.generator,
+                      (args.import_path or []) + list(IMPORT_PATH))
+  try:
+    outputs = compiler.CompileAll(args.directories, args.jobs)
+  except ImportError as e:
+    print(e, file=sys.stderr)
+    return 1
+  for filename, output in outputs.items():
+    print('%s -> %s' % (filename, output))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,171 @@
+"""Per-method call counts and latencies, to see where the time of a call goes.
+
+Disabled until Enable is called, which leaves one global lookup per call:
+
+  instrumentation.Enable()
+  ...
+  instrumentation.Snapshot()[('Calculator', 'add')]['handler']
+  # {'count': 120, 'errors': 0, 'total': 0.0031, 'mean': 2.6e-05,
+  #  'p50': 3.2e-05, 'p99': 6.4e-05, 'buckets': {32: 97, 64: 23}}
+
+Each (interface, method) has a Histogram per phase of a call:
+
+  params: Converting the parameters with _ConvertToType.
+  handler: Running the implementation, until its awaitable is done if it
+    returns one.
+  results: Converting the result.
+  call: All of RemoteInterfaceServer.call, so the three above plus finding
+    the method, until the handler returns or returns an awaitable.
+
+Whatever the caller waited on top of those was the transport and the backend.
+
+Counters are plain ints bumped under the GIL, without a lock, so threads
+calling the same method at once may very rarely lose a count.
+
+Exporters are called with a Snapshot by Export, for sending them elsewhere:
+
+  instrumentation.AddExporter(instrumentation.LoggingExporter())
+  instrumentation.Export(reset=True)
+"""
+import logging
+
+# The Recorder calls are reported to, or None when disabled.
+recorder = None
+# Callables that Export passes snapshots to.
+exporters = []
+
+# Histogram buckets are powers of two in microseconds, this many of them.
+_BUCKETS = 40
+
+
+class Histogram(object):
+  """Counts of durations, in buckets doubling from a microsecond up.
+
+  Attributes:
+    count: Durations added.
+    errors: How many of them ended in an exception.
+    total: Their sum, in seconds.
+    buckets: Counts by bucket index. Bucket i holds durations below 2**i
+      microseconds, and at least half of that.
+  """
+  __slots__ = ('count', 'errors', 'total', 'buckets')
+
+  def __init__(self):
+    self.count = 0
+    self.errors = 0
+    self.total = 0.0
+    self.buckets = [0] * (_BUCKETS + 1)
+
+  def Add(self, seconds, error=False):
+    self.count += 1
+    self.total += seconds
+    if error:
+      self.errors += 1
+    self.buckets[min(int(seconds * 1e6).bit_length(), _BUCKETS)] += 1
+
+  def Percentile(self, percent):
+    """The upper bound in seconds of the bucket the percentile falls in."""
+    if not self.count:
+      return 0.0
+    rank = self.count * percent / 100.0
+    seen = 0
+    for index, count in enumerate(self.buckets):
+      seen += count
+      if seen >= rank:
+        break
+    return (1 << index) / 1e6
+
+  def ToDict(self):
+    return {
+        'count': self.count,
+        'errors': self.errors,
+        'total': self.total,
+        'mean': self.total / self.count if self.count else 0.0,
+        'p50': self.Percentile(50),
+        'p99': self.Percentile(99),
+        # Keyed by the bucket's upper bound in microseconds.
+        'buckets': {1 << index: count
+                    for index, count in enumerate(self.buckets) if count},
+    }
+
+
+class Recorder(object):
+  """Accumulates the durations of each phase of each method's calls.
+
+  Subclass it and pass it to Enable to send them somewhere else as they
+  happen instead.
+
+  Attributes:
+    methods: {(interface name, method name): {phase: Histogram}}.
+  """
+
+  def __init__(self):
+    self.methods = {}
+
+  def Record(self, key, phase, seconds, error=False):
+    phases = self.methods.get(key)
+    if phases is None:
+      phases = self.methods.setdefault(key, {})
+    histogram = phases.get(phase)
+    if histogram is None:
+      histogram = phases.setdefault(phase, Histogram())
+    histogram.Add(seconds, error)
+
+  def Snapshot(self):
+    return {key: {phase: histogram.ToDict()
+                  for phase, histogram in list(phases.items())}
+            for key, phases in list(self.methods.items())}
+
+  def Reset(self):
+    self.methods = {}
+
+
+def Enable(new_recorder=None):
+  """Starts reporting calls to a Recorder, a new one by default."""
+  global recorder
+  recorder = new_recorder if new_recorder is not None else Recorder()
+  return recorder
+
+
+def Disable():
+  global recorder
+  recorder = None
+
+
+def Snapshot():
+  """Every method's phases as dicts, see Histogram.ToDict."""
+  if recorder is None:
+    return {}
+  return recorder.Snapshot()
+
+
+def AddExporter(exporter):
+  """Adds a callable for Export to pass snapshots to."""
+  exporters.append(exporter)
+  return exporter
+
+
+def Export(reset=False):
+  """Passes a Snapshot to every exporter, then resets the counts if asked."""
+  snapshot = Snapshot()
+  for exporter in exporters:
+    exporter(snapshot)
+  if reset and recorder is not None:
+    recorder.Reset()
+  return snapshot
+
+
+class LoggingExporter(object):
+  """Logs a line for each phase of each method that was called."""
+
+  def __init__(self, logger=None, level=logging.INFO):
+    self.logger = logger or logging.getLogger(__name__)
+    self.level = level
+
+  def __call__(self, snapshot):
+    for (interface, method), phases in sorted(snapshot.items()):
+      for phase, stats in sorted(phases.items()):
+        self.logger.log(
+            self.level, '%s.%s %s: %d calls, %d errors, mean %.6fs, '
+            'p50 %.6fs, p99 %.6fs', interface, method, phase, stats['count'],
+            stats['errors'], stats['mean'], stats['p50'], stats['p99'])
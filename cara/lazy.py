@@ -0,0 +1,90 @@
+"""Generated modules that only declare everything when they're first used.
+
+capnpc-cara generates these when CARA_LAZY_MODULES=1 is set:
+
+  from cara import cara
+  from cara import lazy
+
+
+  def _load():
+    from cara.capnp import cara_capnp
+    Basic = cara.Struct(name="Basic", id=0xf950b63201d11192, ...)
+    Basic.FinishDeclaration(...)
+    return locals()
+
+
+  __all__ = ["Basic"]
+  lazy.Module(
+      __name__, _load, registered=[0xf950b63201d11192])
+
+Importing one costs next to nothing. The first time any of its attributes is
+used, _load runs, importing the schemas it imports and declaring and
+finishing everything, and what it declared becomes the module's attributes
+from then on. __all__ names its top-level declarations up front, so
+importing * from it loads it too. The declarations registered with
+$Cara.registerGlobally are deferred in cara.GlobalTypeRegistry, so looking
+one up loads its module.
+"""
+import sys
+import threading
+import types
+
+from cara import cara
+
+
+def Module(name, load, registered=()):
+  """Makes the module called name run load on first use.
+
+  Args:
+    name: The module's __name__.
+    load: A function declaring everything in the module and returning its
+      locals.
+    registered: The ids load adds to cara.GlobalTypeRegistry.
+  """
+  module = sys.modules[name]
+  module.__lazy__ = _Loader(module, load)
+  module.__class__ = _LazyModule
+  for id in registered:
+    cara.GlobalTypeRegistry.Defer(id, module.__lazy__)
+
+
+class _LazyModule(types.ModuleType):
+  """A module whose attributes are only declared once one's looked up."""
+
+  def __getattr__(self, attr):
+    # Dunder lookups, by import machinery and the like, don't load it, but the
+    # file's annotations are in it.
+    if attr == '__annotations__' or not attr.startswith('__'):
+      namespace = vars(self)
+      namespace['__lazy__']()
+      if attr in namespace:
+        return namespace[attr]
+    raise AttributeError('module %r has no attribute %r' % (
+        self.__name__, attr))
+
+  def __dir__(self):
+    self.__lazy__()
+    return sorted(vars(self))
+
+
+class _Loader(object):
+  """Runs a lazy module's load once, adding what it returns to the module."""
+
+  def __init__(self, module, load):
+    self.module = module
+    self.load = load
+    self.lock = threading.RLock()
+    self.loaded = False
+    self.loading = False
+
+  def __call__(self):
+    with self.lock:
+      if self.loaded or self.loading:
+        # Loaded by another thread, or a circular import while loading.
+        return
+      self.loading = True
+      try:
+        vars(self.module).update(self.load())
+        self.loaded = True
+      finally:
+        self.loading = False
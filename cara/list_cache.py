@@ -1,11 +1,17 @@
 import mutablerecords
 
+from cara import locks
+
+_locks = locks.Striped()
+
 
 class ListCache(mutablerecords.Record('ListCache', [],
                                       {'keys': list, 'values': list})):
   def __setitem__(self, key, value, key_idx=None):
-    self.keys.append(key)
-    self.values.append(value)
+    with _locks.For(self):
+      # The value first, so readers that find the key find its value too.
+      self.values.append(value)
+      self.keys.append(key)
 
   def __contains__(self, key):
     return key in self.keys
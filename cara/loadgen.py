@@ -0,0 +1,393 @@
+"""Drives a cara service with calls to one method, reporting latency.
+
+  python -m cara.loadgen addressbook_capnp AddressBook.find \\
+      --connect tcp://127.0.0.1:5000 --clients 16 --duration 30
+
+loads the generated module, and has 16 clients call find on the interface
+their server registered under AddressBook's id (see
+RemoteInterfaceClient.Bootstrap) for 30 seconds, each as soon as its last
+call finished. Parameters are made up from the schema, or taken in turn from
+--params, JSON objects of parameters by name. Then it reports throughput and
+latency percentiles, or --json prints them as JSON. --backend pseud drives a
+cara_pseud server instead.
+
+Without a module, it measures cara on its own with an echo service, served
+in-process over cara_loopback (or over cara_asyncio with --echo-endpoint):
+
+  python -m cara.loadgen --clients 4 --requests 100000
+
+and --serve-echo ENDPOINT serves the echo service for loadgen elsewhere.
+"""
+import argparse
+import asyncio
+import importlib
+import inspect
+import json
+import sys
+import time
+
+from cara import cara
+from cara import cara_asyncio
+from cara import cara_loopback
+
+# The echo service, declared like capnpc-cara would generate it for:
+#
+#   struct EchoMessage {
+#     id @0 :UInt64;
+#     text @1 :Text;
+#     payload @2 :Data;
+#     values @3 :List(Int64);
+#   }
+#
+#   interface Echo {
+#     echo @0 (message :EchoMessage) -> (message :EchoMessage);
+#   }
+EchoMessage = cara.Struct(
+    name='EchoMessage', id=0xd4e1c8a7f2b63905, qualname='loadgen.EchoMessage')
+Echo = cara.Interface(
+    name='Echo', id=0xe8b3f5d2a1c74906, qualname='loadgen.Echo')
+EchoMessage.FinishDeclaration(fields=[
+    cara.Field(id=0, name='id', type=cara.Uint64),
+    cara.Field(id=1, name='text', type=cara.Text),
+    cara.Field(id=2, name='payload', type=cara.Data),
+    cara.Field(id=3, name='values', type=cara.List(cara.Int64)),
+])
+Echo.FinishDeclaration(superclasses=[], methods=[
+    cara.Method(id=0, name='echo',
+                params=[cara.Param(id=0, name='message', type=EchoMessage)],
+                results=[cara.Param(id=0, name='message', type=EchoMessage)]),
+])
+
+# Percentiles in the report.
+PERCENTILES = (50, 95, 99, 99.9)
+
+# What Synthesize makes up for builtin types, by name.
+_BUILTIN_VALUES = {
+    'Int8': 1, 'Int16': 1, 'Int32': 1, 'Int64': 1, 'Uint8': 1, 'Uint16': 1,
+    'Uint32': 1, 'Uint64': 1, 'Float32': 0.5, 'Float64': 0.5,
+    'Text': 'loadgen', 'Data': b'loadgen', 'Bool': True, 'Void': None,
+    'AnyPointer': None,
+}
+
+
+def Synthesize(type, list_size=3, depth=3):
+  """A value of type, to send when no samples are given.
+
+  Structs get every field (and the first of each union), lists get list_size
+  elements, and nesting stops at depth. Interfaces are left out.
+  """
+  if not inspect.isclass(type):
+    return None
+  if issubclass(type, cara.BaseEnum):
+    return next(iter(type))
+  if issubclass(type, cara.BuiltinType):
+    return _BUILTIN_VALUES[type.__name__]
+  if depth <= 0:
+    return None
+  if issubclass(type, cara.BaseList):
+    elements = [Synthesize(type.sub_type, list_size, depth - 1)
+                for _ in range(list_size)]
+    return [element for element in elements if element is not None]
+  if issubclass(type, cara.BaseStruct):
+    value = {}
+    in_union = False
+    for field in type.__id_fields__:
+      if field.id in type.__union_fields__:
+        if in_union:
+          continue
+        in_union = True
+      field_value = Synthesize(field.type, list_size, depth - 1)
+      # None is also what Void values are.
+      if field_value is not None or field.type is cara.Void:
+        value[field.name] = field_value
+    return value
+  # Interfaces and anything else.
+  return None
+
+
+def SynthesizeParams(method, list_size=3):
+  """Keyword arguments for a call to method."""
+  if isinstance(method.params, list):
+    params = {}
+    for param in method.params:
+      value = Synthesize(param.type, list_size)
+      if value is not None:
+        params[param.name] = value
+    return params
+  # A struct as the parameters, its fields are the arguments.
+  return Synthesize(method.params, list_size)
+
+
+def FindMethod(module, name):
+  """(interface, method name) for 'Interface.method', nested interfaces too."""
+  path, _, method_name = name.rpartition('.')
+  if not path:
+    raise ValueError('%s should be Interface.method' % name)
+  interface = module
+  for part in path.split('.'):
+    interface = getattr(interface, part)
+  if interface._get_method(method_name)[1] is None:
+    raise ValueError('%s has no method %s' % (path, method_name))
+  return interface, method_name
+
+
+def Percentile(latencies, percent):
+  """Nearest-rank percentile of already sorted latencies."""
+  if not latencies:
+    return 0.0
+  rank = max(1, int(len(latencies) * percent / 100.0 + 0.5))
+  return latencies[min(rank, len(latencies)) - 1]
+
+
+class Stats(object):
+  """Latencies of the calls made, and how many failed."""
+
+  def __init__(self):
+    self.latencies = []
+    self.errors = 0
+    self.error_types = {}
+    self.start = self.end = None
+
+  def Error(self, error):
+    self.errors += 1
+    name = type(error).__name__
+    self.error_types[name] = self.error_types.get(name, 0) + 1
+
+  def Report(self):
+    latencies = sorted(self.latencies)
+    duration = (self.end or time.perf_counter()) - self.start
+    report = {
+        'requests': len(latencies) + self.errors,
+        'errors': self.errors,
+        'error_types': self.error_types,
+        'duration': duration,
+        'throughput': len(latencies) / duration if duration else 0.0,
+        'mean': sum(latencies) / len(latencies) if latencies else 0.0,
+        'max': latencies[-1] if latencies else 0.0,
+    }
+    for percent in PERCENTILES:
+      report['p%s' % str(percent).replace('.', '')] = Percentile(
+          latencies, percent)
+    return report
+
+
+async def Drive(calls, clients, duration=None, requests=None):
+  """Has clients call in a loop until duration seconds or requests calls.
+
+  Args:
+    calls: A function per client, returning an awaitable per call. Each is
+      called with the index of the call.
+    clients: How many calls are outstanding at once.
+    duration: Seconds to run for.
+    requests: Calls to make, over all the clients.
+  Returns:
+    The Stats of the calls.
+  """
+  stats = Stats()
+  counter = iter(range(requests)) if requests is not None else None
+
+  async def Client(call):
+    while True:
+      if counter is not None:
+        index = next(counter, None)
+        if index is None:
+          return
+      else:
+        index = len(stats.latencies) + stats.errors
+      if deadline is not None and time.perf_counter() >= deadline:
+        return
+      start = time.perf_counter()
+      try:
+        await call(index)
+      except Exception as e:
+        stats.Error(e)
+      else:
+        stats.latencies.append(time.perf_counter() - start)
+
+  stats.start = time.perf_counter()
+  deadline = stats.start + duration if duration is not None else None
+  await asyncio.gather(*[Client(calls[i % len(calls)])
+                         for i in range(clients)])
+  stats.end = time.perf_counter()
+  return stats
+
+
+def _Caller(interface, method_name, client, by_name, samples):
+  if by_name:
+    iface = interface(client)
+  else:
+    iface = _Backend(client).RemoteInterfaceClient.Bootstrap(
+        interface, client)
+  method = getattr(iface, method_name)
+
+  def Call(index):
+    return method(**samples[index % len(samples)])
+  return Call
+
+
+async def _StartEcho(endpoint=None):
+  """Serves Echo over loopback, or cara_asyncio if endpoint is given."""
+  if endpoint is None:
+    server = cara_loopback.setup_server(cara_loopback.Server())
+    server.bind('loadgen-echo')
+  else:
+    server = cara_asyncio.setup_server(cara_asyncio.Server())
+    server.bind(endpoint)
+  await server.start()
+  cara_asyncio.register_interface(
+      server, Echo, {'echo': lambda message: message})
+  return server
+
+
+async def _Connect(backend, endpoint, identity):
+  if backend == 'pseud':
+    import pseud
+    from cara import cara_pseud
+    # As in docs/remote.md, the server has to trust the user_id.
+    client = pseud.Client(identity.encode(), security_plugin='plain',
+                          user_id=b'loadgen', password=b'_')
+    client.connect(endpoint)
+    client = cara_pseud.setup_client(client)
+  elif backend == 'loopback':
+    client = cara_loopback.setup_client(cara_loopback.Client())
+    client.connect(endpoint)
+  else:
+    client = cara_asyncio.setup_client(cara_asyncio.Client())
+    client.connect(endpoint)
+  await client.start()
+  return client
+
+
+def _Backend(client):
+  """The cara module for a client from _Connect."""
+  if isinstance(client, cara_asyncio.Client):
+    return cara_asyncio
+  from cara import cara_pseud
+  return cara_pseud
+
+
+async def Run(args):
+  server = None
+  if args.module:
+    module = importlib.import_module(args.module)
+    interface, method_name = FindMethod(module, args.method)
+    backend, endpoint = args.backend, args.connect
+  else:
+    interface, method_name = Echo, 'echo'
+    server = await _StartEcho(args.echo_endpoint)
+    if args.echo_endpoint:
+      backend, endpoint = 'asyncio', args.echo_endpoint
+    else:
+      backend, endpoint = 'loopback', 'loadgen-echo'
+
+  if args.params:
+    samples = [json.loads(params) for params in args.params]
+  else:
+    _, method = interface._get_method(method_name)
+    samples = [SynthesizeParams(method, args.list_size)]
+
+  clients = []
+  try:
+    for _ in range(args.connections or args.clients):
+      clients.append(await _Connect(backend, endpoint, args.identity))
+    calls = [_Caller(interface, method_name, client, args.by_name, samples)
+             for client in clients]
+    if args.warmup:
+      await Drive(calls, args.clients, duration=args.warmup)
+    return await Drive(calls, args.clients, args.duration, args.requests)
+  finally:
+    for client in clients:
+      client.close()
+    if server is not None:
+      server.close()
+
+
+def FormatReport(report):
+  lines = [
+      'requests:   %d (%d errors)' % (report['requests'], report['errors']),
+      'duration:   %.3fs' % report['duration'],
+      'throughput: %.1f calls/s' % report['throughput'],
+      'latency:    mean %.3fms, max %.3fms' % (
+          report['mean'] * 1e3, report['max'] * 1e3),
+  ]
+  for percent in PERCENTILES:
+    key = 'p%s' % str(percent).replace('.', '')
+    lines.append('  %-8s %.3fms' % (key, report[key] * 1e3))
+  for name, count in sorted(report['error_types'].items()):
+    lines.append('error %s: %d' % (name, count))
+  return '\n'.join(lines)
+
+
+def ParseArgs(argv=None):
+  parser = argparse.ArgumentParser(
+      prog='python -m cara.loadgen', description=__doc__.splitlines()[0])
+  parser.add_argument('module', nargs='?',
+                      help='Generated module, like addressbook_capnp.')
+  parser.add_argument('method', nargs='?', help='Interface.method to call.')
+  parser.add_argument('--connect', help='Endpoint of the server.')
+  parser.add_argument('--backend', choices=('asyncio', 'pseud', 'loopback'),
+                      default='asyncio')
+  parser.add_argument('--identity', default='server',
+                      help='The pseud server\'s identity, for --backend pseud.')
+  parser.add_argument('--by-name', action='store_true',
+                      help='Call the method by name instead of on the '
+                      'interface registered under its id.')
+  parser.add_argument('--clients', type=int, default=8,
+                      help='Calls outstanding at once.')
+  parser.add_argument('--connections', type=int,
+                      help='Connections to spread them over, one per client '
+                      'by default.')
+  limit = parser.add_mutually_exclusive_group()
+  limit.add_argument('--duration', type=float, help='Seconds to run for.')
+  limit.add_argument('--requests', type=int, help='Calls to make in total.')
+  parser.add_argument('--warmup', type=float, default=0,
+                      help='Seconds to run for before measuring.')
+  parser.add_argument('--params', action='append',
+                      help='JSON object of parameters by name, may be given '
+                      'several times to rotate through them.')
+  parser.add_argument('--list-size', type=int, default=3,
+                      help='Elements in made up lists.')
+  parser.add_argument('--echo-endpoint',
+                      help='Serve the echo service over cara_asyncio here '
+                      'instead of loopback.')
+  parser.add_argument('--serve-echo', metavar='ENDPOINT',
+                      help='Only serve the echo service, until interrupted.')
+  parser.add_argument('--json', action='store_true',
+                      help='Print the report as JSON.')
+  args = parser.parse_args(argv)
+  if args.serve_echo:
+    return args
+  if args.module and not args.method:
+    parser.error('method is needed with a module')
+  if args.module and not args.connect:
+    parser.error('--connect is needed with a module')
+  if args.duration is None and args.requests is None:
+    args.duration = 10
+  return args
+
+
+def main(argv=None):
+  args = ParseArgs(argv)
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+  try:
+    if args.serve_echo:
+      loop.run_until_complete(_StartEcho(args.serve_echo))
+      try:
+        loop.run_forever()
+      except KeyboardInterrupt:
+        pass
+      return 0
+    report = loop.run_until_complete(Run(args)).Report()
+    loop.run_until_complete(asyncio.sleep(0))
+  finally:
+    loop.close()
+  if args.json:
+    print(json.dumps(report, indent=2, sort_keys=True))
+  else:
+    print(FormatReport(report))
+  return 1 if report['errors'] else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,27 @@
+"""Striped locks, for caches that are read without locking.
+
+cara's caches of declarations are read far more than they're added to, so
+reads never lock, and adding to one takes a lock picked by what's being added,
+so unrelated additions don't wait for each other:
+
+  _locks = locks.Striped()
+
+  value = cache.get(key)
+  if value is None:
+    with _locks.For(key):
+      ...  # Check again, then make the value and publish it.
+
+Whatever is published must be finished first, since readers don't wait.
+"""
+import threading
+
+
+class Striped(object):
+  """A fixed number of locks, one for each object by its identity."""
+
+  def __init__(self, stripes=32):
+    self._locks = tuple(threading.Lock() for _ in range(stripes))
+
+  def For(self, obj):
+    # Objects are aligned, so the low bits of their ids are all the same.
+    return self._locks[(id(obj) >> 4) % len(self._locks)]
@@ -0,0 +1,107 @@
+"""Where conversion time goes, by the type values are converted to.
+
+_ConvertToType is behind every struct field, list element, parameter and
+result, so profiles of cara show it (and the BaseStruct and BaseList
+constructors it calls) as one flat hot spot. A ConversionProfile breaks it
+down by target type while it's active:
+
+  with profiling.ConversionProfile() as profile:
+    ...
+  print(profile.Report(limit=10))
+
+  type                          conversions  allocated   total (s)     own (s)
+  addressbook_capnp.Person            20000      20000    0.412003    0.161250
+  List[Person]                          200        200    0.450117    0.038114
+  ...
+
+total includes converting the fields or elements inside each value, own
+doesn't, so own points at the types worth restructuring. allocated counts the
+conversions that made a new object instead of passing the value through.
+
+Conversions are only intercepted inside the with block, so there's no cost
+outside of it. Only one profile can be active at a time.
+"""
+import collections
+import threading
+import time
+
+from cara import cara
+import mutablerecords
+
+# The real _ConvertToType, for profiles to call through to.
+_convert = cara._ConvertToType
+
+
+class TypeStats(mutablerecords.Record(
+        'TypeStats', [], {'conversions': 0, 'allocated': 0, 'total': 0.0,
+                          'own': 0.0})):
+  """Conversions to one type.
+
+  Attributes:
+    conversions: Values converted to it.
+    allocated: How many of those made a new object.
+    total: Seconds spent converting, including nested conversions.
+    own: Seconds spent converting, excluding nested conversions.
+  """
+
+
+class ConversionProfile(object):
+  """Attributes conversion counts and times to each target type.
+
+  Attributes:
+    stats: TypeStats by type.
+  """
+
+  def __init__(self):
+    self.stats = collections.defaultdict(TypeStats)
+    # Time spent in nested conversions, a stack per thread.
+    self._local = threading.local()
+
+  def __enter__(self):
+    if cara._ConvertToType is not _convert:
+      raise RuntimeError('Conversions are already being profiled.')
+    cara._ConvertToType = self._Convert
+    return self
+
+  def __exit__(self, *exc_info):
+    cara._ConvertToType = _convert
+
+  def _Convert(self, type, value):
+    nested = getattr(self._local, 'nested', None)
+    if nested is None:
+      nested = self._local.nested = []
+    nested.append(0.0)
+    start = time.perf_counter()
+    try:
+      result = _convert(type, value)
+    finally:
+      elapsed = time.perf_counter() - start
+      inner = nested.pop()
+      if nested:
+        nested[-1] += elapsed
+      stats = self.stats[type]
+      stats.conversions += 1
+      stats.total += elapsed
+      stats.own += elapsed - inner
+    if result is not value:
+      stats.allocated += 1
+    return result
+
+  def Sorted(self, key='own'):
+    """(type, TypeStats) pairs, most of key (a TypeStats attribute) first."""
+    return sorted(self.stats.items(),
+                  key=lambda item: getattr(item[1], key), reverse=True)
+
+  def Report(self, key='own', limit=None):
+    """A table of the types converted to, most of key first."""
+    lines = ['%-40s %11s %10s %11s %11s' % (
+        'type', 'conversions', 'allocated', 'total (s)', 'own (s)')]
+    for type, stats in self.Sorted(key)[:limit]:
+      lines.append('%-40s %11d %10d %11.6f %11.6f' % (
+          _TypeName(type), stats.conversions, stats.allocated, stats.total,
+          stats.own))
+    return '\n'.join(lines)
+
+
+def _TypeName(type):
+  return getattr(type, '__qualname__', None) or repr(type)
@@ -0,0 +1,1340 @@
+"""Backend independent pieces for using interfaces over the wire.
+
+A backend gives cara a client object for each peer. Calling
+client.call(remote_id, iface_id, method_id, args, kwargs) on it must end up in
+RemoteInterfaceServer.call on the other side, and interfaces must be
+translated into a remote_id with RemoteInterfaceServer.export while being
+serialized. See cara_pseud and cara_asyncio for the two backends in cara
+itself.
+
+Every export is a reference, released by the other side once the
+RemoteInterfaceClient for it is garbage collected. Exports the other side
+never releases (because it went away, for instance) can be given a ttl.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import heapq
+import inspect
+import itertools
+import random
+import threading
+import time
+import weakref
+
+from cara import cara
+from cara import codec
+from cara import generics
+from cara import instrumentation
+import mutablerecords
+
+
+class RemoteInterfaceServer(mutablerecords.Record(
+        'Wrapper', [], {'objs': dict, 'dispatch': dict, 'answers': dict,
+                        'streams': dict, 'refs': dict, 'leases': dict,
+                        'ttl': None, 'owner': None, 'codecs': None,
+                        'exported': 0, 'released': 0, 'expired': 0,
+                        'lock': threading.Lock})):
+  """The objects exported to the other side, and the calls made on them.
+
+  Attributes:
+    objs: Exported objects, by local_id.
+    dispatch: The wrapped methods of exported objects, by (local_id, iface_id,
+      method_id), so a call is a single lookup.
+    answers: Results kept for promise pipelining, by answer_id.
+    streams: Results of $Cara.stream methods still being sent, by stream_id.
+    refs: How many references to each local_id the other side holds.
+    leases: When each local_id was last exported or called, if ttl is set.
+    ttl: Seconds an export may go unused before Sweep drops it, or None to
+      keep exports until they're released.
+    owner: Tags every export id, for processes forked from the same parent
+      that would otherwise hand out the same ids. See ExportOwner.
+    codecs: Names of the codecs call_encoded accepts, or None for any that's
+      registered. See cara.codec.
+    lock: Held while exporting and dropping objects, so calls from any thread
+      can look them up without it.
+  """
+
+  def call(self, local_id, iface_id, method_id, args, kwargs):
+    if instrumentation.recorder is not None:
+      return self._TimedCall(local_id, iface_id, method_id, args, kwargs)
+    return self._Call(local_id, iface_id, method_id, args, kwargs)
+
+  def _Call(self, local_id, iface_id, method_id, args, kwargs):
+    # Only exports have leases, registered objects are never released.
+    if self.ttl is not None and local_id in self.leases:
+      self.leases[local_id] = time.monotonic()
+    method = self.dispatch.get((local_id, iface_id, method_id))
+    if method is None:
+      # Not an interface we know the methods of, so ask the object itself.
+      method = self._Object(local_id)[iface_id, method_id]
+    return method(*args, **kwargs)
+
+  def _Object(self, local_id):
+    if local_id not in self.objs and ExportOwner(local_id) != self.owner:
+      raise LookupError('Interface %d was exported by owner %s, not %s' % (
+          local_id, ExportOwner(local_id), self.owner))
+    return self.objs[local_id]
+
+  def _TimedCall(self, local_id, iface_id, method_id, args, kwargs):
+    """Times _Call as the call phase, see cara.instrumentation."""
+    start = time.perf_counter()
+    error = True
+    try:
+      result = self._Call(local_id, iface_id, method_id, args, kwargs)
+      error = False
+      return result
+    finally:
+      obj = self.objs.get(local_id)
+      recorder = instrumentation.recorder
+      if obj is not None and recorder is not None:
+        _, method = type(obj)._get_method((iface_id, method_id))
+        if method is not None:
+          recorder.Record(cara._MethodKey(type(obj), method), 'call',
+                          time.perf_counter() - start, error)
+
+  def negotiate_codec(self, offered):
+    """Picks the codec for call_encoded out of the offered names, or None."""
+    return codec.Negotiate(offered, self.codecs)
+
+  def call_encoded(self, local_id, iface_id, method_id, codec_name, params):
+    """Like call, with the params and result encoded by a codec.
+
+    Args:
+      local_id, iface_id, method_id: Like call.
+      codec_name: The codec, one that negotiate_codec would pick.
+      params: The values of the params in order, encoded with EncodeMany.
+    Returns: The encoded result, or a future of it.
+    """
+    if self.codecs is not None and codec_name not in self.codecs:
+      raise LookupError('Codec %s is not supported' % codec_name)
+    encoding = codec.GetCodec(codec_name)
+    _, method = type(self._Object(local_id))._get_method((iface_id, method_id))
+    if method is None:
+      raise LookupError('Interface %d has no method %d' % (
+          iface_id, method_id))
+    args = encoding.FromTrees(_Types(method.params), params)
+    result = self.call(local_id, iface_id, method_id, args, {})
+    if inspect.isawaitable(result):
+      return _EncodeWhenReady(encoding, method, result)
+    return _EncodeResult(encoding, method, result)
+
+  def register(self, local_id, obj):
+    """Exports obj under a known local_id, which is never released."""
+    with self.lock:
+      if local_id in self.objs:
+        self._Drop(local_id)
+      self._Add(local_id, obj)
+
+  def export(self, obj):
+    """Exports obj for one more reference from the other side.
+
+    Returns: The local_id to send, which is never reused for another object.
+    """
+    local_id = _NewExportId(self.owner)
+    with self.lock:
+      self._Add(local_id, obj)
+      self.refs[local_id] = 1
+      self.exported += 1
+      if self.ttl is not None:
+        self.leases[local_id] = time.monotonic()
+    return local_id
+
+  def release(self, local_id, count=1):
+    """The other side dropped count references to local_id."""
+    with self.lock:
+      refs = self.refs.get(local_id)
+      if refs is None:
+        return
+      if refs > count:
+        self.refs[local_id] = refs - count
+        return
+      self._Drop(local_id)
+      self.released += 1
+
+  def Sweep(self, now=None):
+    """Drops exports that went unused for longer than the ttl.
+
+    Returns: How many exports were dropped.
+    """
+    if self.ttl is None:
+      return 0
+    deadline = (time.monotonic() if now is None else now) - self.ttl
+    with self.lock:
+      # Copied first, calls update leases without the lock.
+      expired = [local_id for local_id, last_used in list(self.leases.items())
+                 if last_used < deadline]
+      for local_id in expired:
+        self._Drop(local_id)
+      self.expired += len(expired)
+    return len(expired)
+
+  def Stats(self):
+    """Counts for the export table, for monitoring its size."""
+    with self.lock:
+      references = sum(self.refs.values())
+    return {
+        'objects': len(self.objs),
+        'references': references,
+        'answers': len(self.answers),
+        'streams': len(self.streams),
+        'exported': self.exported,
+        'released': self.released,
+        'expired': self.expired,
+    }
+
+  def _Add(self, local_id, obj):
+    self.objs[local_id] = obj
+    for key, method in _Methods(obj):
+      self.dispatch[(local_id,) + key] = method
+
+  def _Drop(self, local_id):
+    obj = self.objs.pop(local_id, None)
+    for key in _MethodKeys(obj):
+      self.dispatch.pop((local_id,) + key, None)
+    self.refs.pop(local_id, None)
+    self.leases.pop(local_id, None)
+
+  def call_promised(self, answer_id, local_id, iface_id, method_id, args,
+                    kwargs):
+    """Like call, but keeps the result around for pipelined calls."""
+    return self._Answer(
+        answer_id, self.call(local_id, iface_id, method_id, args, kwargs))
+
+  def call_pipelined(self, answer_id, path, iface_id, method_id, args, kwargs,
+                     new_answer_id=None):
+    """Calls a method on part of a previous call's result.
+
+    Args:
+      answer_id: The answer_id of a call_promised or call_pipelined call that
+        hasn't been finished yet.
+      path: Field or result names to get from that call's result, ending at
+        an interface.
+      iface_id, method_id, args, kwargs: Like call.
+      new_answer_id: If given, keep the result for pipelined calls as well.
+    Returns: The method's result, or a future of it if the answer isn't ready.
+    """
+    answer = self.answers[answer_id]
+    if _IsPending(answer):
+      result = asyncio.ensure_future(self._CallWhenReady(
+          answer, path, iface_id, method_id, args, kwargs))
+    else:
+      if inspect.isawaitable(answer):
+        answer = answer.result()
+      result = _Walk(answer, path)[iface_id, method_id](*args, **kwargs)
+    if new_answer_id is not None:
+      self._Answer(new_answer_id, result)
+    return result
+
+  def finish(self, answer_id):
+    """The caller is done pipelining on the answer, so forget it."""
+    self.answers.pop(answer_id, None)
+
+  def call_stream(self, stream_id, local_id, iface_id, method_id, args,
+                  kwargs, count):
+    """Calls a $Cara.stream method, returning its first chunk.
+
+    Args:
+      stream_id: Chosen by the caller, for stream_next and stream_cancel.
+      local_id, iface_id, method_id, args, kwargs: Like call.
+      count: The most elements to send back, the caller's credit.
+    Returns: Like stream_next.
+    """
+    stream = _ServerStream(self.call(local_id, iface_id, method_id, args,
+                                     kwargs))
+    self.streams[stream_id] = stream
+    return self.stream_next(stream_id, count)
+
+  def stream_next(self, stream_id, count):
+    """Gets up to count more elements of a stream.
+
+    Returns: (elements, done), or a future of it for async generators. A chunk
+      from an async generator is cut short when it has to wait for the next
+      element, so elements aren't held back.
+    """
+    stream = self.streams[stream_id]
+    if stream.is_async:
+      result = asyncio.ensure_future(stream.NextAsync(count))
+    else:
+      try:
+        result = stream.Next(count)
+      except Exception:
+        self.streams.pop(stream_id, None)
+        raise
+    return self._StreamResult(stream_id, result)
+
+  def stream_cancel(self, stream_id):
+    """The caller stopped reading the stream before it was done."""
+    stream = self.streams.pop(stream_id, None)
+    if stream is not None:
+      stream.Close()
+
+  def _StreamResult(self, stream_id, result):
+    if not isinstance(result, asyncio.Future):
+      if result[1]:
+        self.streams.pop(stream_id, None)
+      return result
+
+    def Done(future):
+      if future.cancelled() or future.exception() or future.result()[1]:
+        self.streams.pop(stream_id, None)
+    result.add_done_callback(Done)
+    return result
+
+  def _Answer(self, answer_id, result):
+    if inspect.isawaitable(result) and not isinstance(result, asyncio.Future):
+      # Coroutines can only be awaited once, but both the backend and
+      # pipelined calls need the result.
+      result = asyncio.ensure_future(result)
+    self.answers[answer_id] = result
+    return result
+
+  async def _CallWhenReady(self, answer, path, iface_id, method_id, args,
+                           kwargs):
+    result = _Walk(await answer, path)[iface_id, method_id](*args, **kwargs)
+    if inspect.isawaitable(result):
+      result = await result
+    return result
+
+
+def _Interface(obj):
+  if isinstance(obj, RemoteInterfaceClient):
+    return obj.interface
+  if isinstance(obj, cara.BaseInterface):
+    return cara._find_interface_base_class(type(obj))
+  return None
+
+
+def _MethodKeys(obj):
+  """The (iface_id, method_id) of every method obj has."""
+  interface = _Interface(obj)
+  if interface is None:
+    return
+  for iface in interface.__superclasses__ + (interface,):
+    for method in iface.__methods__.values():
+      yield iface.id, method.id
+
+
+def _Methods(obj):
+  """Yields ((iface_id, method_id), wrapped method) for obj's methods."""
+  for key in _MethodKeys(obj):
+    try:
+      func = obj[key]
+    except (AttributeError, KeyError):
+      # Not implemented, which call reports if it's ever called.
+      continue
+    if isinstance(func, generics.GetItemWrapper):
+      _, method = _Interface(obj)._get_method(key)
+      func = func[(cara.AnyPointer,) * len(method.templates)]
+    yield key, func
+
+
+class _ServerStream(object):
+  """A $Cara.stream method's result, as it's being sent."""
+
+  def __init__(self, stream):
+    self.is_async = hasattr(stream, '__aiter__')
+    if self.is_async:
+      self.iterator = stream.__aiter__()
+    else:
+      self.iterator = iter(stream)
+    # The async element being waited on, kept between chunks.
+    self.next = None
+
+  def Next(self, count):
+    elements = list(itertools.islice(self.iterator, count))
+    return elements, len(elements) < count
+
+  async def NextAsync(self, count):
+    elements = []
+    while len(elements) < count:
+      if self.next is None:
+        self.next = asyncio.ensure_future(self.iterator.__anext__())
+      if elements and not self.next.done():
+        # Give it a chance before sending what's there so far.
+        await asyncio.sleep(0)
+        if not self.next.done():
+          break
+      try:
+        element = await self.next
+      except StopAsyncIteration:
+        return elements, True
+      finally:
+        if self.next.done():
+          self.next = None
+      elements.append(element)
+    return elements, False
+
+  def Close(self):
+    if not self.is_async:
+      close = getattr(self.iterator, 'close', None)
+      if close is not None:
+        close()
+      return
+    if self.next is not None:
+      self.next.cancel()
+    close = getattr(self.iterator, 'aclose', None)
+    if close is not None:
+      asyncio.ensure_future(close())
+
+
+def _IsPending(answer):
+  return inspect.isawaitable(answer) and not (
+      isinstance(answer, asyncio.Future) and answer.done())
+
+
+def _Walk(value, path):
+  for name in path:
+    value = value[name]
+  return value
+
+
+def _IsPipelinable(type):
+  return isinstance(type, (cara.StructMeta, cara.InterfaceMeta)) or (
+      isinstance(type, list) and any(
+          _IsPipelinable(param.type) for param in type))
+
+
+def _Types(params):
+  """The types of a method's params (or results), in order."""
+  if isinstance(params, list):
+    return [param.type for param in params]
+  return [params]
+
+
+# Whether codecs can encode a method's params and results, by (interface,
+# method name).
+_encodable_methods = {}
+
+
+def _EncodableMethod(interface, method):
+  key = (interface, method.name)
+  encodable = _encodable_methods.get(key)
+  if encodable is None:
+    encodable = _encodable_methods[key] = (
+        cara.StreamType(method) is None and all(
+            codec.Encodable(type)
+            for type in _Types(method.params) + _Types(method.results)))
+  return encodable
+
+
+def _EncodeParams(encoding, method, args, kwargs):
+  values = list(args)
+  if kwargs:
+    names = [param.name for param in method.params]
+    values += [None] * (len(names) - len(values))
+    for name, value in kwargs.items():
+      values[names.index(name)] = value
+    # Params that weren't given at all are left for the handler's defaults.
+    while values and values[-1] is None:
+      values.pop()
+  return encoding.EncodeMany(_Types(method.params), values)
+
+
+def _EncodeResult(encoding, method, result):
+  results = method.results
+  if not isinstance(results, list):
+    return encoding.Encode(results, result)
+  if len(results) == 1:
+    return encoding.Encode(results[0].type, result)
+  if not results:
+    return encoding.Dump(None)
+  trees = []
+  for param in results:
+    if param.type is cara.Void and param.name in result:
+      trees.append(codec.EncodeVoid(None))
+    elif result.get(param.name) is None:
+      # What missing results are, see codec.EncodeVoid.
+      trees.append(None)
+    else:
+      trees.append(encoding.ToTree(param.type, result[param.name]))
+  return encoding.Dump(trees)
+
+
+async def _EncodeWhenReady(encoding, method, result):
+  return _EncodeResult(encoding, method, await result)
+
+
+def _DecodeResult(encoding, method, data):
+  """The result of call_encoded, ready for converting to the result types."""
+  results = method.results
+  if not isinstance(results, list):
+    return encoding.FromTree(results, encoding.Load(data))
+  if len(results) == 1:
+    return encoding.FromTree(results[0].type, encoding.Load(data))
+  if not results:
+    return encoding.Load(data)
+  return {param.name: codec.DecodeVoid(tree) if param.type is cara.Void
+          else encoding.FromTree(param.type, tree)
+          for param, tree in zip(results, encoding.Load(data))
+          if tree is not None}
+
+
+def _ResultType(method):
+  """The type of a method's result after _MethodWrapper's unboxing."""
+  if isinstance(method.results, list) and len(method.results) == 1:
+    return method.results[0].type
+  return method.results
+
+
+class RemoteInterfaceClient(mutablerecords.HashableRecord(
+        'RemoteInterface', ['remote_id', 'client', 'interface'])):
+
+  @classmethod
+  def FromDescriptor(cls, interface, descriptor):
+    client = cls(descriptor.remote_id, descriptor.client, interface)
+    if descriptor.client is not None:
+      # The finalizer gets its own copy, it can't keep client alive.
+      finalizer = weakref.finalize(
+          client, _Release,
+          cls(descriptor.remote_id, descriptor.client, interface))
+      finalizer.atexit = False
+    return client
+
+  @classmethod
+  def Bootstrap(cls, interface, client):
+    """The interface the other side registered with register_interface."""
+    return cls(interface.id, client, interface)
+
+  def __getattr__(self, attr):
+      if attr.startswith('_'):
+          raise AttributeError(attr)
+      stub = self[attr]
+      # Stored on the instance, so the next lookup doesn't even get here.
+      self.__dict__[attr] = stub
+      return stub
+
+  def __getitem__(self, key):
+      stubs = self.__dict__.get('_stubs')
+      if stubs is None:
+          stubs = self.__dict__['_stubs'] = {}
+      stub = stubs.get(key)
+      if stub is None:
+          stub = stubs[key] = self._NewStub(key)
+      return stub
+
+  def _NewStub(self, key):
+      iface_id, method = self.interface._get_method(key)
+      if method is None:
+          raise AttributeError('%s has no attribute %s' % (self, key))
+      result_type = _ResultType(method)
+
+      if cara.StreamType(method) is not None:
+          def ProxyMethod(*args, **kwargs):
+              # The rest of the stream has to come from the same place.
+              caller = self._Pinned()
+              stream_id = _NewAnswerId()
+              future = caller._Request(
+                  'call_stream', stream_id, self.remote_id, iface_id,
+                  method.id, args, kwargs, STREAM_CREDIT)
+              return RemoteStream(future, caller, stream_id)
+      elif (self._Codec() is not None
+            and _EncodableMethod(self.interface, method)):
+          encoding = self._Codec()
+          decode = functools.partial(_DecodeResult, encoding, method)
+          pipelinable = _IsPipelinable(result_type)
+
+          def ProxyMethod(*args, **kwargs):
+              future = self._Request(
+                  'call_encoded', self.remote_id, iface_id, method.id,
+                  encoding.name,
+                  _EncodeParams(encoding, method, args, kwargs))
+              future = cara._ConvertToType(decode, _AsFuture(future))
+              if pipelinable:
+                  # Nothing to pipeline without interfaces, but fields of
+                  # the result can still be used before it arrives.
+                  return Promise(future, self, None, result_type)
+              return future
+      elif not _IsPipelinable(result_type):
+          def ProxyMethod(*args, **kwargs):
+              return self._Call(iface_id, method.id, args, kwargs)
+      else:
+          def ProxyMethod(*args, **kwargs):
+              # Pipelined calls have to go where the answer is.
+              caller = self._Pinned()
+              answer_id = _NewAnswerId()
+              future = caller._Request(
+                  'call_promised', answer_id, self.remote_id, iface_id,
+                  method.id, args, kwargs)
+              return Promise(future, caller, answer_id, result_type)
+      return cara.BaseInterface._MethodWrapper(ProxyMethod, method)
+
+  def _Pinned(self):
+      """This interface on a single connection, if it's on a ClientPool."""
+      if isinstance(self.client, ClientPool):
+          return type(self)(self.remote_id, self.client.Pin(), self.interface)
+      return self
+
+  def _Codec(self):
+    """The codec negotiated with the other side, if backends support one."""
+    return None
+
+  def _Call(self, iface_id, method_id, args, kwargs):
+    """Sends the call to the other side."""
+    return self._Request(
+        'call', self.remote_id, iface_id, method_id, args, kwargs)
+
+  def _Request(self, name, *args):
+    """Calls the other side's rpc, backends may override this."""
+    return getattr(self.client, name)(*args)
+
+  def _Notify(self, name, *args):
+    """Calls the other side's rpc without needing its result."""
+    self._Request(name, *args)
+
+  def __deepcopy__(self, memo):
+    # Can't deep copy a remote client, and a copy would release the reference
+    # a second time.
+    return self
+
+
+# How many elements of a stream are requested at a time. The next chunk is
+# requested as soon as one arrives, so at most two are on their way.
+STREAM_CREDIT = 64
+
+
+class RemoteStream(object):
+  """The result of a $Cara.stream method on the other side.
+
+  Iterate over it with async for (once converted by the method wrapper, the
+  elements are the list's element type):
+
+    async for person in address_book.everyone():
+      ...
+
+  Elements are requested STREAM_CREDIT at a time, which is all the other side
+  will produce before this side asks for more.
+  """
+
+  def __init__(self, future, caller, stream_id):
+    self._request = future
+    self._caller = caller
+    self._stream_id = stream_id
+    self._elements = collections.deque()
+    self._cancel = weakref.finalize(
+        self, _Release, caller, 'stream_cancel', stream_id)
+    self._cancel.atexit = False
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self):
+    while not self._elements:
+      if self._request is None:
+        raise StopAsyncIteration
+      try:
+        elements, done = await self._request
+      except BaseException:
+        self._request = None
+        self._cancel.detach()
+        raise
+      self._elements.extend(elements)
+      if done:
+        self._request = None
+        self._cancel.detach()
+      else:
+        self._request = self._caller._Request(
+            'stream_next', self._stream_id, STREAM_CREDIT)
+    return self._elements.popleft()
+
+  async def aclose(self):
+    """Stops the stream early, letting the other side clean up."""
+    request, self._request = self._request, None
+    if request is not None:
+      # Nobody wants its elements, or its error once the stream is cancelled.
+      request.add_done_callback(lambda f: f.cancelled() or f.exception())
+    self._elements.clear()
+    self._cancel()
+
+
+ROUND_ROBIN = 'round_robin'
+LEAST_OUTSTANDING = 'least_outstanding'
+
+
+class ClientPool(object):
+  """Spreads calls over clients connected to replicas of the same server.
+
+  Use it wherever a client would go, each call goes to one of the clients:
+
+    pool = ClientPool([client1, client2, client3])
+    result = yield Calculator(pool).add(2, 5)
+
+  Interfaces that come back from a call are on the client that made the call,
+  so the objects they stand for are only called in the replica that has them.
+
+  Args:
+    clients: The clients, already set up and started.
+    balance: LEAST_OUTSTANDING picks the client with the fewest calls waiting
+      on a result, ROUND_ROBIN takes turns.
+  """
+
+  def __init__(self, clients, balance=LEAST_OUTSTANDING):
+    if balance not in (ROUND_ROBIN, LEAST_OUTSTANDING):
+      raise ValueError('Unknown balance %s' % balance)
+    self.clients = list(clients)
+    self.balance = balance
+    self.outstanding = [0] * len(self.clients)
+    self._turns = itertools.count()
+
+  def Pin(self):
+    """Picks a client, returning it wrapped so its calls are counted."""
+    return PooledClient(self, self._Pick())
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    return getattr(self.Pin(), name)
+
+  def _Pick(self):
+    first = next(self._turns) % len(self.clients)
+    if self.balance == ROUND_ROBIN:
+      return first
+    # Ties go to whoever's turn it is.
+    order = itertools.chain(
+        range(first, len(self.clients)), range(first))
+    return min(order, key=self.outstanding.__getitem__)
+
+  def _Track(self, index, result):
+    # Coroutines are only counted once they're futures.
+    result = _AsFuture(result)
+    if not hasattr(result, 'add_done_callback'):
+      return result
+    self.outstanding[index] += 1
+    result.add_done_callback(lambda _: self._Done(index))
+    return result
+
+  def _Done(self, index):
+    self.outstanding[index] -= 1
+
+
+class PooledClient(mutablerecords.Record('PooledClient', ['pool', 'index'])):
+  """One of a ClientPool's clients, counting the calls made through it."""
+
+  @property
+  def client(self):
+    return self.pool.clients[self.index]
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    func = getattr(self.client, name)
+
+    def Tracked(*args, **kwargs):
+      return self.pool._Track(self.index, func(*args, **kwargs))
+    return Tracked
+
+
+def _Release(client, name='release', id=None):
+  try:
+    client._Notify(name, client.remote_id if id is None else id)
+  except Exception:
+    # Nothing to release if the connection is already gone.
+    pass
+
+
+# Export ids count up from a random start, so they aren't reused while the
+# process lives and ids from a previous run are unlikely to match. The owner
+# tag goes in the bits above the count.
+_export_ids = itertools.count(random.getrandbits(32))
+_OWNER_SHIFT = 48
+_COUNT_MASK = (1 << _OWNER_SHIFT) - 1
+
+
+def _NewExportId(owner=None):
+  local_id = next(_export_ids) & _COUNT_MASK
+  if owner is not None:
+    local_id |= owner << _OWNER_SHIFT
+  return local_id
+
+
+def ExportOwner(local_id):
+  """The owner tag of an id from RemoteInterfaceServer.export, or None."""
+  return (local_id >> _OWNER_SHIFT) or None
+
+
+def _NewAnswerId():
+  return random.getrandbits(63)
+
+
+def _AsFuture(result):
+  """result as a future if it's awaitable, like pseud 1.x's coroutines."""
+  if inspect.isawaitable(result) and not hasattr(result, 'add_done_callback'):
+    return asyncio.ensure_future(result)
+  return result
+
+
+class Promise(object):
+  """The result of a call on a remote interface, before it has arrived.
+
+  Await it (or yield it in a tornado coroutine) for the result. Fields of the
+  result and methods of interfaces in it can be used right away, and those
+  calls are sent without waiting for the result. The other side resolves them
+  once the result is ready, so a chain of calls costs a single round trip:
+
+    person = AddressBook(client).find('Bob')
+    await person.updater.delete()
+  """
+  __slots__ = ('_future', '_caller', '_answer_id', '_type', '_path')
+
+  def __init__(self, future, caller, answer_id, type, path=()):
+    # Backends' calls may be coroutines, which can't take callbacks.
+    self._future = future = _AsFuture(future)
+    self._caller = caller
+    self._answer_id = answer_id
+    self._type = type
+    self._path = path
+    # Without an answer_id, the other side didn't keep the answer.
+    if not path and answer_id is not None:
+      future.add_done_callback(self._Finish)
+
+  def _Finish(self, future):
+    # Pipelined calls sent before this are already ahead of the finish.
+    self._caller._Notify('finish', self._answer_id)
+
+  def _Convert(self, type):
+    self._future = cara._ConvertToType(type, self._future)
+    return self
+
+  def __await__(self):
+    if not self._path:
+      return self._future.__await__()
+    return self._Resolve().__await__()
+  __iter__ = __await__
+
+  async def _Resolve(self):
+    return _Walk(await self._future, self._path)
+
+  def __getattr__(self, attr):
+    if attr.startswith('_'):
+      raise AttributeError(attr)
+    type = self._type
+    if isinstance(type, cara.InterfaceMeta):
+      return self._PipelinedMethod(attr)
+    if isinstance(type, cara.StructMeta):
+      field = type.__fields__.get(attr)
+      if field is None:
+        raise AttributeError('%s has no field %s' % (type.__name__, attr))
+      type = field.type
+    elif isinstance(type, list):
+      param = next((param for param in type if param.name == attr), None)
+      if param is None:
+        raise AttributeError('No result named %s' % attr)
+      type = param.type
+    else:
+      raise AttributeError('Cannot pipeline %s on %s' % (attr, type))
+    return Promise(self._future, self._caller, self._answer_id, type,
+                   self._path + (attr,))
+  __getitem__ = __getattr__
+
+  def _PipelinedMethod(self, attr):
+    iface_id, method = self._type._get_method(attr)
+    if method is None:
+      raise AttributeError('%s has no method %s' % (self._type, attr))
+    if cara.StreamType(method) is not None:
+      raise TypeError('Cannot pipeline streaming method %s, await the promise '
+                      'first.' % attr)
+    result_type = _ResultType(method)
+
+    def PipelinedMethod(*args, **kwargs):
+      if self._future.done():
+        # Too late to pipeline, the answer may already be finished.
+        iface = _Walk(self._future.result(), self._path)
+        return iface[iface_id, method.id](*args, **kwargs)
+      new_answer_id = None
+      if _IsPipelinable(result_type):
+        new_answer_id = _NewAnswerId()
+      future = self._caller._Request(
+          'call_pipelined', self._answer_id, self._path, iface_id, method.id,
+          args, kwargs, new_answer_id)
+      if new_answer_id is None:
+        return future
+      return Promise(future, self._caller, new_answer_id, result_type)
+    return cara.BaseInterface._MethodWrapper(PipelinedMethod, method)
+
+
+def RegisterRemoteTypes():
+  """Registers what every backend needs, called when setting one up."""
+  cara.type_conversion_registry.Register(
+      Promise, lambda type, promise: promise._Convert(type))
+
+
+# $Cara.executor, see cara.capnp.
+_EXECUTOR_ANNOTATION_ID = 0xc2a9d4b3f0e61b57
+
+# Executors that $Cara.executor can name without registering them first.
+_executor_factories = {
+    'thread': concurrent.futures.ThreadPoolExecutor,
+    'process': concurrent.futures.ProcessPoolExecutor,
+}
+# Named executors, by name.
+executors = {}
+# Offloads for executors that were passed in directly, by executor.
+_offloads = weakref.WeakKeyDictionary()
+
+
+class Offload(object):
+  """Runs handlers in an executor, keeping count of what's waiting on it.
+
+  Attributes:
+    executor: The concurrent.futures.Executor.
+    name: The name it was registered with, if any.
+    pending: Calls submitted that haven't finished, the executor's backlog.
+    max_pending: The most calls that were pending at once.
+    submitted, completed, failed: Calls so far.
+  """
+
+  def __init__(self, executor, name=None):
+    self.executor = executor
+    self.name = name
+    self.pending = 0
+    self.max_pending = 0
+    self.submitted = 0
+    self.completed = 0
+    self.failed = 0
+    # Done callbacks run in the executor's threads.
+    self._lock = threading.Lock()
+
+  def Submit(self, func, *args, **kwargs):
+    """Calls func in the executor.
+
+    Returns:
+      A future of the running event loop, converted like any other awaitable
+      when the handler's result is, or a concurrent.futures.Future when there
+      is no running loop.
+    """
+    with self._lock:
+      self.submitted += 1
+      self.pending += 1
+      self.max_pending = max(self.max_pending, self.pending)
+    future = self.executor.submit(func, *args, **kwargs)
+    future.add_done_callback(self._Done)
+    try:
+      loop = asyncio.get_event_loop()
+    except RuntimeError:
+      # Not the main thread, and none was set for this one.
+      return future
+    if not loop.is_running():
+      return future
+    # Its callbacks run in the executor's threads, this one's on the loop.
+    return asyncio.wrap_future(future, loop=loop)
+
+  def Stats(self):
+    return {
+        'pending': self.pending,
+        'max_pending': self.max_pending,
+        'submitted': self.submitted,
+        'completed': self.completed,
+        'failed': self.failed,
+    }
+
+  def _Done(self, future):
+    failed = future.cancelled() or future.exception() is not None
+    with self._lock:
+      self.pending -= 1
+      if failed:
+        self.failed += 1
+      else:
+        self.completed += 1
+
+
+def RegisterExecutor(name, executor):
+  """Makes executor available to register_interface and $Cara.executor."""
+  offload = executors[name] = Offload(executor, name)
+  return offload
+
+
+def GetOffload(executor):
+  """The Offload for an executor, or for a name from RegisterExecutor.
+
+  'thread' and 'process' are a ThreadPoolExecutor and ProcessPoolExecutor
+  with the default number of workers, created the first time they're used.
+  """
+  if isinstance(executor, Offload):
+    return executor
+  if isinstance(executor, str):
+    offload = executors.get(executor)
+    if offload is None:
+      if executor not in _executor_factories:
+        raise KeyError('No executor named %s' % executor)
+      offload = RegisterExecutor(executor, _executor_factories[executor]())
+    return offload
+  offload = _offloads.get(executor)
+  if offload is None:
+    offload = _offloads[executor] = Offload(executor)
+  return offload
+
+
+def ExecutorStats():
+  """Stats of every Offload in use, by executor name (or repr)."""
+  stats = {name: offload.Stats() for name, offload in executors.items()}
+  for executor, offload in list(_offloads.items()):
+    stats[repr(executor)] = offload.Stats()
+  return stats
+
+
+def _AnnotatedExecutor(annotations):
+  for ann in annotations:
+    if ann.annotation.id == _EXECUTOR_ANNOTATION_ID:
+      return str(ann.value)
+  return None
+
+
+def _Offloads(interface, executor):
+  """The Offload each method of interface runs in, by method name.
+
+  The executor given at registration wins over the method's $Cara.executor,
+  which wins over its interface's.
+  """
+  offloads = {}
+  for iface in interface.__superclasses__ + (interface,):
+    default = _AnnotatedExecutor(iface.__annotations__)
+    for name, method in iface.__methods__.items():
+      if isinstance(executor, dict):
+        chosen = executor.get(name)
+      else:
+        chosen = executor
+      if chosen is None:
+        chosen = _AnnotatedExecutor(method.annotations) or default
+      if chosen is not None:
+        offloads[name] = GetOffload(chosen)
+  return offloads
+
+
+def _Offloaded(interface, obj, offloads):
+  """Implementations of obj's methods, submitting some to executors."""
+  if not isinstance(obj, interface):
+    obj = interface(obj)
+  funcs = {}
+  for iface in interface.__superclasses__ + (interface,):
+    for name, method in iface.__methods__.items():
+      try:
+        func = obj._GetImplementation(method)
+      except (AttributeError, KeyError):
+        continue
+      if name in offloads:
+        if inspect.iscoroutinefunction(func):
+          raise TypeError('%s is a coroutine, which cannot run in an '
+                          'executor.' % name)
+        func = functools.partial(offloads[name].Submit, func)
+      funcs[name] = func
+  return funcs
+
+
+# $Cara.priority, see cara.capnp.
+_PRIORITY_ANNOTATION_ID = 0xe3b5a7c91d2f4068
+
+# Every Limiter given to register_interface, for LimiterStats.
+_limiters = weakref.WeakSet()
+
+
+class Overloaded(Exception):
+  """A call was shed because its Limiter's queue was full."""
+
+
+class Limiter(object):
+  """Admits a limited number of calls at once, queueing or shedding the rest.
+
+  Calls that find max_in_flight calls running wait in a queue, highest
+  $Cara.priority first and in arrival order otherwise. Once max_queued calls
+  are waiting, a new call pushes out the newest waiting call of a lower
+  priority, or fails with Overloaded right away if there isn't one. A call is
+  in flight until its result (or the awaitable it returns) is done, so limits
+  on synchronous handlers in the event loop only matter with an executor.
+
+  Only used from the event loop the calls come in on.
+
+  Attributes:
+    max_in_flight: Calls that may run at once.
+    max_queued: Calls that may wait for one of them to finish.
+    name: What LimiterStats calls it, set by register_interface if not given.
+    in_flight, queued: Calls running and waiting right now, the backlog.
+    most_queued: The most calls that were waiting at once.
+    admitted, shed, completed: Calls so far.
+  """
+
+  def __init__(self, max_in_flight, max_queued=0, name=None):
+    if max_in_flight < 1:
+      raise ValueError('max_in_flight must be at least 1, not %s' %
+                       max_in_flight)
+    self.max_in_flight = max_in_flight
+    self.max_queued = max_queued
+    self.name = name
+    self.in_flight = 0
+    self.most_queued = 0
+    self.admitted = 0
+    self.shed = 0
+    self.completed = 0
+    # Waiting calls as (-priority, arrival, future).
+    self._queue = []
+    self._arrivals = itertools.count()
+
+  @property
+  def queued(self):
+    return len(self._queue)
+
+  def Call(self, priority, func, *args, **kwargs):
+    """Calls func now, or returns a coroutine that calls it once admitted."""
+    if self.in_flight < self.max_in_flight:
+      self.in_flight += 1
+      self.admitted += 1
+      return self._Run(func, args, kwargs)
+    if len(self._queue) >= self.max_queued:
+      self._Shed(priority)
+    waiter = asyncio.get_event_loop().create_future()
+    heapq.heappush(self._queue, (-priority, next(self._arrivals), waiter))
+    self.most_queued = max(self.most_queued, len(self._queue))
+    return self._Queued(waiter, func, args, kwargs)
+
+  def Stats(self):
+    return {
+        'in_flight': self.in_flight,
+        'queued': self.queued,
+        'most_queued': self.most_queued,
+        'admitted': self.admitted,
+        'shed': self.shed,
+        'completed': self.completed,
+    }
+
+  def _Shed(self, priority):
+    """Makes room for a call of the given priority, or raises Overloaded."""
+    self.shed += 1
+    if self._queue:
+      lowest = max(self._queue)
+      if -lowest[0] < priority:
+        self._queue.remove(lowest)
+        heapq.heapify(self._queue)
+        lowest[2].set_exception(Overloaded(
+            '%s shed a call for one of higher priority' % self.name))
+        return
+    raise Overloaded('%s has %d calls in flight and %d queued' % (
+        self.name, self.in_flight, len(self._queue)))
+
+  def _Run(self, func, args, kwargs):
+    try:
+      result = func(*args, **kwargs)
+    except BaseException:
+      self._Finish()
+      raise
+    if isinstance(result, concurrent.futures.Future):
+      result = asyncio.wrap_future(result)
+    if inspect.isawaitable(result):
+      return self._Track(result)
+    self._Finish()
+    return result
+
+  async def _Track(self, awaitable):
+    try:
+      return await awaitable
+    finally:
+      self._Finish()
+
+  async def _Queued(self, waiter, func, args, kwargs):
+    try:
+      await waiter
+    except asyncio.CancelledError:
+      if waiter.cancelled():
+        self._queue = [entry for entry in self._queue if entry[2] is not waiter]
+        heapq.heapify(self._queue)
+      else:
+        # Admitted just as the caller went away, so pass the slot on.
+        self._Finish()
+      raise
+    result = self._Run(func, args, kwargs)
+    if inspect.isawaitable(result):
+      result = await result
+    return result
+
+  def _Finish(self):
+    """Hands the finished call's slot to the first waiting call, if any."""
+    self.completed += 1
+    while self._queue:
+      _, _, waiter = heapq.heappop(self._queue)
+      if not waiter.done():
+        self.admitted += 1
+        waiter.set_result(None)
+        return
+    self.in_flight -= 1
+
+
+def LimiterStats():
+  """Stats of every Limiter in use, by name.
+
+  Limiters register_interface makes are named after the interface (or
+  Interface.method), so give a Limiter a name if the same interface is
+  registered with several of them.
+  """
+  return {limiter.name: limiter.Stats() for limiter in list(_limiters)}
+
+
+def _AnnotatedPriority(annotations):
+  for ann in annotations:
+    if ann.annotation.id == _PRIORITY_ANNOTATION_ID:
+      return int(ann.value)
+  return None
+
+
+def _Limits(interface, limit, priority):
+  """The Limiter and priority each method of interface is called with.
+
+  Like executors, a dict of limits or priorities by method name may be given
+  for some methods only. Priorities given at registration win over the
+  method's $Cara.priority, which wins over its interface's.
+  """
+  shared = {}
+  limits = {}
+  for iface in interface.__superclasses__ + (interface,):
+    default = _AnnotatedPriority(iface.__annotations__)
+    for name, method in iface.__methods__.items():
+      if isinstance(limit, dict):
+        chosen, limit_name = limit.get(name), '%s.%s' % (
+            interface.__name__, name)
+      else:
+        chosen, limit_name = limit, interface.__name__
+      if chosen is None:
+        continue
+      if not isinstance(chosen, Limiter):
+        if limit_name not in shared:
+          shared[limit_name] = Limiter(chosen)
+        chosen = shared[limit_name]
+      if chosen.name is None:
+        chosen.name = limit_name
+      _limiters.add(chosen)
+      if isinstance(priority, dict):
+        chosen_priority = priority.get(name)
+      else:
+        chosen_priority = priority
+      if chosen_priority is None:
+        chosen_priority = _AnnotatedPriority(method.annotations)
+      if chosen_priority is None:
+        chosen_priority = default or 0
+      limits[name] = chosen, chosen_priority
+  return limits
+
+
+def _Limited(interface, obj, limits):
+  """Implementations of obj's methods, admitting calls through limiters."""
+  funcs = {}
+  for iface in interface.__superclasses__ + (interface,):
+    for name, method in iface.__methods__.items():
+      try:
+        func = obj._GetImplementation(method)
+      except (AttributeError, KeyError):
+        continue
+      if name in limits:
+        limiter, priority = limits[name]
+        func = functools.partial(limiter.Call, priority, func)
+      funcs[name] = func
+  return funcs
+
+
+def register_interface(server, interface=None, obj_or_cls=None,
+                       by_name=True, executor=None, limit=None,
+                       priority=None):
+    """Registers an object with the given server (or client).
+
+    Call this with a server and an object, and optionally an interface.
+
+    If called with only a server, it will become a decorator and must be called
+    on a class that can be constructed with no arguments. If the interface has a
+    single method, then it may also decorate a function.
+
+    If the interface is not specified, then the object must be a subclass of an
+    interface.
+
+    interface FooInterface {
+        bar @0 () -> ();
+    }
+
+    @register_interface(server)
+    class Foo(FooInterface):
+        ...
+
+    @register_interface(server, interface=FooInterface)
+    class Foo:
+        ...
+
+    @register_interface(server, interface=FooInterface)
+    def bar_func():
+        ...
+
+    register_interface(server, FooInterface, FooClass)
+    register_interface(server, FooInterface, bar_func)
+
+    The object is exported under the interface's id, where
+    RemoteInterfaceClient.Bootstrap finds it, and its methods are registered as
+    rpcs by name, so that Interface(client).method() works. Pass by_name=False
+    to skip the names, which lets interfaces with the same method names share
+    a server:
+
+    register_interface(server, FooInterface, FooClass, by_name=False)
+    foo = cara_asyncio.RemoteInterfaceClient.Bootstrap(FooInterface, client)
+
+    Registering by name only needs a register_rpc(func, name=name) method on
+    the server, like pseud's servers and clients or cara_asyncio's.
+
+    Methods that block or keep the CPU busy can run in an executor instead of
+    the event loop. Pass an Executor, a name from RegisterExecutor ('thread'
+    and 'process' always work), or a dict of those by method name:
+
+    register_interface(server, FooInterface, FooClass, executor='thread')
+
+    The same names can be given in the schema, with $Cara.executor("thread")
+    on an interface or method. Parameters and results are still converted in
+    the event loop.
+
+    Calls can be limited so a burst on one interface can't starve the others.
+    Pass a Limiter, which may be shared with other registrations, an int for a
+    Limiter allowing that many calls at once, or a dict of those by method
+    name. Queued calls run by $Cara.priority, or by priority, an int or dict
+    by method name of them:
+
+    register_interface(server, FooInterface, FooClass,
+                       limit=Limiter(max_in_flight=4, max_queued=100))
+
+    See LimiterStats for how many calls are running and waiting.
+    """
+
+    def decorator(obj_or_cls):
+        nonlocal interface
+        if inspect.isclass(obj_or_cls):
+            obj = obj_or_cls()
+            interface = cara._find_interface_base_class(obj_or_cls, interface)
+        elif inspect.isfunction(obj_or_cls):
+            if interface is None:
+                raise TypeError('Interface must be specified for registering a '
+                                'single function.')
+            if len(interface.__methods__) != 1:
+                raise TypeError(
+                    'Interface %s has too many methods to be registered with '
+                    'only a function.' % interface)
+            obj = interface(obj_or_cls)
+        else:
+            # Should be an instance of a class.
+            interface = cara._find_interface_base_class(
+                obj_or_cls.__class__, interface)
+            obj = interface(obj_or_cls)
+
+        offloads = _Offloads(interface, executor)
+        if offloads:
+            obj = interface(_Offloaded(interface, obj, offloads))
+        limits = _Limits(interface, limit, priority)
+        if limits:
+            obj = interface(_Limited(interface, obj, limits))
+
+        handler = getattr(server, 'handler', None)
+        if handler is not None:
+            handler.register(interface.id, interface(obj))
+        if not by_name:
+            return
+        # interface is last since we want to override any overlapping names.
+        for iface in interface.__superclasses__ + (interface,):
+            for name, method in iface.__methods__.items():
+                func = getattr(obj, name)
+                if isinstance(method, cara.TemplatedMethod):
+                    func = func.__getitem__(
+                        (cara.AnyPointer,) * len(method.templates))
+                server.register_rpc(func, name=name)
+    if obj_or_cls is None:
+        return decorator
+    return decorator(obj_or_cls)
@@ -0,0 +1,307 @@
+"""Snapshots of finished schema modules, to import them without running them.
+
+  snapshot.Save('schemas.snapshot', [people_capnp])  # Once, after compiling.
+
+  snapshot.Install('schemas.snapshot')  # At startup, before importing any.
+  from people import people_capnp
+
+Save pickles the finished declarations of the modules, and of the schema
+modules they import: the struct and interface classes with their fields,
+methods, unions and nested declarations, enums, lists, and generics with the
+instantiations in their caches. Install adds an import hook that, on the first
+import of one of those modules, restores all of them from the snapshot instead
+of running them, so nothing is declared or finished again.
+
+A snapshot only applies to the cara it was saved with, and only while every
+module's source is the same as when it was saved, so compiling any of the
+schemas again invalidates it. If it doesn't apply, or one of its modules was
+imported before it could be restored, the modules are imported as usual.
+"""
+import hashlib
+import importlib
+import importlib.abc
+import importlib.machinery
+import importlib.util
+import io
+import pickle
+import sys
+import threading
+import types
+
+import mutablerecords
+
+from cara import cara
+from cara import generics
+from cara import list_cache
+from cara import specialized
+
+# Incremented when what's pickled changes.
+FORMAT = 1
+
+_REGISTER_GLOBALLY_ID = 0xebd6c4912189be2c
+# The modules of cara whose classes and functions are pickled.
+_PICKLED_MODULES = (cara, generics, list_cache, specialized)
+# Attributes of declaration classes that are made with the class.
+_CLASS_ATTRIBUTES = frozenset([
+    'id', '__module__', '__dict__', '__weakref__', '__doc__', '__new__'])
+
+
+def Save(path, modules):
+  """Snapshots modules, and the schema modules they import, to path."""
+  modules = _WithImports(modules)
+  namespaces = {module.__name__: _Namespace(module) for module in modules}
+  files = {module.__name__: (module.__file__, _Hash(module.__file__))
+           for module in modules}
+  body = io.BytesIO()
+  _Pickler(body, set(namespaces)).dump(namespaces)
+  with open(path, 'wb') as file:
+    pickle.dump((FORMAT, _CaraVersion(), files), file,
+                protocol=pickle.HIGHEST_PROTOCOL)
+    file.write(body.getvalue())
+
+
+def Install(path):
+  """Restores the modules in the snapshot at path when they're imported.
+
+  Returns:
+    Whether the snapshot is for this version of cara, and was installed.
+  """
+  try:
+    file = open(path, 'rb')
+  except FileNotFoundError:
+    return False
+  with file:
+    try:
+      format, version, files = pickle.load(file)
+    except Exception:
+      return False
+    if format != FORMAT or version != _CaraVersion():
+      return False
+    offset = file.tell()
+  sys.meta_path.insert(0, _Finder(path, offset, files))
+  return True
+
+
+class _Finder(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+  """Finds the modules in a snapshot, and loads them from it."""
+
+  def __init__(self, path, offset, files):
+    self.path = path
+    self.offset = offset
+    self.files = files
+    self.modules = None
+    self.lock = threading.Lock()
+
+  def find_spec(self, name, path, target=None):
+    if name not in self.files:
+      return None
+    spec = importlib.machinery.PathFinder.find_spec(name, path)
+    if spec is None or spec.origin != self.files[name][0]:
+      return None
+    with self.lock:
+      if self.modules is None and not self._Restore():
+        sys.meta_path.remove(self)
+        return None
+    return importlib.util.spec_from_file_location(
+        name, spec.origin, loader=self)
+
+  def _Restore(self):
+    """Unpickles every module, if the snapshot still applies."""
+    if any(name in sys.modules for name in self.files):
+      return False
+    for filename, hash in self.files.values():
+      try:
+        if _Hash(filename) != hash:
+          return False
+      except OSError:
+        return False
+    modules = {name: types.ModuleType(name) for name in self.files}
+    with open(self.path, 'rb') as file:
+      file.seek(self.offset)
+      namespaces = _Unpickler(file, modules).load()
+    for name, namespace in namespaces.items():
+      modules[name].__dict__.update(namespace)
+    self.modules = modules
+    return True
+
+  def create_module(self, spec):
+    return self.modules[spec.name]
+
+  def exec_module(self, module):
+    # Already restored.
+    pass
+
+
+def _WithImports(modules):
+  """modules, and the schema modules they import recursively."""
+  found = {}
+  pending = list(modules)
+  while pending:
+    module = pending.pop()
+    if module.__name__ in found:
+      continue
+    found[module.__name__] = module
+    # Lazy modules declare everything now.
+    dir(module)
+    pending.extend(
+        value for value in vars(module).values()
+        if isinstance(value, types.ModuleType)
+        and value.__name__.endswith('_capnp'))
+  return list(found.values())
+
+
+def _Namespace(module):
+  return {
+      name: value for name, value in vars(module).items()
+      if (name == '__annotations__' or not name.startswith('__'))
+      # cara.lazy's functions, which need running the module.
+      and not isinstance(value, types.FunctionType)}
+
+
+def _Hash(filename):
+  with open(filename, 'rb') as file:
+    return hashlib.sha256(file.read()).hexdigest()
+
+
+def _CaraVersion():
+  # Releases and checkouts alike change the modules that make what's pickled.
+  hashes = [_Hash(module.__file__) for module in _PICKLED_MODULES]
+  return hashlib.sha256(' '.join(hashes).encode()).hexdigest()
+
+
+# Records in cara, which mutablerecords doesn't make picklable by name.
+_RECORD_TYPES = {
+    value: (module.__name__, name)
+    for module in _PICKLED_MODULES
+    for name, value in vars(module).items()
+    if isinstance(value, mutablerecords.records.RecordMeta)}
+
+
+class _Pickler(pickle.Pickler):
+  """Pickles declarations by value, with the modules in names by name.
+
+  Classes are only pickled by value through reducer_override, and restoring
+  them needs the state setters of its reductions; both are new in Python 3.8,
+  cara's oldest.
+  """
+
+  def __init__(self, file, names):
+    super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+    self.names = names
+
+  def persistent_id(self, obj):
+    if isinstance(obj, types.ModuleType) and obj.__name__ in self.names:
+      return obj.__name__
+    return None
+
+  def reducer_override(self, obj):
+    if isinstance(obj, types.ModuleType):
+      return importlib.import_module, (obj.__name__,)
+    if isinstance(obj, type):
+      return _ReduceType(obj)
+    if isinstance(obj, mutablerecords.records.RecordClass):
+      state = {attr: getattr(obj, attr)
+               for attr in type(obj).all_attribute_names
+               if hasattr(obj, attr)}
+      if isinstance(obj, cara.BaseTemplated):
+        # Callbacks for finishing instantiations, which it already is.
+        state['__dependent_decls__'] = []
+      return object.__new__, (type(obj),), state, None, None, _SetSlots
+    if isinstance(obj, cara.BaseStruct):
+      return (object.__new__, (type(obj),), dict(obj), None, None,
+              _SetStructValue)
+    if isinstance(obj, cara.BaseList):
+      return object.__new__, (type(obj),), list(obj), None, None, _SetList
+    return NotImplemented
+
+
+def _ReduceType(cls):
+  if cls in _RECORD_TYPES:
+    return _Lookup, _RECORD_TYPES[cls]
+  own = vars(cls)
+  if isinstance(cls, (cara.StructMeta, cara.InterfaceMeta)) and 'id' in own:
+    new = cara.Struct if isinstance(cls, cara.StructMeta) else cara.Interface
+    # Specialized again when restored, see cara.specialized.
+    made = _CLASS_ATTRIBUTES | own.get('__specialized__', frozenset())
+    state = {name: value for name, value in own.items() if name not in made}
+    return (new, (cls.__name__, cls.id, cls.__qualname__), state, None, None,
+            _SetDeclaration)
+  if issubclass(cls, cara.BaseList) and 'sub_type' in own:
+    if not _ByValue(cls):
+      return cara.List, (cls.sub_type,)
+    # Looking it up in cara.List's cache compares the sub_type to others,
+    # which it can't be until it's restored.
+    return (_NewList, (cls.__name__,), {'sub_type': cls.sub_type}, None, None,
+            _SetListType)
+  if issubclass(cls, cara.BaseEnum) and cls.__members__:
+    enumerants = [cara.Enumerant(name, member.value)
+                  for name, member in cls.__members__.items()]
+    state = {name: own[name] for name in (
+        '__annotations__', '__enumerant_annotations__') if name in own}
+    return (cara.Enum, (cls.__name__, enumerants), state, None, None,
+            _SetDeclaration)
+  return NotImplemented
+
+
+def _ByValue(decl):
+  """Whether decl is declared in a schema, rather than built into cara."""
+  if isinstance(decl, mutablerecords.records.RecordClass):
+    return True
+  if not isinstance(decl, type):
+    return False
+  own = vars(decl)
+  if issubclass(decl, cara.BaseList) and 'sub_type' in own:
+    return _ByValue(decl.sub_type)
+  if issubclass(decl, cara.BaseEnum):
+    return bool(decl.__members__)
+  return 'id' in own and isinstance(decl, (cara.StructMeta, cara.InterfaceMeta))
+
+
+class _Unpickler(pickle.Unpickler):
+
+  def __init__(self, file, modules):
+    super().__init__(file)
+    self.modules = modules
+
+  def persistent_load(self, name):
+    return self.modules[name]
+
+
+def _Lookup(module, name):
+  return getattr(sys.modules[module], name)
+
+
+def _SetDeclaration(cls, state):
+  for name, value in state.items():
+    if name != '__specialized__':
+      type.__setattr__(cls, name, value)
+  if '__specialized__' in state:
+    specialized.Specialize(cls)
+  if isinstance(cls, cara.InterfaceMeta) and '__methods__' in state:
+    # As FinishDeclaration does.
+    cls.__new__ = cls.NewWrapper
+  if any(annotation.annotation.id == _REGISTER_GLOBALLY_ID
+         for annotation in state.get('__annotations__') or ()):
+    cara.GlobalTypeRegistry[cls.id] = cls
+
+
+def _NewList(name):
+  return type(name, (cara.BaseList,), {'__module__': cara.__name__})
+
+
+def _SetListType(cls, state):
+  cls.sub_type = state['sub_type']
+  cara.__list_cache__[cls.sub_type] = cls
+
+
+def _SetSlots(obj, state):
+  for name, value in state.items():
+    object.__setattr__(obj, name, value)
+
+
+def _SetStructValue(value, fields):
+  dict.update(value, fields)
+
+
+def _SetList(value, elements):
+  list.extend(value, elements)
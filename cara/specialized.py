@@ -0,0 +1,174 @@
+"""Struct classes with accessors and methods specialized to their fields.
+
+capnpc-cara generates a call to Specialize for every struct when
+CARA_SPECIALIZED_STRUCTS=1 is set, after finishing them:
+
+  Basic.FinishDeclaration(...)
+  specialized.Specialize(Basic)
+
+BaseStruct resolves every name or id it's given to a field at runtime, so
+basic.field goes through __getattr__, __getitem__ and _get_id_from_identifier
+to find its id. Specialize gives the struct a property per field that reads
+its id directly, an __init__, __setattr__ and item methods looking keys up in
+one constant table of every name and id, and conversions and ToDict picked by
+each field's type once rather than per value. Structs behave the same either
+way: anything the tables don't cover goes to BaseStruct, as do subclasses of
+the struct, like cara.wire's views.
+"""
+import functools
+
+from cara import cara
+
+_NESTED_TYPES = (cara.BaseStruct, cara.BaseInterface)
+# The real _ConvertToType, which builtin fields skip.
+_convert = cara._ConvertToType
+
+
+def Specialize(cls):
+  """Specializes a finished struct class, and its groups, in place."""
+  fields = cls.__id_fields__
+  union = frozenset(cls.__union_fields__)
+  ids = {}
+  for field in fields:
+    for key in (str(field.id), field.name):
+      ids[key] = ids[key.encode('ascii')] = field.id
+    ids[field.id] = field.id
+  names = tuple(field.name for field in fields)
+  converters = tuple(_Converter(field.type) for field in fields)
+  # Values of these types are stored as they are, so ToDict returns them so.
+  plain = frozenset(field.id for field in fields if _IsPlain(field.type))
+  dict_getitem = dict.__getitem__
+  dict_setitem = dict.__setitem__
+  dict_get = dict.get
+  dict_contains = dict.__contains__
+  base = cara.BaseStruct
+
+  def __init__(self, val=None):
+    if not val:
+      return
+    keep = {}
+    for key, value in val.items():
+      id = ids.get(key)
+      if id is None or id in union and not union.isdisjoint(keep):
+        # Keys it doesn't know and several union members, as usual.
+        keep = None
+        break
+      keep[id] = converters[id](value)
+    if keep is None:
+      base.__init__(self, val)
+    else:
+      dict.update(self, keep)
+
+  def Setter(id):
+    convert = converters[id]
+    if id not in union:
+      def Set(self, val):
+        dict_setitem(self, id, convert(val))
+    else:
+      def Set(self, val):
+        # Clear the other fields in the union first.
+        for union_id in union:
+          dict.pop(self, union_id, None)
+        dict_setitem(self, id, convert(val))
+    return Set
+  setters = tuple(Setter(field.id) for field in fields)
+  setters_by_name = {field.name: setters[field.id] for field in fields}
+
+  def __setattr__(self, attr, val):
+    setter = setters_by_name.get(attr)
+    if setter is None or type(self) is not cls:
+      return base.__setattr__(self, attr, val)
+    setter(self, val)
+
+  def __getitem__(self, item):
+    id = ids.get(item)
+    if id is None:
+      return base.__getitem__(self, item)
+    return dict_getitem(self, id)
+
+  def __setitem__(self, item, val, field=None):
+    id = ids.get(item)
+    if id is None or type(self) is not cls:
+      return base.__setitem__(self, item, val, field=field)
+    setters[id](self, val)
+
+  def get(self, item, default=None):
+    id = ids.get(item)
+    if id is None:
+      return base.get(self, item, default)
+    return dict_get(self, id, default)
+
+  def __contains__(self, item):
+    id = ids.get(item)
+    if id is None:
+      return base.__contains__(self, item)
+    return dict_contains(self, id)
+
+  def ToDict(self, with_field_names=False):
+    result = {}
+    items = dict.items(self) if type(self) is cls else self.items()
+    for id, value in items:
+      if id not in plain:
+        if isinstance(value, _NESTED_TYPES):
+          value = value.ToDict(with_field_names=with_field_names)
+        elif isinstance(value, cara.BaseList):
+          value = value.ToList(with_field_names=with_field_names)
+      result[names[id] if with_field_names else id] = value
+    return result
+
+  attrs = {
+      '__init__': __init__, '__setattr__': __setattr__,
+      '__getitem__': __getitem__, '__setitem__': __setitem__, 'get': get,
+      '__contains__': __contains__, 'ToDict': ToDict,
+  }
+  for field in fields:
+    # Fields named like dict methods, or anything else on the class, are only
+    # items, as they are in BaseStruct.
+    if not hasattr(cls, field.name):
+      attrs[field.name] = property(
+          functools.partial(_GetItem, field.id), doc=field.name)
+    if _IsGroup(cls, field.type):
+      Specialize(field.type)
+  for name, value in attrs.items():
+    # Not nested declarations.
+    type.__setattr__(cls, name, value)
+  type.__setattr__(cls, '__specialized__', frozenset(attrs))
+  return cls
+
+
+def _GetItem(id, struct):
+  # dict's own, which still calls __missing__ for defaults.
+  return dict.__getitem__(struct, id)
+
+
+def _Converter(field_type):
+  # cara._ConvertToType is looked up on each call, since cara.profiling
+  # replaces it while profiling.
+  if isinstance(field_type, type) and issubclass(field_type, cara.BuiltinType):
+    registry = cara.type_conversion_registry
+
+    def ConvertBuiltin(value):
+      if cara._ConvertToType is not _convert:
+        return cara._ConvertToType(field_type, value)
+      # Builtin types return the value itself.
+      if registry.IsInstanceOfAny(value):
+        return registry.LookUp(value)(field_type, value)
+      return value
+    return ConvertBuiltin
+
+  def Convert(value):
+    return cara._ConvertToType(field_type, value)
+  return Convert
+
+
+def _IsPlain(field_type):
+  return isinstance(field_type, type) and (
+      issubclass(field_type, cara.BuiltinType)
+      and field_type is not cara.AnyPointer
+      or issubclass(field_type, cara.BaseEnum))
+
+
+def _IsGroup(cls, field_type):
+  return (isinstance(field_type, cara.StructMeta) and field_type is not cls
+          and field_type.id == cls.id
+          and field_type.__name__.startswith(cls.__name__ + '.'))
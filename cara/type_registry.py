@@ -1,16 +1,30 @@
+import threading
+
+
 class TypeRegistry(object):
   def __init__(self):
     self._registry = {}
     self._registry_types = ()
+    self._lock = threading.Lock()
 
   def Register(self, base_type, registered):
-    if base_type in self._registry:
-      return
-    self._registry[base_type] = registered
-    self._registry_types += (base_type,)
+    with self._lock:
+      if base_type in self._registry:
+        return
+      # Copied rather than changed, so lookups in other threads never see it
+      # change while they iterate.
+      registry = dict(self._registry)
+      registry[base_type] = registered
+      self._registry = registry
+      self._registry_types += (base_type,)
 
   def LookUp(self, instance):
-    for base_type, registered in self._registry.items():
+    registry = self._registry
+    # Exact types win over base classes, and skip the scan.
+    registered = registry.get(type(instance))
+    if registered is not None:
+      return registered
+    for base_type, registered in registry.items():
       if isinstance(instance, base_type):
         return registered
 
@@ -0,0 +1,748 @@
+"""Cap'n Proto's binary wire format, read lazily and without copying.
+
+  data = wire.Build(Person, person)  # A message with person as its root.
+  person = wire.Read(Person, data)   # A read-only view of the root struct.
+  person.name                        # Only decoded now.
+
+Read takes bytes, a memoryview or an mmap, and the view it returns decodes
+each field the first time it's used, straight out of the buffer. Data fields
+are memoryviews of the buffer, so large blobs aren't copied, and nested
+structs and the elements of struct lists are views as well. A view is an
+instance of its struct type, so it works wherever the struct does, but it
+can't be modified. Person(view) copies it into a regular struct.
+
+Both need to know where fields are in the struct's data and pointer sections,
+which capnpc-cara generates into FinishDeclaration (see
+cara.StructLayout). Messages are the same as every other Cap'n Proto
+implementation's, but interfaces and AnyPointers can't be read or written
+without an RPC system's capability table. Build writes a single segment, and
+Read follows far pointers into any number of them.
+"""
+import struct
+
+from cara import cara
+
+# List element sizes, from the second word of a list pointer.
+VOID, BIT, BYTE, TWO_BYTES, FOUR_BYTES, EIGHT_BYTES, POINTER, COMPOSITE = (
+    range(8))
+# Pointer kinds, the low two bits of a pointer.
+_STRUCT, _LIST, _FAR, _OTHER = range(4)
+
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+_U64 = struct.Struct('<Q')
+_OFFSET_MASK = (1 << 30) - 1
+_MAX_COUNT = (1 << 29) - 1
+
+# The struct format and element size of values in the data section.
+_DATA_FORMATS = {
+    cara.Int8: ('b', BYTE), cara.Int16: ('h', TWO_BYTES),
+    cara.Int32: ('i', FOUR_BYTES), cara.Int64: ('q', EIGHT_BYTES),
+    cara.Uint8: ('B', BYTE), cara.Uint16: ('H', TWO_BYTES),
+    cara.Uint32: ('I', FOUR_BYTES), cara.Uint64: ('Q', EIGHT_BYTES),
+    cara.Float32: ('f', FOUR_BYTES), cara.Float64: ('d', EIGHT_BYTES),
+}
+_ENUM_FORMAT = ('H', TWO_BYTES)
+_BYTES = {BYTE: 1, TWO_BYTES: 2, FOUR_BYTES: 4, EIGHT_BYTES: 8}
+# The bits of floats, for defaults which are XORed with the value.
+_FLOAT_BITS = {'f': 'I', 'd': 'Q'}
+
+# What a pointer field reads as when it's null, and isn't set in the view.
+_ABSENT = object()
+
+
+def Read(type, data):
+  """A read-only view of the root struct of the message in data."""
+  return Message(data).Root(type)
+
+
+def Build(type, value):
+  """Serializes value (converted to type) as the root of a message."""
+  builder = _Builder()
+  builder.WriteStruct(0, type, value)
+  return _U32.pack(0) + _U32.pack(len(builder.buffer) // 8) + builder.buffer
+
+
+class Message(object):
+  """The segments of a message, as memoryviews of the buffer it's in."""
+
+  def __init__(self, data):
+    buffer = memoryview(data)
+    if buffer.ndim != 1 or buffer.itemsize != 1:
+      buffer = buffer.cast('B')
+    try:
+      count = _U32.unpack_from(buffer, 0)[0] + 1
+      if count * 4 > len(buffer):
+        raise ValueError('%d segments is more than the message has' % count)
+      sizes = struct.unpack_from('<%dI' % count, buffer, 4)
+    except struct.error:
+      raise ValueError('Truncated segment table')
+    # The table is padded to a whole number of words.
+    offset = (4 * (count + 1) + 7) & ~7
+    self.segments = []
+    self.words = sum(sizes)
+    for size in sizes:
+      end = offset + size * 8
+      if end > len(buffer):
+        raise ValueError('Truncated segment, %d bytes missing' % (
+            end - len(buffer)))
+      self.segments.append(buffer[offset:end])
+      offset = end
+
+  def Root(self, type):
+    view = _ReadStruct(self, 0, 0, _ViewType(type))
+    if view is _ABSENT:
+      # A null root is a struct with every field at its default.
+      return _NewView(_ViewType(type), _Location(self, 0, 0, 0, 0, 0))
+    return view
+
+  def Pointer(self, segment, word):
+    """Follows the pointer at word of segment, through far pointers.
+
+    Returns: (pointer, segment, word it points to), with the pointer being the
+      tag for double-far pointers, and the word None for null pointers and
+      capabilities.
+    """
+    raw = self._Word(segment, word)
+    kind = raw & 3
+    if kind == _FAR:
+      pad_segment, pad_word = raw >> 32, (raw >> 3) & _MAX_COUNT
+      if not raw & 4:
+        raw = self._Word(pad_segment, pad_word)
+        if raw & 3 == _FAR:
+          raise ValueError('Far pointer landed on another far pointer')
+        return raw, pad_segment, _Target(raw, pad_word)
+      far = self._Word(pad_segment, pad_word)
+      tag = self._Word(pad_segment, pad_word + 1)
+      return tag, far >> 32, (far >> 3) & _MAX_COUNT
+    if raw == 0 or kind == _OTHER:
+      return raw, segment, None
+    return raw, segment, _Target(raw, word)
+
+  def Check(self, segment, word, words):
+    """Raises ValueError unless segment has words words starting at word."""
+    if segment >= len(self.segments) or (
+        word < 0 or (word + words) * 8 > len(self.segments[segment])):
+      raise ValueError('Pointer out of bounds of segment %d' % segment)
+
+  def _Word(self, segment, word):
+    self.Check(segment, word, 1)
+    return _U64.unpack_from(self.segments[segment], word * 8)[0]
+
+
+def _Target(raw, word):
+  offset = (raw & 0xffffffff) >> 2
+  if offset & (1 << 29):
+    offset -= 1 << 30
+  return word + 1 + offset
+
+
+class _Location(object):
+  """Where a struct's sections are, data in bytes and pointers in words."""
+  __slots__ = ('message', 'segment', 'data', 'data_size', 'pointers',
+               'pointer_count')
+
+  def __init__(self, message, segment, data, data_size, pointers,
+               pointer_count):
+    self.message = message
+    self.segment = segment
+    self.data = data
+    self.data_size = data_size
+    self.pointers = pointers
+    self.pointer_count = pointer_count
+
+
+class StructView(object):
+  """A struct in a message, decoding its fields the first time they're used.
+
+  Views are instances of a subclass of both this and the struct type, see
+  _ViewType. Fields that aren't set (null pointers, or union members that
+  aren't the active one) read as their defaults, like in any other struct.
+  """
+
+  def __missing__(self, id):
+    value = type(self)._readers[id](self._at)
+    if value is _ABSENT:
+      return type(self).__id_fields__[id].default_value
+    dict.__setitem__(self, id, value)
+    return value
+
+  def _Load(self):
+    """Decodes every field that's set, so dict methods see all of them."""
+    if self.__dict__.get('_loaded'):
+      return
+    for id, read in type(self)._readers.items():
+      if not dict.__contains__(self, id):
+        value = read(self._at)
+        if value is not _ABSENT:
+          dict.__setitem__(self, id, value)
+    self.__dict__['_loaded'] = True
+
+  def items(self):
+    self._Load()
+    return super().items()
+
+  def keys(self):
+    self._Load()
+    return super().keys()
+
+  def values(self):
+    self._Load()
+    return super().values()
+
+  def __iter__(self):
+    self._Load()
+    return super().__iter__()
+
+  def __len__(self):
+    self._Load()
+    return super().__len__()
+
+  def __contains__(self, item):
+    self._Load()
+    return super().__contains__(item)
+
+  def get(self, item, default=None):
+    self._Load()
+    return super().get(item, default)
+
+  def __eq__(self, other):
+    # Compared as the struct type, which other is converted to if need be.
+    struct_type = type(self)._struct_type
+    if not isinstance(other, struct_type):
+      try:
+        other = struct_type(other)
+      except Exception:
+        return False
+    return struct_type.__eq__(other, self)
+
+  def __ne__(self, other):
+    return not self == other
+
+  __hash__ = cara.BaseStruct.__hash__
+
+  def __reduce__(self):
+    # Copies and pickles are of the struct type.
+    return type(self)._struct_type, (dict(self.items()),)
+
+  def _ReadOnly(self, *args, **kwargs):
+    raise TypeError('%s is a read-only view of a message' % (
+        type(self).__name__))
+  __setitem__ = __delitem__ = pop = popitem = clear = update = setdefault = (
+      _ReadOnly)
+
+
+# View types, by struct type.
+_view_types = {}
+
+
+def _ViewType(struct_type):
+  view_type = _view_types.get(struct_type)
+  if view_type is None:
+    _Layout(struct_type)
+    view_type = type(struct_type)(
+        struct_type.__name__, (StructView, struct_type),
+        {'__module__': struct_type.__module__,
+         '__qualname__': struct_type.__qualname__,
+         '_struct_type': struct_type, '_readers': {}})
+    for field in struct_type.__id_fields__:
+      view_type._readers[field.id] = _FieldReader(struct_type, field)
+    _view_types[struct_type] = view_type
+  return view_type
+
+
+def _NewView(view_type, at):
+  view = dict.__new__(view_type)
+  view.__dict__['_at'] = at
+  return view
+
+
+def _Layout(struct_type):
+  layout = getattr(struct_type, '__layout__', None)
+  if layout is None:
+    raise TypeError('%s has no wire layout, generate it with a newer '
+                    'capnpc-cara' % struct_type.__name__)
+  return layout
+
+
+def _DataFormat(field_type):
+  """The struct format and element size of field_type, if it's data."""
+  if _IsEnum(field_type):
+    return _ENUM_FORMAT
+  return _DATA_FORMATS.get(field_type)
+
+
+def _IsEnum(field_type):
+  return isinstance(field_type, type) and issubclass(field_type, cara.BaseEnum)
+
+
+def _IsStruct(field_type):
+  return isinstance(field_type, type) and issubclass(
+      field_type, cara.BaseStruct)
+
+
+def _IsList(field_type):
+  return isinstance(field_type, type) and issubclass(field_type, cara.BaseList)
+
+
+def _ToBits(fmt):
+  """A function converting values of fmt to their bits, unsigned."""
+  value_struct = struct.Struct('<' + fmt)
+  bits_struct = struct.Struct('<' + _UNSIGNED[value_struct.size])
+  return lambda value: bits_struct.unpack(value_struct.pack(value))[0]
+
+
+def _FromBits(field_type, fmt):
+  """A function converting the unsigned bits of a field_type to its value."""
+  if fmt in _FLOAT_BITS:
+    value_struct = struct.Struct('<' + fmt)
+    bits_struct = struct.Struct('<' + _FLOAT_BITS[fmt])
+    return lambda bits: value_struct.unpack(bits_struct.pack(bits))[0]
+  if fmt.islower():
+    sign = 1 << (struct.calcsize(fmt) * 8 - 1)
+    return lambda bits: (bits ^ sign) - sign
+  if _IsEnum(field_type):
+    return _EnumConverter(field_type)
+  return lambda bits: bits
+
+
+def _EnumConverter(enum_type):
+  def Convert(value):
+    try:
+      return enum_type(value)
+    except ValueError:
+      # An enumerant added to the schema since this was generated.
+      return value
+  return Convert
+
+
+_UNSIGNED = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+
+# Reading.
+
+def _FieldReader(struct_type, field):
+  """A function reading field from a _Location, or returning _ABSENT."""
+  read = _ValueReader(field)
+  if field.discriminant is None:
+    return read
+  offset = struct_type.__layout__.discriminant_offset * 2
+  discriminant = field.discriminant
+
+  def ReadMember(at):
+    if _ReadDiscriminant(at, offset) != discriminant:
+      return _ABSENT
+    value = read(at)
+    # The active member is set, even when it's Void or its default.
+    return field.default_value if value is _ABSENT else value
+  return ReadMember
+
+
+def _ReadDiscriminant(at, offset):
+  if offset + 2 > at.data_size:
+    return 0
+  return _U16.unpack_from(at.message.segments[at.segment], at.data + offset)[0]
+
+
+def _ValueReader(field):
+  if field.type is cara.Void:
+    return lambda at: _ABSENT
+  if field.type is cara.Bool:
+    return _BoolReader(field)
+  data_format = _DataFormat(field.type)
+  if data_format:
+    return _DataReader(field, data_format)
+  if field.offset is None:
+    # A group, in the same sections as the struct it's in.
+    group_type = field.type
+    return lambda at: _NewView(_ViewType(group_type), at)
+  return _PointerReader(field)
+
+
+def _BoolReader(field):
+  byte, bit = divmod(field.offset, 8)
+  value = not field.default
+
+  def Read(at):
+    if byte >= at.data_size or not (
+        at.message.segments[at.segment][at.data + byte] >> bit & 1):
+      return _ABSENT
+    return value
+  return Read
+
+
+def _DataReader(field, data_format):
+  fmt, size = data_format
+  width = _BYTES[size]
+  start = field.offset * width
+  unpack = struct.Struct('<' + _UNSIGNED[width]).unpack_from
+  default = _ToBits(fmt)(field.default or 0)
+  convert = _FromBits(field.type, fmt)
+
+  def Read(at):
+    if start + width > at.data_size:
+      return _ABSENT
+    bits = unpack(at.message.segments[at.segment], at.data + start)[0]
+    # All zeros is the default, so the field isn't set.
+    if not bits:
+      return _ABSENT
+    return convert(bits ^ default)
+  return Read
+
+
+def _PointerReader(field):
+  index = field.offset
+  read = _PointerDecoder(field.type)
+
+  def Read(at):
+    if index >= at.pointer_count:
+      return _ABSENT
+    return read(at.message, at.segment, at.pointers + index)
+  return Read
+
+
+def _PointerDecoder(pointer_type):
+  """A function decoding the pointer at (message, segment, word)."""
+  if pointer_type is cara.Text:
+    return _ReadText
+  if pointer_type is cara.Data:
+    return _ReadData
+  if _IsStruct(pointer_type):
+    return lambda message, segment, word: _ReadStruct(
+        message, segment, word, _ViewType(pointer_type))
+  if _IsList(pointer_type):
+    return _ListDecoder(pointer_type)
+  return _ReadCapability
+
+
+def _ReadText(message, segment, word):
+  data = _ReadData(message, segment, word)
+  if data is _ABSENT:
+    return data
+  if not data or data[-1]:
+    raise ValueError('Text is not NUL terminated')
+  return str(data[:-1], 'utf-8')
+
+
+def _ReadData(message, segment, word):
+  found = _ReadList(message, segment, word)
+  if found is None:
+    return _ABSENT
+  size, count, segment, word, _, _ = found
+  if size != BYTE:
+    raise ValueError('Expected a list of bytes, not element size %d' % size)
+  return message.segments[segment][word * 8:word * 8 + count]
+
+
+def _ReadStruct(message, segment, word, view_type):
+  raw, segment, target = message.Pointer(segment, word)
+  if not raw:
+    return _ABSENT
+  if raw & 3 != _STRUCT:
+    raise ValueError('Expected a struct pointer, not kind %d' % (raw & 3))
+  data_words, pointer_count = (raw >> 32) & 0xffff, raw >> 48
+  message.Check(segment, target, data_words + pointer_count)
+  return _NewView(view_type, _Location(
+      message, segment, target * 8, data_words * 8, target + data_words,
+      pointer_count))
+
+
+def _ReadCapability(message, segment, word):
+  raw, _, _ = message.Pointer(segment, word)
+  if not raw:
+    return _ABSENT
+  raise TypeError('Interfaces and AnyPointers need a capability table to be '
+                  'read')
+
+
+_EMPTY = {cara.Text: str, cara.Data: bytes}
+# Bits per element, for every element size but COMPOSITE.
+_ELEMENT_BITS = (0, 1, 8, 16, 32, 64, 64)
+
+
+def _ReadList(message, segment, word):
+  """Follows a list pointer, returning None if it's null.
+
+  Returns: (element size, element count, segment, word of the first element,
+    data bytes and pointers of each element if they're structs).
+  """
+  raw, segment, target = message.Pointer(segment, word)
+  if not raw:
+    return None
+  if raw & 3 != _LIST:
+    raise ValueError('Expected a list pointer, not kind %d' % (raw & 3))
+  size, count = (raw >> 32) & 7, raw >> 35
+  data_size = pointer_count = 0
+  if size == COMPOSITE:
+    message.Check(segment, target, count + 1)
+    tag = _U64.unpack_from(message.segments[segment], target * 8)[0]
+    words, target = count, target + 1
+    count = (tag & 0xffffffff) >> 2
+    data_words, pointer_count = (tag >> 32) & 0xffff, tag >> 48
+    if count * (data_words + pointer_count) > words:
+      raise ValueError('%d elements overrun their list' % count)
+    zero_sized = not data_words + pointer_count
+    data_size = data_words * 8
+  else:
+    message.Check(segment, target, (count * _ELEMENT_BITS[size] + 63) // 64)
+    zero_sized = not size
+    if size == POINTER:
+      pointer_count = 1
+    elif size != BIT:
+      data_size = _ELEMENT_BITS[size] // 8
+  # Elements without words are free to send, but not to decode.
+  if zero_sized and count > message.words:
+    raise ValueError('%d empty elements in a message of %d words' % (
+        count, message.words))
+  return size, count, segment, target, data_size, pointer_count
+
+
+def _ListDecoder(list_type):
+  read_elements = _ElementsReader(list_type.sub_type)
+
+  def Read(message, segment, word):
+    found = _ReadList(message, segment, word)
+    if found is None:
+      return _ABSENT
+    value = list.__new__(list_type)
+    list.extend(value, read_elements(message, *found))
+    return value
+  return Read
+
+
+def _ElementsReader(sub_type):
+  """A function reading the elements _ReadList found."""
+  if sub_type is cara.Void:
+    return lambda message, size, count, *_: [None] * count
+  if sub_type is cara.Bool:
+    return _ReadBools
+  data_format = _DataFormat(sub_type)
+  if data_format:
+    return _DataElementsReader(sub_type, data_format)
+  if _IsStruct(sub_type):
+    return _StructElementsReader(sub_type)
+  read = _PointerDecoder(sub_type)
+  # Null elements are empty, there's no leaving them out of a list.
+  empty = _EMPTY.get(sub_type, sub_type if _IsList(sub_type) else None)
+
+  def ReadPointers(message, size, count, segment, word, *_):
+    _CheckSize(size, POINTER)
+    values = [read(message, segment, word + i) for i in range(count)]
+    for i, value in enumerate(values):
+      if value is _ABSENT:
+        values[i] = empty() if empty else None
+    return values
+  return ReadPointers
+
+
+def _CheckSize(size, expected):
+  if size != expected:
+    raise ValueError('Expected list elements of size %d, not %d' % (
+        expected, size))
+
+
+def _ReadBools(message, size, count, segment, word, *_):
+  _CheckSize(size, BIT)
+  data = message.segments[segment]
+  start = word * 8
+  return [bool(data[start + i // 8] >> i % 8 & 1) for i in range(count)]
+
+
+def _DataElementsReader(sub_type, data_format):
+  fmt, element_size = data_format
+  convert = _EnumConverter(sub_type) if _IsEnum(sub_type) else None
+
+  def Read(message, size, count, segment, word, *_):
+    _CheckSize(size, element_size)
+    values = struct.unpack_from(
+        '<%d%s' % (count, fmt), message.segments[segment], word * 8)
+    return values if convert is None else map(convert, values)
+  return Read
+
+
+def _StructElementsReader(sub_type):
+
+  def Read(message, size, count, segment, word, data_size, pointer_count):
+    if size == BIT:
+      raise ValueError('Expected a list of structs, not of bits')
+    view_type = _ViewType(sub_type)
+    step = data_size + pointer_count * 8
+    return [
+        _NewView(view_type, _Location(
+            message, segment, word * 8 + i * step, data_size,
+            word + (i * step + data_size) // 8, pointer_count))
+        for i in range(count)]
+  return Read
+
+
+# Writing.
+
+class _Builder(object):
+  """Writes a message's single segment, allocating as it goes."""
+
+  def __init__(self):
+    # Starting with the root pointer.
+    self.buffer = bytearray(8)
+
+  def Allocate(self, words):
+    word = len(self.buffer) // 8
+    self.buffer += bytes(words * 8)
+    return word
+
+  def Point(self, word, target, kind, upper):
+    """Writes a pointer at word to target, with upper as its second half."""
+    offset = (target - word - 1) & _OFFSET_MASK
+    _U64.pack_into(self.buffer, word * 8, offset << 2 | kind | upper << 32)
+
+  def WriteStruct(self, word, struct_type, value):
+    if not isinstance(value, struct_type):
+      value = struct_type(value)
+    if not value:
+      # Nothing's set, so a struct without sections reads back the same.
+      self.Point(word, word, _STRUCT, 0)
+      return
+    layout = _Layout(struct_type)
+    target = self.Allocate(layout.data_words + layout.pointer_words)
+    self.Point(word, target, _STRUCT,
+               layout.data_words | layout.pointer_words << 16)
+    self.WriteFields(
+        struct_type, value, target * 8, target + layout.data_words)
+
+  def WriteFields(self, struct_type, value, data, pointers):
+    writers = _Writers(struct_type)
+    for id, field_value in value.items():
+      writers[id](self, field_value, data, pointers)
+
+  def WritePointer(self, word, pointer_type, value):
+    if value is None:
+      return
+    if pointer_type is cara.Text:
+      self.WriteBytes(word, value.encode('utf-8') + b'\0')
+    elif pointer_type is cara.Data:
+      self.WriteBytes(word, value)
+    elif _IsStruct(pointer_type):
+      self.WriteStruct(word, pointer_type, value)
+    elif _IsList(pointer_type):
+      self.WriteList(word, pointer_type, value)
+    else:
+      raise TypeError("Can't write %s without a capability table" % (
+          pointer_type.__name__))
+
+  def WriteBytes(self, word, data):
+    size = memoryview(data).nbytes
+    _CheckCount(size)
+    target = self.Allocate((size + 7) // 8)
+    self.buffer[target * 8:target * 8 + size] = data
+    self.Point(word, target, _LIST, BYTE | size << 3)
+
+  def WriteList(self, word, list_type, values):
+    sub_type = list_type.sub_type
+    count = _CheckCount(len(values))
+    data_format = _DataFormat(sub_type)
+    if sub_type is cara.Void:
+      self.Point(word, word + 1, _LIST, VOID | count << 3)
+    elif sub_type is cara.Bool:
+      target = self.Allocate((count + 63) // 64)
+      for i, value in enumerate(values):
+        if value:
+          self.buffer[target * 8 + i // 8] |= 1 << i % 8
+      self.Point(word, target, _LIST, BIT | count << 3)
+    elif data_format:
+      fmt, size = data_format
+      target = self.Allocate((count * _BYTES[size] + 7) // 8)
+      struct.pack_into(
+          '<%d%s' % (count, fmt), self.buffer, target * 8, *values)
+      self.Point(word, target, _LIST, size | count << 3)
+    elif _IsStruct(sub_type):
+      layout = _Layout(sub_type)
+      step = layout.data_words + layout.pointer_words
+      words = _CheckCount(count * step)
+      target = self.Allocate(1 + words)
+      # The tag is a struct pointer, with the element count as its offset.
+      _U64.pack_into(self.buffer, target * 8, count << 2 | (
+          layout.data_words | layout.pointer_words << 16) << 32)
+      for i, value in enumerate(values):
+        if not isinstance(value, sub_type):
+          value = sub_type(value)
+        element = target + 1 + i * step
+        self.WriteFields(
+            sub_type, value, element * 8, element + layout.data_words)
+      self.Point(word, target, _LIST, COMPOSITE | words << 3)
+    else:
+      target = self.Allocate(count)
+      for i, value in enumerate(values):
+        self.WritePointer(target + i, sub_type, value)
+      self.Point(word, target, _LIST, POINTER | count << 3)
+
+
+def _CheckCount(count):
+  if count > _MAX_COUNT:
+    raise ValueError('Lists are limited to %d elements or words, not %d' % (
+        _MAX_COUNT, count))
+  return count
+
+
+# Field writers, by struct type.
+_writers = {}
+
+
+def _Writers(struct_type):
+  writers = _writers.get(struct_type)
+  if writers is None:
+    _Layout(struct_type)
+    writers = _writers[struct_type] = {
+        field.id: _FieldWriter(struct_type, field)
+        for field in struct_type.__id_fields__}
+  return writers
+
+
+def _FieldWriter(struct_type, field):
+  write = _ValueWriter(field)
+  if field.discriminant is None:
+    return write
+  offset = struct_type.__layout__.discriminant_offset * 2
+  discriminant = field.discriminant
+
+  def WriteMember(builder, value, data, pointers):
+    _U16.pack_into(builder.buffer, data + offset, discriminant)
+    write(builder, value, data, pointers)
+  return WriteMember
+
+
+def _ValueWriter(field):
+  field_type = field.type
+  if field_type is cara.Void:
+    return lambda *_: None
+  if field_type is cara.Bool:
+    byte, bit = divmod(field.offset, 8)
+    default = bool(field.default)
+
+    def WriteBool(builder, value, data, pointers):
+      if value is not None and bool(value) != default:
+        builder.buffer[data + byte] |= 1 << bit
+    return WriteBool
+  data_format = _DataFormat(field_type)
+  if data_format:
+    fmt, size = data_format
+    width = _BYTES[size]
+    start = field.offset * width
+    pack = struct.Struct('<' + _UNSIGNED[width]).pack_into
+    to_bits = _ToBits(fmt)
+    default = to_bits(field.default or 0)
+
+    def WriteData(builder, value, data, pointers):
+      if value is not None:
+        pack(builder.buffer, data + start, to_bits(value) ^ default)
+    return WriteData
+  if field.offset is None:
+
+    def WriteGroup(builder, value, data, pointers):
+      if not isinstance(value, field_type):
+        value = field_type(value)
+      builder.WriteFields(field_type, value, data, pointers)
+    return WriteGroup
+  index = field.offset
+
+  def WritePointer(builder, value, data, pointers):
+    builder.WritePointer(pointers + index, field_type, value)
+  return WritePointer
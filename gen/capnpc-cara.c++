@@ -1,8 +1,10 @@
 #include <algorithm>
+#include <cstdlib>
 #include <map>
 #include <memory>
 #include <regex>
 #include <set>
+#include <sstream>
 #include <stack>
 #include <unordered_map>
 #include <unordered_set>
@@ -261,6 +263,28 @@ class BasePythonGenerator : public BaseGenerator {
     return to_py_array(fields);
   }
 
+  // Where a field is in its struct's sections, for cara.wire.
+  kj::String field_layout(const StructSchema::Field& field) {
+    auto proto = field.getProto();
+    kj::String layout = kj::str("");
+    if (proto.isSlot()) {
+      layout = kj::str(", offset=", proto.getSlot().getOffset());
+    }
+    if (proto.getDiscriminantValue() != schema::Field::NO_DISCRIMINANT) {
+      layout = kj::str(layout, ", discriminant=", proto.getDiscriminantValue());
+    }
+    return layout;
+  }
+
+  // The union's discriminant in a struct or group, if it has one.
+  kj::String discriminant_layout(const Schema& schema) {
+    auto proto = schema.getProto().getStruct();
+    if (proto.getDiscriminantCount() == 0) {
+      return kj::str("");
+    }
+    return kj::str(", discriminant_offset=", proto.getDiscriminantOffset());
+  }
+
   kj::StringTree get_stored_annotations() {
     auto stored = std::move(stored_annotations_);
     if (stored.size() > 0) {
@@ -550,7 +574,8 @@ class BasePythonGenerator : public BaseGenerator {
         field.getIndex(),
         kj::str("(id=", field.getIndex(), ", name=\"",
                 field.getProto().getName(), "\"", default_value, ", type=",
-                pop_back(last_type_), get_stored_annotations(), ")")});
+                pop_back(last_type_), get_stored_annotations(),
+                field_layout(field), ")")});
     return false;
   }
 
@@ -573,7 +598,8 @@ class BasePythonGenerator : public BaseGenerator {
         field.getIndex(),
         kj::str(MODULE "Group(id=", field.getIndex(), ", name=\"",
                 field.getProto().getName(), "\", fields=", fields,
-                get_stored_annotations(), ")")});
+                get_stored_annotations(), field_layout(field),
+                discriminant_layout(groupSchema), ")")});
     return false;
   }
 
@@ -655,17 +681,17 @@ class EnumForwardDecl : public BasePythonGenerator {
 
  public:
   EnumForwardDecl(
-      SchemaLoader& loader, FILE* fd,
+      SchemaLoader& loader, std::ostream& out,
       std::vector<std::string> decl_stack)
     : BasePythonGenerator(loader, decl_stack),
-      fd_(fd) {}
+      out_(out) {}
  private:
-  FILE* fd_;
+  std::ostream& out_;
   bool post_visit_enum_decl(const Schema&, const NestedNode& decl) {
-    fprintf(
-        fd_, "%s = " MODULE "Enum(name=\"%s\", enumerants=%s)\n",
-        kj::strArray(decl_stack_, ".").cStr(), decl.getName().cStr(),
-        to_py_array(to_sorted_vector(enumerants_)).cStr());
+    out_ << kj::str(
+        kj::strArray(decl_stack_, "."), " = " MODULE "Enum(name=\"",
+        decl.getName(), "\", enumerants=",
+        to_py_array(to_sorted_vector(enumerants_)), ")\n").cStr();
     return false;
   }
 
@@ -680,11 +706,11 @@ class EnumForwardDecl : public BasePythonGenerator {
 
 class CapnpcCaraForwardDecls : public BasePythonGenerator {
  public:
-  CapnpcCaraForwardDecls(SchemaLoader &schemaLoader, FILE* fd, const kj::String& inputFilename)
-    : BasePythonGenerator(schemaLoader), fd_(fd), inputFilename_(inputFilename) {
+  CapnpcCaraForwardDecls(SchemaLoader &schemaLoader, std::ostream& out, const kj::String& inputFilename)
+    : BasePythonGenerator(schemaLoader), out_(out), inputFilename_(inputFilename) {
   }
  private:
-  FILE* fd_;
+  std::ostream& out_;
   const kj::String &inputFilename_;
 
   template<typename T>
@@ -693,15 +719,14 @@ class CapnpcCaraForwardDecls : public BasePythonGenerator {
     auto declname = kj::strArray(decl_stack_, ".");
     auto qualname = kj::str(inputFilename_, ".", declname);
     if (templates.size() != 0) {
-      fprintf(
-          fd_, "%s = " MODULE "Templated%s(name=\"%s\", id=0x%lx, "
-          "templates=%s, qualname=\"%s\")\n", declname.cStr(),
-          type.c_str(), name.cStr(), id, to_py_array(templates).cStr(), qualname.cStr());
+      out_ << kj::str(
+          declname, " = " MODULE "Templated", type.c_str(), "(name=\"", name,
+          "\", id=0x", kj::hex(id), ", templates=", to_py_array(templates),
+          ", qualname=\"", qualname, "\")\n").cStr();
     } else {
-      fprintf(
-          fd_, "%s = " MODULE "%s(name=\"%s\", id=0x%lx, qualname=\"%s\")\n",
-          declname.cStr(), type.c_str(), name.cStr(),
-          id, qualname.cStr());
+      out_ << kj::str(
+          declname, " = " MODULE, type.c_str(), "(name=\"", name, "\", id=0x",
+          kj::hex(id), ", qualname=\"", qualname, "\")\n").cStr();
     }
   }
 
@@ -723,19 +748,17 @@ class CapnpcCaraForwardDecls : public BasePythonGenerator {
     importPath.pop_back();
 
     if (importPath.size() == 0) {
-      fprintf(fd_, "from . import %s\n", name.c_str());
+      out_ << "from . import " << name << "\n";
     } else {
-      fprintf(
-          fd_, "from %s import %s\n",
-          kj::strArray(importPath, ".").cStr(),
-          name.c_str());
+      out_ << "from " << kj::strArray(importPath, ".").cStr() << " import "
+           << name << "\n";
     }
     return false;
   }
 
   bool pre_visit_enum_decl(const Schema& schema, const NestedNode& decl) {
     // Output all the fields of the enum in the forward decl.
-    EnumForwardDecl enumDecl {schemaLoader, fd_, decl_stack_};
+    EnumForwardDecl enumDecl {schemaLoader, out_, decl_stack_};
     enumDecl.traverse_enum_decl(schema, decl);
     TRAVERSE(nested_decls, schema);
     return true;
@@ -787,22 +810,31 @@ class CapnpcCaraForwardDecls : public BasePythonGenerator {
 
 class CapnpcCaraFinishDecls : public BasePythonGenerator {
  public:
-  CapnpcCaraFinishDecls(SchemaLoader& loader, FILE* fd)
-    : BasePythonGenerator(loader), fd_(fd) {}
+  CapnpcCaraFinishDecls(SchemaLoader& loader, std::ostream& out, bool specialize)
+    : BasePythonGenerator(loader), out_(out), specialize_(specialize) {}
  private:
-  FILE* fd_;
+  std::ostream& out_;
+  bool specialize_;
+  // Structs to specialize once they're all finished, see cara.specialized.
+  kj::Vector<kj::String> specialized_;
 
   bool post_visit_file(const Schema&, const RequestedFile&) override {
+    if (specialized_.size() != 0) {
+      outputLine("");
+      outputLine("# Specializing structs:");
+      for (auto& name : specialized_) {
+        outputLine(kj::str("specialized.Specialize(", name, ")"));
+      }
+    }
     if (stored_annotations_.size() != 0) {
       outputLine("");
       outputLine(kj::str("__annotations__ = ", kj::mv(stored_annotations_)));
     }
-    fclose(fd_);
     return false;
   }
 
   void outputLine(kj::StringPtr&& line) {
-    fprintf(fd_, "%s\n", line.cStr());
+    out_ << line.cStr() << "\n";
   }
 
   bool post_visit_const_decl(const Schema&, const NestedNode&) {
@@ -811,9 +843,17 @@ class CapnpcCaraFinishDecls : public BasePythonGenerator {
     return false;
   }
 
-  bool post_visit_struct_decl(const Schema&, const NestedNode&) {
+  bool post_visit_struct_decl(const Schema& schema, const NestedNode&) {
+    auto proto = schema.getProto().getStruct();
     finish_decl(
-        "fields=", get_fields("Field"), get_stored_annotations());
+        "fields=", get_fields("Field"), get_stored_annotations(),
+        ", data_words=", proto.getDataWordCount(),
+        ", pointer_words=", proto.getPointerCount(),
+        discriminant_layout(schema));
+    // Generic structs are instantiated at runtime, and stay generic.
+    if (specialize_ && !schema.getProto().getIsGeneric()) {
+      specialized_.add(kj::strArray(decl_stack_, "."));
+    }
     return false;
   }
 
@@ -934,6 +974,9 @@ class CapnpcCaraFinishDecls : public BasePythonGenerator {
 
 };
 
+// $Cara.registerGlobally, see cara.capnp.
+const uint64_t REGISTER_GLOBALLY_ID = 0xebd6c4912189be2cull;
+
 class CapnpcCara : public BaseGenerator {
  public:
   CapnpcCara(SchemaLoader& loader)
@@ -952,20 +995,79 @@ class CapnpcCara : public BaseGenerator {
 
     // Start the file
     outputLine("from " MODULE_NAME " import " MODULE_NAME);
-    outputLine("");
+    // Lazy modules declare everything in _load, which cara.lazy runs on first
+    // use. The declarations are written to a buffer first, to indent them.
+    const char* lazy = getenv("CARA_LAZY_MODULES");
+    bool is_lazy = lazy != nullptr && kj::StringPtr(lazy) == "1";
+    std::ostringstream body;
+    // Specialized structs, see cara.specialized.
+    const char* specialize = getenv("CARA_SPECIALIZED_STRUCTS");
+    bool is_specialized =
+        specialize != nullptr && kj::StringPtr(specialize) == "1";
+    if (is_specialized) {
+      outputLine("from " MODULE_NAME " import specialized");
+    }
+    if (is_lazy) {
+      outputLine("from " MODULE_NAME " import lazy");
+      outputLine("");
+      outputLine("");
+      outputLine("def _load():");
+    }
+    body << "\n";
     // Output 'forward decls' first.
-    outputLine("# Forward declarations:");
-    CapnpcCaraForwardDecls decls(schemaLoader, fd_, inputFilename);
+    body << "# Forward declarations:\n";
+    CapnpcCaraForwardDecls decls(schemaLoader, body, inputFilename);
     decls.traverse_file(schema, requestedFile);
 
-    outputLine("");
+    body << "\n";
     // Finally, finish the declarations.
-    outputLine("# Finishing declarations:");
-    CapnpcCaraFinishDecls forward(schemaLoader, fd_);
+    body << "# Finishing declarations:\n";
+    CapnpcCaraFinishDecls forward(schemaLoader, body, is_specialized);
     forward.traverse_file(schema, requestedFile);
+    if (!is_lazy) {
+      fputs(body.str().c_str(), fd_);
+      fclose(fd_);
+      return false;
+    }
+
+    std::istringstream lines {body.str()};
+    for (std::string line; std::getline(lines, line);) {
+      if (!line.empty()) {
+        fprintf(fd_, "  %s", line.c_str());
+      }
+      fprintf(fd_, "\n");
+    }
+    outputLine("  return locals()");
+    outputLine("");
+    outputLine("");
+    // What importing * gets, since the module has none of it until loaded.
+    std::vector<kj::String> names;
+    for (auto nested : schema.getProto().getNestedNodes()) {
+      names.emplace_back(kj::str('"', nested.getName(), '"'));
+    }
+    outputLine(kj::str("__all__ = ", to_py_array(names)));
+    std::vector<kj::String> registered;
+    find_registered(schema, registered);
+    outputLine(kj::str(
+        "lazy.Module(\n"
+        "    __name__, _load, registered=", to_py_array(registered), ")"));
+    fclose(fd_);
     return false;
   }
 
+  // The ids of the declarations in schema with $Cara.registerGlobally.
+  void find_registered(const Schema& schema, std::vector<kj::String>& ids) {
+    auto proto = schema.getProto();
+    for (auto annotation : proto.getAnnotations()) {
+      if (annotation.getId() == REGISTER_GLOBALLY_ID) {
+        ids.emplace_back(kj::str("0x", kj::hex(proto.getId())));
+      }
+    }
+    for (auto nested : proto.getNestedNodes()) {
+      find_registered(schemaLoader.get(nested.getId()), ids);
+    }
+  }
+
 };
 
 KJ_MAIN(CapnpcGenericMain<CapnpcCara>);
@@ -162,6 +162,34 @@ class build_test_capnp(build_capnp_files):
             self.compile_file(filename, os.path.join('tests'))
 
 
+class build_benchmark_capnp(build_capnp_files):
+    def run(self):
+        for filename in glob.glob(os.path.join(b'benchmarks', b'*.capnp')):
+            self.compile_file(filename, os.path.join('benchmarks'))
+
+
+class benchmark(Command):
+    description = "Run the benchmarks, see benchmarks/run.py."
+    user_options = [
+        ('benchmark-args=', None, "Arguments to pass to benchmarks.run"),
+    ]
+
+    def initialize_options(self):
+        self.benchmark_args = ''
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        self.run_command('build_generator')
+        self.run_command('build_benchmark_capnp')
+        build_included = self.distribution.get_command_obj(
+            'build_included_capnp')
+        build_included.run(keep_local=True)
+        from benchmarks import run
+        sys.exit(run.main(self.benchmark_args.split()))
+
+
 class pytest(test):
     user_options = [
         ('pytest-args=', None, "Arguments to pass to py.test"),
@@ -205,7 +233,9 @@ setup(
     author_email='fahhem@gmail.com',
     url='https://github.com/chainreactionmfg/cara',
     cmdclass={
+        'benchmark': benchmark,
         'build': cara_build,
+        'build_benchmark_capnp': build_benchmark_capnp,
         'build_generator': build_generator,
         'build_included_capnp': build_included_capnp,
         'build_test_capnp': build_test_capnp,
@@ -216,10 +246,12 @@ setup(
     data_files=[
         ('bin', ['gen/capnpc-cara']),
     ],
+    python_requires='>=3.8',
     install_requires=[
         'mutablerecords',
     ],
     extras_require={
+        'asyncio': ['msgpack>=0.6.1'],
         'pseud': ['pseud[Tornado]>=0.1.0'],
     },
     tests_require=[
@@ -232,6 +264,7 @@ setup(
         'Programming Language :: C++',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.8',
         'Topic :: Utilities',
         'Topic :: System :: Networking',
         'Topic :: Software Development :: Code Generators',
@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from cara import archive
+from cara import wire
+from tests.basics_capnp import Basic, SemiAdvanced
+
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'basics.arc')
+
+    def write(self, values):
+        with archive.Writer(self.path, Basic) as writer:
+            writer.Extend(values)
+            return len(writer)
+
+    def test_random_access(self):
+        self.write({'field': i, 'ints': [i] * i} for i in range(1, 101))
+        with archive.Archive(self.path, Basic) as basics:
+            assert len(basics) == 100
+            assert type(basics[6]) is Basic
+            assert basics[6] == Basic({'field': 7, 'ints': [7] * 7})
+            assert basics[-1].field == 100
+            assert [basic.field for basic in basics[10:13]] == [11, 12, 13]
+            assert [basic.field for basic in basics[::40]] == [1, 41, 81]
+            assert sum(basic.field for basic in basics) == 5050
+            with self.assertRaises(IndexError):
+                basics[100]
+
+    def test_append(self):
+        assert self.write([{'field': 1}]) == 1
+        assert self.write([{'field': 2}, {'field': 3}]) == 3
+        with archive.Archive(self.path, Basic) as basics:
+            assert [basic.field for basic in basics] == [1, 2, 3]
+
+    def test_append_compacts(self):
+        values = [{'field': i, 'ints': [i] * i} for i in range(20)]
+        self.write(values)
+        with open(self.path, 'rb') as file:
+            whole = file.read()
+        os.remove(self.path)
+        # A few records after many, then many after a few.
+        for part in (values[:15], values[15:16], [], values[16:]):
+            self.write(part)
+            self.write([])
+        with open(self.path, 'rb') as file:
+            assert file.read() == whole
+        os.remove(self.path)
+        for part in (values[:1], values[1:]):
+            self.write(part)
+        with open(self.path, 'rb') as file:
+            assert file.read() == whole
+
+    def test_unfinished_append(self):
+        self.write([{'field': 1}])
+        writer = archive.Writer(self.path, Basic)
+        writer.Append({'field': 2})
+        writer._file.flush()
+        # As it was, until the writer's closed.
+        with archive.Archive(self.path, Basic) as basics:
+            assert [basic.field for basic in basics] == [1]
+        # Left unclosed, and what it wrote is written over by the next one.
+        writer._file.close()
+        assert self.write([{'field': 3}]) == 2
+        with archive.Archive(self.path, Basic) as basics:
+            assert [basic.field for basic in basics] == [1, 3]
+
+    def test_lazy(self):
+        self.write([{'field': 1, 'nested': {'field': 2}}])
+        basics = archive.Archive(self.path, Basic, lazy=True)
+        basic = basics[0]
+        assert isinstance(basic, wire.StructView)
+        # Closing leaves the file mapped for the records still around.
+        basics.close()
+        assert basic.nested.field == 2
+
+    def test_closed(self):
+        self.write([{'field': 1}])
+        basics = archive.Archive(self.path, Basic)
+        basics.close()
+        with self.assertRaisesRegex(ValueError, 'closed'):
+            basics[0]
+
+    def test_empty(self):
+        self.write([])
+        with archive.Archive(self.path, Basic) as basics:
+            assert len(basics) == 0 and list(basics) == []
+
+    def test_errors(self):
+        self.write([{'field': 1}])
+        with self.assertRaisesRegex(ValueError, 'not SemiAdvanced'):
+            archive.Archive(self.path, SemiAdvanced)
+        # Unfinished, without the index.
+        with open(self.path, 'r+b') as file:
+            file.truncate(os.path.getsize(self.path) - 8)
+        with self.assertRaisesRegex(ValueError, 'no index'):
+            archive.Archive(self.path, Basic)
+        with open(self.path, 'wb') as file:
+            file.write(b'not an archive, but long enough to be one')
+        with self.assertRaisesRegex(ValueError, 'not an archive'):
+            archive.Archive(self.path, Basic)
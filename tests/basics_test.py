@@ -1,3 +1,4 @@
+import asyncio
 import unittest
 
 import cara
@@ -62,6 +63,32 @@ class BasicsTest(unittest.TestCase):
         assert iface.structIn({'field': 3}) == 3
         assert iface.multipleOut()['one'] == 1
 
+    def test_coroutine_interface(self):
+        async def structOut(input):
+            await asyncio.sleep(0)
+            return {'field': input}
+
+        async def structIn(struct):
+            return struct.field
+
+        iface = SimpleInterface({
+            'structOut': structOut,
+            'structIn': structIn,
+            # Returns an awaitable without being a coroutine function.
+            'multipleOut': lambda: asyncio.sleep(0, result=[1, 2]),
+        })
+        loop = asyncio.new_event_loop()
+        try:
+            basic = loop.run_until_complete(iface.structOut(4))
+            assert isinstance(basic, Basic)
+            assert basic.field == 4
+            assert loop.run_until_complete(iface.structIn({'field': 5})) == 5
+            result = loop.run_until_complete(iface.multipleOut())
+            assert result['one'] == 1
+            assert result['two'] == 2
+        finally:
+            loop.close()
+
     def test_inheritance(self):
         class Inherited(SimpleInterface):
           def structIn(self, struct):
@@ -0,0 +1,859 @@
+import asyncio
+import concurrent.futures
+import gc
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from cara import cara_asyncio
+from cara import codec
+from cara import remote
+from tests.cara_pseud_test_capnp import (
+    FooIface, BarIface, BazIface, ThreeIface, Inherit, InheritAcceptor)
+from tests.cara_asyncio_test_capnp import (
+    AddressBook, AllBlocking, Blocking, Directory, Feed, Jobs, Person)
+
+
+class BaseAsyncioTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = tempfile.mkdtemp()
+        self.peers = []
+
+    def tearDown(self):
+        for peer in self.peers:
+            peer.close()
+        self.wait(asyncio.sleep(0))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(self.tmpdir)
+
+    def wait(self, coro, timeout=1):
+        return self.loop.run_until_complete(asyncio.wait_for(coro, timeout))
+
+    def endpoint(self, name='server'):
+        return 'unix://' + os.path.join(self.tmpdir, name)
+
+    def create_server(self, endpoint, **kwargs):
+        server = cara_asyncio.setup_server(cara_asyncio.Server(**kwargs))
+        server.bind(endpoint)
+        self.wait(server.start())
+        self.peers.append(server)
+        return server
+
+    def create_client(self, endpoint, **kwargs):
+        client = cara_asyncio.setup_client(cara_asyncio.Client(**kwargs))
+        client.connect(endpoint)
+        self.wait(client.start())
+        self.peers.append(client)
+        return client
+
+
+class AsyncioTest(BaseAsyncioTest):
+
+    def test_simple(self):
+        server = self.create_server(self.endpoint())
+        client = self.create_client(self.endpoint())
+        called = []
+
+        @server.register_rpc
+        def test():
+            return 'tested'
+
+        @cara_asyncio.register_interface(server)
+        class BazIfaceImpl(BazIface):
+            def call(self, is_called):
+                called.append(is_called)
+
+        assert self.wait(client.test()) == 'tested'
+        self.wait(BazIface(client).call(True))
+        assert called == [True]
+
+    def test_tcp(self):
+        server = self.create_server('tcp://127.0.0.1:0')
+        host, port = server.addresses[0]
+        client = self.create_client('tcp://%s:%d' % (host, port))
+        server.register_rpc(lambda a, b: a + b, name='add')
+        assert self.wait(client.add(1, b=2)) == 3
+
+    def test_call_client_cb(self):
+        server = self.create_server(self.endpoint())
+        client = self.create_client(self.endpoint())
+        called = []
+
+        class Foo(FooIface):
+            def callback(self):
+                called.append(True)
+
+        @cara_asyncio.register_interface(server, FooIface)
+        def calls_cb(foo):
+            return foo.callback()
+
+        self.wait(client.callback(Foo()))
+        assert called == [True]
+
+    def test_call_server_cb(self):
+        server = self.create_server(self.endpoint())
+        client = self.create_client(self.endpoint())
+        called = []
+
+        @cara_asyncio.register_interface(server, BarIface)
+        def returnCb():
+            return lambda is_called: called.append(is_called)
+        cb = self.wait(BarIface(client).returnCb())
+        assert isinstance(cb, remote.RemoteInterfaceClient)
+        self.wait(cb.call(True))
+        assert called == [True]
+
+    def test_async_handler(self):
+        server = self.create_server(self.endpoint())
+        client = self.create_client(self.endpoint())
+
+        class ThreeIfaceImpl(ThreeIface):
+            async def returnIface(self):
+                await asyncio.sleep(0)
+                return {'normalMethod': lambda input: input * 2}
+
+            def acceptIface(self, accept):
+                pass
+
+        cara_asyncio.register_interface(server, obj_or_cls=ThreeIfaceImpl())
+        iface = self.wait(ThreeIface(client).returnIface())
+        assert self.wait(iface.normalMethod('in')) == 'inin'
+
+    def test_inheritance(self):
+        server = self.create_server(self.endpoint())
+        client = self.create_client(self.endpoint())
+        calls = []
+        inherit_iface = {
+            'superMethod': lambda: calls.append('super'),
+            'inheritedMethod': lambda: calls.append('inherited'),
+            'second': lambda: calls.append('second'),
+            'third': lambda: calls.append('third'),
+            'overlapped': lambda: calls.append('overlapped'),
+        }
+        accepted = []
+        cara_asyncio.register_interface(server, InheritAcceptor, {
+            'accept': accepted.append,
+        })
+        self.wait(InheritAcceptor(client).accept(inherit_iface))
+        self.wait(accepted[0].superMethod())
+        self.wait(accepted[0].inheritedMethod())
+        assert calls == ['super', 'inherited']
+
+    def test_remote_error(self):
+        server = self.create_server(self.endpoint())
+        client = self.create_client(self.endpoint())
+
+        @server.register_rpc
+        def fails():
+            raise ValueError('nope')
+
+        with self.assertRaises(cara_asyncio.RemoteError):
+            self.wait(client.fails())
+        with self.assertRaises(cara_asyncio.RemoteError):
+            self.wait(client.missing())
+
+
+class BootstrapTest(BaseAsyncioTest):
+
+    def test_not_by_name(self):
+        server = self.create_server(self.endpoint())
+        client = self.create_client(self.endpoint())
+        called = []
+
+        # BazIface.call would take over the 'call' rpc if it had a name.
+        @cara_asyncio.register_interface(server, by_name=False)
+        class BazIfaceImpl(BazIface):
+            def call(self, is_called):
+                called.append(is_called)
+
+        @cara_asyncio.register_interface(server, BarIface, by_name=False)
+        def returnCb():
+            return lambda is_called: called.append(is_called)
+        assert server.rpcs['call'] == server.handler.call
+
+        baz = cara_asyncio.RemoteInterfaceClient.Bootstrap(BazIface, client)
+        self.wait(baz.call(True))
+        bar = cara_asyncio.RemoteInterfaceClient.Bootstrap(BarIface, client)
+        self.wait(bar.returnCb().call(False))
+        assert called == [True, False]
+
+    def test_dispatch_table(self):
+        server = self.create_server(self.endpoint())
+        client = self.create_client(self.endpoint())
+        cara_asyncio.register_interface(server, InheritAcceptor, {
+            'accept': lambda iface: iface.superMethod(),
+        })
+        calls = []
+        self.wait(InheritAcceptor(client).accept({
+            'superMethod': lambda: calls.append('super'),
+        }))
+        assert calls == ['super']
+        local_ids = {key[0] for key in client.handler.dispatch}
+        assert local_ids == set(client.handler.objs)
+
+
+class LifetimeTest(BaseAsyncioTest):
+
+    def test_release(self):
+        server = self.create_server(self.endpoint())
+        client = self.create_client(self.endpoint())
+        called = []
+
+        @cara_asyncio.register_interface(server, BarIface)
+        def returnCb():
+            return lambda is_called: called.append(is_called)
+        cb = self.wait(BarIface(client).returnCb())
+        assert server.handler.Stats()['references'] == 1
+        self.wait(cb.call(True))
+        del cb
+        gc.collect()
+        self.wait(asyncio.sleep(0.01))
+        assert called == [True]
+        assert not server.handler.refs
+        assert server.handler.Stats()['released'] == 1
+
+    def test_export_ids_not_reused(self):
+        server = self.create_server(self.endpoint())
+        client = self.create_client(self.endpoint())
+        cb = lambda is_called: None
+
+        @cara_asyncio.register_interface(server, BarIface)
+        def returnCb():
+            return cb
+        first = self.wait(BarIface(client).returnCb())
+        second = self.wait(BarIface(client).returnCb())
+        assert first.remote_id != second.remote_id
+        assert server.handler.Stats()['references'] == 2
+
+    def test_ttl(self):
+        server = self.create_server(self.endpoint())
+        client = self.create_client(self.endpoint(), ttl=0.01)
+        accepted = []
+        cara_asyncio.register_interface(server, InheritAcceptor, {
+            'accept': accepted.append,
+        })
+        inherit_iface = {'superMethod': lambda: None}
+        self.wait(InheritAcceptor(client).accept(inherit_iface))
+        assert len(client.handler.objs) == 1
+        # The server never releases it, since it keeps the interface around.
+        self.wait(asyncio.sleep(0.05))
+        assert not client.handler.objs
+        assert client.handler.Stats()['expired'] == 1
+
+
+class BatchTest(BaseAsyncioTest):
+
+    def count_writes(self, connection):
+        writes = []
+        write = connection.writer.write
+
+        def counting_write(data):
+            writes.append(data)
+            write(data)
+        connection.writer.write = counting_write
+        return writes
+
+    def test_batched_calls(self):
+        server = self.create_server(self.endpoint())
+        client = self.create_client(self.endpoint(), batch=True)
+        server.register_rpc(lambda a, b: a + b, name='add')
+        server_writes = self.count_writes(next(iter(server.connections)))
+        client_writes = self.count_writes(client.connection)
+
+        results = self.wait(asyncio.gather(
+            *[client.add(i, 1) for i in range(10)]))
+        assert results == list(range(1, 11))
+        assert len(client_writes) == 1
+        assert len(server_writes) == 1
+
+    def test_max_batch(self):
+        server = self.create_server(self.endpoint())
+        client = self.create_client(
+            self.endpoint(), batch=True, max_batch=4)
+        server.register_rpc(lambda a: a, name='echo')
+        client_writes = self.count_writes(client.connection)
+
+        results = self.wait(asyncio.gather(
+            *[client.echo(i) for i in range(10)]))
+        assert results == list(range(10))
+        assert len(client_writes) == 3
+
+    def test_batch_with_async_handler(self):
+        server = self.create_server(self.endpoint())
+        client = self.create_client(self.endpoint(), batch=True)
+
+        async def slow(a):
+            await asyncio.sleep(0.01)
+            return a
+        server.register_rpc(slow, name='slow')
+        server.register_rpc(lambda a: a, name='fast')
+        results = self.wait(asyncio.gather(client.slow(1), client.fast(2)))
+        assert results == [1, 2]
+
+    def test_batched_interface_calls(self):
+        server = self.create_server(self.endpoint())
+        client = self.create_client(self.endpoint(), batch=True)
+        called = []
+
+        @cara_asyncio.register_interface(server, BarIface)
+        def returnCb():
+            return lambda is_called: called.append(is_called)
+        cb = self.wait(BarIface(client).returnCb())
+        self.wait(asyncio.gather(cb.call(True), cb.call(False)))
+        assert called == [True, False]
+
+
+class PoolTest(BaseAsyncioTest):
+
+    def create_replicas(self, count, balance=remote.LEAST_OUTSTANDING):
+        self.servers = []
+        clients = []
+        for i in range(count):
+            server = self.create_server(self.endpoint('server%d' % i))
+            server.register_rpc(lambda i=i: i, name='which')
+            self.servers.append(server)
+            clients.append(self.create_client(self.endpoint('server%d' % i)))
+        return remote.ClientPool(clients, balance=balance)
+
+    def test_round_robin(self):
+        pool = self.create_replicas(3, balance=remote.ROUND_ROBIN)
+        results = [self.wait(pool.which()) for _ in range(6)]
+        assert results == [0, 1, 2, 0, 1, 2]
+        assert pool.outstanding == [0, 0, 0]
+
+    def test_least_outstanding(self):
+        pool = self.create_replicas(2)
+        release = asyncio.Event()
+
+        async def wait():
+            await release.wait()
+        self.servers[0].register_rpc(wait, name='wait')
+        self.servers[1].register_rpc(wait, name='wait')
+        waiting = asyncio.ensure_future(pool.wait())
+        assert pool.outstanding == [1, 0]
+        # The first replica is busy, so everything else goes to the second.
+        results = [self.wait(pool.which()) for _ in range(3)]
+        assert results == [1, 1, 1]
+        release.set()
+        self.wait(waiting)
+        assert pool.outstanding == [0, 0]
+
+    def test_pinned_capabilities(self):
+        pool = self.create_replicas(3, balance=remote.ROUND_ROBIN)
+        called = []
+        for i, server in enumerate(self.servers):
+            cara_asyncio.register_interface(
+                server, BarIface,
+                lambda i=i: lambda is_called: called.append(i))
+        callbacks = [self.wait(BarIface(pool).returnCb()) for _ in range(3)]
+        for cb in reversed(callbacks):
+            self.wait(cb.call(True))
+        assert called == [2, 1, 0]
+
+    def test_pinned_pipelining(self):
+        pool = self.create_replicas(3, balance=remote.ROUND_ROBIN)
+        called = []
+        for i, server in enumerate(self.servers):
+            cara_asyncio.register_interface(
+                server, BarIface,
+                lambda i=i: lambda is_called: called.append(i),
+                by_name=False)
+        bar = cara_asyncio.RemoteInterfaceClient.Bootstrap(BarIface, pool)
+        for _ in range(3):
+            self.wait(bar.returnCb().call(True))
+        assert called == [0, 1, 2]
+        self.wait(asyncio.sleep(0.01))
+        assert not any(server.handler.answers for server in self.servers)
+
+    def test_bad_balance(self):
+        with self.assertRaises(ValueError):
+            remote.ClientPool([], balance='random')
+
+
+class WorkersTest(BaseAsyncioTest):
+
+    def setUp(self):
+        super().setUp()
+        self.server = cara_asyncio.setup_server(cara_asyncio.Server())
+        self.server.bind('tcp://127.0.0.1:0')
+        self.server.register_rpc(os.getpid, name='pid')
+        cara_asyncio.register_interface(self.server, ThreeIface, {
+            'returnIface': lambda: {
+                'normalMethod': lambda input: str(os.getpid())},
+            'acceptIface': lambda accept: None,
+        })
+        self.server.start_workers(2)
+
+    def tearDown(self):
+        self.server.stop_workers()
+        super().tearDown()
+
+    def test_workers(self):
+        host, port = self.server.addresses[0]
+        pids = set()
+        for _ in range(4):
+            client = self.create_client('tcp://%s:%d' % (host, port))
+            pid = self.wait(client.pid(), timeout=5)
+            assert pid in self.server.workers
+            pids.add(pid)
+            # Interfaces a worker exports are called in that worker.
+            iface = self.wait(ThreeIface(client).returnIface(), timeout=5)
+            worker = self.server.workers.index(pid) + 1
+            assert remote.ExportOwner(iface.remote_id) == worker
+            assert self.wait(iface.normalMethod('pid')) == str(pid)
+
+
+class OffloadTest(BaseAsyncioTest):
+
+    def setUp(self):
+        super().setUp()
+        self.server = self.create_server(self.endpoint())
+        self.client = self.create_client(self.endpoint())
+        self.executor = concurrent.futures.ThreadPoolExecutor(2)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        super().tearDown()
+
+    @staticmethod
+    def thread_name(input):
+        return threading.current_thread().name
+
+    def test_executor(self):
+        cara_asyncio.register_interface(
+            self.server, AddressBook, {
+                'find': lambda name: {
+                    'name': threading.current_thread().name},
+                'findUpdater': lambda name: None,
+            }, executor=self.executor)
+        person = self.wait(AddressBook(self.client).find('Bob'))
+        assert isinstance(person, Person)
+        assert person.name != threading.current_thread().name
+        stats = remote.GetOffload(self.executor).Stats()
+        assert stats['submitted'] == stats['completed'] == 1
+        assert stats['pending'] == 0
+
+    def test_per_method(self):
+        cara_asyncio.register_interface(
+            self.server, Blocking,
+            {'work': self.thread_name, 'inline': self.thread_name},
+            executor={'inline': self.executor})
+        main = threading.current_thread().name
+        # work is annotated with $Cara.executor("thread").
+        assert self.wait(Blocking(self.client).work('')) != main
+        assert self.wait(Blocking(self.client).inline('')) != main
+        assert remote.ExecutorStats()['thread']['submitted'] >= 1
+
+    def test_annotations(self):
+        main = threading.current_thread().name
+        cara_asyncio.register_interface(
+            self.server, Blocking,
+            {'work': self.thread_name, 'inline': self.thread_name},
+            by_name=False)
+        blocking = cara_asyncio.RemoteInterfaceClient.Bootstrap(
+            Blocking, self.client)
+        assert self.wait(blocking.work('')) != main
+        assert self.wait(blocking.inline('')) == main
+
+        cara_asyncio.register_interface(
+            self.server, AllBlocking, {'work': self.thread_name},
+            by_name=False)
+        all_blocking = cara_asyncio.RemoteInterfaceClient.Bootstrap(
+            AllBlocking, self.client)
+        assert self.wait(all_blocking.work('')) != main
+
+    def test_error(self):
+        def work(input):
+            raise ValueError(input)
+        cara_asyncio.register_interface(
+            self.server, Blocking, {'work': work, 'inline': work},
+            executor=self.executor)
+        with self.assertRaises(cara_asyncio.RemoteError):
+            self.wait(Blocking(self.client).work('nope'))
+        assert remote.GetOffload(self.executor).Stats()['failed'] == 1
+
+    def test_coroutine(self):
+        async def work(input):
+            return input
+        with self.assertRaises(TypeError):
+            cara_asyncio.register_interface(
+                self.server, Blocking, {'work': work, 'inline': work},
+                executor=self.executor)
+
+
+class LimitTest(BaseAsyncioTest):
+
+    def setUp(self):
+        super().setUp()
+        self.server = self.create_server(self.endpoint())
+        self.client = self.create_client(self.endpoint())
+        self.started = []
+        self.release = asyncio.Event()
+
+    def register(self, **kwargs):
+        async def work(input):
+            self.started.append(input)
+            await self.release.wait()
+            return input
+        cara_asyncio.register_interface(
+            self.server, Jobs, {'background': work, 'urgent': work}, **kwargs)
+
+    def send(self, *calls):
+        """Sends each call once the previous one got to the server."""
+        async def Send():
+            futures = []
+            for method, input in calls:
+                futures.append(asyncio.ensure_future(
+                    getattr(Jobs(self.client), method)(input)))
+                await asyncio.sleep(0.01)
+            return futures
+        return self.wait(Send())
+
+    def finish(self, futures):
+        self.release.set()
+        return self.wait(asyncio.gather(*futures, return_exceptions=True))
+
+    def test_queue(self):
+        limiter = remote.Limiter(1, max_queued=2)
+        self.register(limit=limiter)
+        futures = self.send(
+            ('background', 'a'), ('background', 'b'), ('background', 'c'))
+        assert self.started == ['a']
+        assert limiter.Stats()['in_flight'] == 1
+        assert limiter.Stats()['queued'] == 2
+        assert self.finish(futures) == ['a', 'b', 'c']
+        assert self.started == ['a', 'b', 'c']
+        assert limiter.Stats() == {
+            'in_flight': 0, 'queued': 0, 'most_queued': 2, 'admitted': 3,
+            'shed': 0, 'completed': 3}
+
+    def test_shed(self):
+        limiter = remote.Limiter(1)
+        self.register(limit=limiter)
+        futures = self.send(('background', 'a'), ('urgent', 'b'))
+        assert futures[1].done()
+        with self.assertRaisesRegex(cara_asyncio.RemoteError, 'Overloaded'):
+            futures[1].result()
+        assert self.finish(futures[:1]) == ['a']
+        assert limiter.Stats()['shed'] == 1
+
+    def test_priority(self):
+        limiter = remote.Limiter(1, max_queued=2)
+        self.register(limit=limiter)
+        futures = self.send(
+            ('background', 'a'), ('background', 'b'), ('background', 'c'),
+            ('urgent', 'd'))
+        # urgent has $Cara.priority(10), so it pushed out the newest waiting
+        # background call and runs before the rest.
+        assert futures[2].done()
+        results = self.finish(futures)
+        assert self.started == ['a', 'd', 'b']
+        assert results[:2] == ['a', 'b'] and results[3] == 'd'
+        assert isinstance(results[2], cara_asyncio.RemoteError)
+        assert limiter.Stats()['shed'] == 1
+
+    def test_per_method(self):
+        self.register(limit={'background': 1}, priority={'urgent': 0})
+        futures = self.send(
+            ('background', 'a'), ('urgent', 'b'), ('urgent', 'c'))
+        assert self.started == ['a', 'b', 'c']
+        assert 'Jobs.urgent' not in remote.LimiterStats()
+        assert remote.LimiterStats()['Jobs.background']['in_flight'] == 1
+        assert self.finish(futures) == ['a', 'b', 'c']
+
+    def test_executor(self):
+        executor = concurrent.futures.ThreadPoolExecutor(2)
+        self.addCleanup(executor.shutdown)
+        event = threading.Event()
+        cara_asyncio.register_interface(
+            self.server, Blocking,
+            {'work': lambda input: event.wait(1) and input,
+             'inline': lambda input: input},
+            executor=executor, limit={'work': remote.Limiter(1, 1)})
+        futures = [Blocking(self.client).work(str(i)) for i in range(3)]
+        with self.assertRaises(cara_asyncio.RemoteError):
+            self.wait(futures[2])
+        assert remote.GetOffload(executor).Stats()['pending'] == 1
+        event.set()
+        assert self.wait(asyncio.gather(*futures[:2])) == ['0', '1']
+
+
+class StreamTest(BaseAsyncioTest):
+
+    def setUp(self):
+        super().setUp()
+        self.server = self.create_server(self.endpoint())
+        self.client = self.create_client(self.endpoint())
+        self.produced = []
+        self.closed = []
+
+    def register(self, people=None, numbers=None):
+        cara_asyncio.register_interface(
+            self.server, Feed, {'people': people, 'numbers': numbers},
+            by_name=False)
+        return cara_asyncio.RemoteInterfaceClient.Bootstrap(Feed, self.client)
+
+    def collect(self, stream, limit=None):
+        async def Collect():
+            elements = []
+            async for element in stream:
+                elements.append(element)
+                if len(elements) == limit:
+                    await stream.aclose()
+                    break
+            return elements
+        return self.wait(Collect())
+
+    def numbers(self, count):
+        try:
+            for i in range(count):
+                self.produced.append(i)
+                yield i
+        finally:
+            self.closed.append(True)
+
+    def test_local(self):
+        feed = Feed({'numbers': self.numbers})
+        numbers = feed.numbers(3)
+        assert not self.produced
+        assert next(numbers) == 0
+        assert self.produced == [0]
+        assert list(numbers) == [1, 2]
+        assert self.closed == [True]
+
+    def test_generator(self):
+        feed = self.register(numbers=self.numbers)
+        count = remote.STREAM_CREDIT * 3 + 1
+        assert self.collect(feed.numbers(count)) == list(range(count))
+        assert self.closed == [True]
+        self.wait(asyncio.sleep(0.01))
+        assert not self.server.handler.streams
+
+    def test_flow_control(self):
+        feed = self.register(numbers=self.numbers)
+        stream = feed.numbers(1000)
+        self.wait(stream.__anext__())
+        self.wait(asyncio.sleep(0.01))
+        # One chunk was sent and the next one is ready, nothing more.
+        assert len(self.produced) == remote.STREAM_CREDIT * 2
+
+    def test_converted(self):
+        async def people(count):
+            for i in range(count):
+                await asyncio.sleep(0)
+                yield {'name': str(i)}
+        feed = self.register(people=people)
+        people = self.collect(feed.people(3))
+        assert all(isinstance(person, Person) for person in people)
+        assert [person.name for person in people] == ['0', '1', '2']
+
+    def test_async_chunks(self):
+        release = asyncio.Event()
+
+        async def numbers(count):
+            yield 1
+            await release.wait()
+            yield 2
+        feed = self.register(numbers=numbers)
+        stream = feed.numbers(2)
+        # The first element isn't held back waiting for the rest of a chunk.
+        assert self.wait(stream.__anext__()) == 1
+        release.set()
+        assert self.wait(stream.__anext__()) == 2
+
+    def test_cancel(self):
+        feed = self.register(numbers=self.numbers)
+        assert self.collect(feed.numbers(1000), limit=3) == [0, 1, 2]
+        self.wait(asyncio.sleep(0.01))
+        assert self.closed == [True]
+        assert not self.server.handler.streams
+
+    def test_error(self):
+        def numbers(count):
+            yield 1
+            raise ValueError('nope')
+        feed = self.register(numbers=numbers)
+        with self.assertRaises(cara_asyncio.RemoteError):
+            self.collect(feed.numbers(2))
+        assert not self.server.handler.streams
+
+
+class PipeliningTest(BaseAsyncioTest):
+
+    def setUp(self):
+        super().setUp()
+        self.server = self.create_server(self.endpoint())
+        self.client = self.create_client(self.endpoint())
+        self.found = asyncio.Event()
+        self.deleted = []
+        test = self
+
+        class Updater(Person.UpdatePerson):
+            def __init__(self, name):
+                self.name = name
+
+            def rename(self, name):
+                return {'name': name, 'updater': Updater(name)}
+
+            def delete(self):
+                test.deleted.append(self.name)
+
+        class AddressBookImpl(AddressBook):
+            async def find(self, name):
+                await test.found.wait()
+                return {'name': name, 'updater': Updater(name)}
+
+            def findUpdater(self, name):
+                return Updater(name)
+
+        # Pipelining starts from interfaces that came over the wire.
+        cara_asyncio.register_interface(
+            self.server, Directory, lambda: AddressBookImpl())
+        self.book = self.wait(Directory(self.client).addressBook())
+
+    def test_pipelined_call(self):
+        person = self.book.find('Bob')
+        deleted = asyncio.ensure_future(person.updater.delete())
+        self.wait(asyncio.sleep(0.01))
+        # The delete is waiting on the server, not on the client.
+        assert not self.deleted
+        assert len(self.server.handler.answers) == 1
+        self.found.set()
+        self.wait(deleted)
+        assert self.deleted == ['Bob']
+        assert self.wait(person).name == 'Bob'
+        self.wait(asyncio.sleep(0.01))
+        assert not self.server.handler.answers
+
+    def test_pipelined_chain(self):
+        updater = self.book.findUpdater('Bob')
+        renamed = updater.rename('Alice')
+        self.wait(renamed.updater.delete())
+        assert self.deleted == ['Alice']
+        assert self.wait(renamed.name) == 'Alice'
+        assert isinstance(self.wait(updater), remote.RemoteInterfaceClient)
+        self.wait(asyncio.sleep(0.01))
+        assert not self.server.handler.answers
+
+    def test_resolved_promise(self):
+        self.found.set()
+        person = self.book.find('Bob')
+        assert self.wait(person).name == 'Bob'
+        # Calls on an arrived result go straight to the interface in it.
+        self.wait(person.updater.delete())
+        assert self.deleted == ['Bob']
+
+    def test_bad_pipeline(self):
+        person = self.book.find('Bob')
+        with self.assertRaises(AttributeError):
+            person.age
+        with self.assertRaises(AttributeError):
+            person.name.upper
+        self.found.set()
+        self.wait(person)
+
+
+class ProxyTest(BaseAsyncioTest):
+
+    class ThreeIfaceImpl(ThreeIface):
+        def __init__(self):
+            self._last = None
+
+        def returnIface(self):
+            return self._last
+
+        def acceptIface(self, accept):
+            self._last = accept
+
+    def test_three_parties(self):
+        # B sends an interface to A, then C gets it from A and calls it, which
+        # proxies through A to B.
+        server_a = self.create_server(self.endpoint())
+        client_b = self.create_client(self.endpoint())
+        client_c = self.create_client(self.endpoint())
+        cara_asyncio.register_interface(
+            server_a, ThreeIface, self.ThreeIfaceImpl())
+
+        self.wait(ThreeIface(client_b).acceptIface(
+            {'normalMethod': lambda input: 'output'}))
+        iface_from_b = self.wait(ThreeIface(client_c).returnIface())
+        assert self.wait(iface_from_b.normalMethod('input')) == 'output'
+
+
+class CodecTest(BaseAsyncioTest):
+
+    def setUp(self):
+        super().setUp()
+        self.encoded = []
+
+    def create_server(self, endpoint, **kwargs):
+        server = super().create_server(endpoint, **kwargs)
+        call_encoded = server.rpcs['call_encoded']
+
+        def counting_call_encoded(*args):
+            self.encoded.append(args[3])
+            return call_encoded(*args)
+        server.rpcs['call_encoded'] = counting_call_encoded
+        return server
+
+    def test_negotiate(self):
+        self.create_server(self.endpoint(), codecs=['json', 'cbor'])
+        client = self.create_client(
+            self.endpoint(), codecs=['nope', 'cbor', 'json'])
+        assert client.connection.codec.name == 'cbor'
+        client = self.create_client(self.endpoint(), codecs=['msgpack'])
+        assert client.connection.codec is None
+        client = self.create_client(self.endpoint())
+        assert client.connection.codec is None
+
+    def test_encoded_calls(self):
+        server = self.create_server(self.endpoint())
+
+        async def background(input):
+            return input + '!'
+        cara_asyncio.register_interface(
+            server, Jobs, {'background': background, 'urgent': str.upper},
+            by_name=False)
+        for name in codec.codecs:
+            client = self.create_client(self.endpoint(), codecs=[name])
+            jobs = cara_asyncio.RemoteInterfaceClient.Bootstrap(Jobs, client)
+            assert self.wait(jobs.background('a')) == 'a!'
+            assert self.wait(jobs.urgent(input='b')) == 'B'
+            assert self.encoded[-2:] == [name, name]
+
+    def test_interfaces_not_encoded(self):
+        server = self.create_server(self.endpoint())
+        client = self.create_client(self.endpoint(), codecs=['cbor'])
+
+        @cara_asyncio.register_interface(server)
+        class AddressBookImpl(AddressBook):
+            def find(self, name):
+                return {'name': name}
+
+            def findUpdater(self, name):
+                return None
+
+        book = cara_asyncio.RemoteInterfaceClient.Bootstrap(
+            AddressBook, client)
+        assert self.wait(book.find('Bob')).name == 'Bob'
+        assert self.encoded == []
+
+    def test_remote_error(self):
+        server = self.create_server(self.endpoint())
+        client = self.create_client(self.endpoint(), codecs=['msgpack'])
+
+        def urgent(input):
+            raise ValueError(input)
+        cara_asyncio.register_interface(
+            server, Jobs, {'background': str, 'urgent': urgent},
+            by_name=False)
+        jobs = cara_asyncio.RemoteInterfaceClient.Bootstrap(Jobs, client)
+        with self.assertRaisesRegex(cara_asyncio.RemoteError, 'oops'):
+            self.wait(jobs.urgent('oops'))
+        assert self.encoded == ['msgpack']
@@ -0,0 +1,140 @@
+import asyncio
+import unittest
+
+from cara import cara_loopback
+from tests.cara_asyncio_test_capnp import AddressBook, Directory, Person
+from tests.cara_pseud_test_capnp import BarIface, FooIface, ThreeIface
+
+
+class LoopbackTest(unittest.TestCase):
+    encode = True
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = cara_loopback.setup_server(cara_loopback.Server())
+        self.server.bind('server')
+        self.wait(self.server.start())
+        self.client = cara_loopback.setup_client(
+            cara_loopback.Client(encode=self.encode))
+        self.client.connect('server')
+        self.wait(self.client.start())
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+        self.wait(asyncio.sleep(0))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def wait(self, coro, timeout=1):
+        return self.loop.run_until_complete(asyncio.wait_for(coro, timeout))
+
+    def test_simple(self):
+        self.server.register_rpc(lambda a, b: a + b, name='add')
+        assert self.wait(self.client.add(1, b=2)) == 3
+
+    def test_call_client_cb(self):
+        called = []
+
+        @cara_loopback.register_interface(self.server, FooIface)
+        def calls_cb(foo):
+            return foo.callback()
+
+        self.wait(self.client.callback(FooIface(lambda: called.append(True))))
+        assert called == [True]
+
+    def test_call_server_cb(self):
+        called = []
+
+        @cara_loopback.register_interface(self.server, BarIface)
+        def returnCb():
+            return lambda is_called: called.append(is_called)
+        cb = self.wait(BarIface(self.client).returnCb())
+        self.wait(cb.call(True))
+        assert called == [True]
+
+    def test_pipelining(self):
+        deleted = []
+
+        class Updater(Person.UpdatePerson):
+            def rename(self, name):
+                raise NotImplementedError
+
+            def delete(self):
+                deleted.append(True)
+
+        class AddressBookImpl(AddressBook):
+            def find(self, name):
+                return {'name': name, 'updater': Updater()}
+
+            def findUpdater(self, name):
+                return Updater()
+
+        cara_loopback.register_interface(
+            self.server, Directory, lambda: AddressBookImpl())
+        book = self.wait(Directory(self.client).addressBook())
+        self.wait(book.find('Bob').updater.delete())
+        assert deleted == [True]
+
+    def test_proxy(self):
+        class ThreeIfaceImpl(ThreeIface):
+            def returnIface(self):
+                return self.last
+
+            def acceptIface(self, accept):
+                self.last = accept
+
+        cara_loopback.register_interface(
+            self.server, ThreeIface, ThreeIfaceImpl())
+        self.wait(ThreeIface(self.client).acceptIface(
+            {'normalMethod': lambda input: input + 'put'}))
+        iface = self.wait(ThreeIface(self.client).returnIface())
+        assert self.wait(iface.normalMethod('in')) == 'input'
+
+    def test_remote_error(self):
+        with self.assertRaises(cara_loopback.RemoteError):
+            self.wait(self.client.missing())
+
+    def test_close(self):
+        self.server.register_rpc(
+            lambda: asyncio.sleep(0.01), name='slow')
+        call = asyncio.ensure_future(self.client.slow())
+        self.wait(asyncio.sleep(0))
+        self.server.close()
+        with self.assertRaises(ConnectionError):
+            self.wait(call)
+        # Its response goes nowhere.
+        self.wait(asyncio.sleep(0.02))
+
+
+class UnencodedLoopbackTest(LoopbackTest):
+    encode = False
+
+
+class EndpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_refused(self):
+        client = cara_loopback.setup_client(
+            cara_loopback.Client(loop=self.loop))
+        client.connect('nowhere')
+        with self.assertRaises(ConnectionRefusedError):
+            self.loop.run_until_complete(client.start())
+
+    def test_already_bound(self):
+        first = cara_loopback.Server(loop=self.loop)
+        first.bind('taken')
+        self.loop.run_until_complete(first.start())
+        second = cara_loopback.Server(loop=self.loop)
+        second.bind('taken')
+        with self.assertRaises(OSError):
+            self.loop.run_until_complete(second.start())
+        first.close()
+        self.loop.run_until_complete(second.start())
+        second.close()
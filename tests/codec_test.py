@@ -0,0 +1,134 @@
+import json
+import unittest
+
+import cara
+from cara import codec
+from cara import remote
+from tests.basics_capnp import Basic, SemiAdvanced
+from tests.cara_asyncio_test_capnp import Person
+
+BASIC = {'field': 1, 'list': [{'field': 2}, {'field': 3, 'ints': [4]}],
+         'ints': [5, 6, 7], 'nested': {'nested': {'field': 8}}}
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for name, encoding in codec.codecs.items():
+            with self.subTest(codec=name):
+                value = Basic(BASIC)
+                decoded = encoding.Decode(Basic, encoding.Encode(Basic, value))
+                assert isinstance(decoded, Basic)
+                assert decoded == value
+                assert decoded.list[1].ints == [4]
+
+    def test_unions_and_data(self):
+        value = SemiAdvanced({'namedGroup': {'first': 'a'},
+                              'namedUnion': {'that': 2},
+                              'unionField': b'\x00\xff'})
+        for name, encoding in codec.codecs.items():
+            with self.subTest(codec=name):
+                decoded = encoding.Decode(
+                    SemiAdvanced, encoding.Encode(SemiAdvanced, value))
+                assert decoded.unionField == b'\x00\xff'
+                assert decoded.namedUnion.that == 2
+                assert 'unnamed' not in decoded
+
+    def test_layouts(self):
+        value = Basic({'field': 1, 'ints': [2]})
+        assert codec.GetCodec('msgpack').ToTree(Basic, value) == {
+            0: 1, 3: [2]}
+        assert codec.GetCodec('msgpack-positional').ToTree(Basic, value) == [
+            1, None, None, [2]]
+        assert json.loads(codec.GetCodec('json').Encode(Basic, value)) == {
+            'field': 1, 'ints': [2]}
+
+    def test_void(self):
+        union = cara.Struct('VoidUnion', 0x5678)
+        union.FinishDeclaration(fields=[cara.Union(fields=[
+            cara.Field(id=0, name='none', type=cara.Void, discriminant=0),
+            cara.Field(id=1, name='some', type=cara.Int32, discriminant=1),
+        ])])
+        value = union({'none': None})
+        method = cara.Method(id=0, name='voids', params=[], results=[
+            cara.Param(id=0, name='none', type=cara.Void),
+            cara.Param(id=1, name='some', type=cara.Int32)])
+        for name, encoding in codec.codecs.items():
+            with self.subTest(codec=name):
+                decoded = encoding.Decode(union, encoding.Encode(union, value))
+                assert decoded == value and 'none' in decoded
+                data = remote._EncodeResult(encoding, method, {'none': None})
+                assert remote._DecodeResult(encoding, method, data) == {
+                    'none': None}
+
+    def test_positional_is_smaller(self):
+        ids = codec.GetCodec('msgpack').Encode(Basic, Basic(BASIC))
+        positions = codec.GetCodec('msgpack-positional').Encode(
+            Basic, Basic(BASIC))
+        assert len(positions) < len(ids)
+
+    def test_many(self):
+        encoding = codec.GetCodec('cbor')
+        data = encoding.EncodeMany([Basic, Basic.__fields__['ints'].type],
+                                   [{'field': 1}, [2, 3]])
+        assert encoding.DecodeMany(
+            [Basic, Basic.__fields__['ints'].type], data) == [
+                Basic({'field': 1}), [2, 3]]
+
+    def test_encodable(self):
+        assert codec.Encodable(Basic)
+        # Person has an interface field.
+        assert not codec.Encodable(Person)
+
+        class Updater(Person.UpdatePerson):
+            pass
+        with self.assertRaisesRegex(TypeError, 'Cannot encode UpdatePerson'):
+            codec.GetCodec('json').Encode(Person, {'updater': Updater()})
+
+    def test_negotiate(self):
+        assert codec.Negotiate(['nope', 'cbor', 'json']) == 'cbor'
+        assert codec.Negotiate(['cbor', 'json'], ['json']) == 'json'
+        assert codec.Negotiate(['cbor'], []) is None
+        assert codec.Negotiate(None) is None
+        with self.assertRaises(LookupError):
+            codec.GetCodec('nope')
+
+
+class CborTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cbor = codec.GetCodec('cbor')
+
+    def test_rfc_examples(self):
+        # From RFC 8949, appendix A.
+        examples = [
+            (0, '00'), (23, '17'), (24, '1818'), (1000000, '1a000f4240'),
+            (18446744073709551615, '1bffffffffffffffff'), (-1, '20'),
+            (-1000, '3903e7'), (1.1, 'fb3ff199999999999a'), (False, 'f4'),
+            (True, 'f5'), (None, 'f6'), (b'\x01\x02', '420102'),
+            ('ü', '62c3bc'), ([1, [2, 3]], '8201820203'),
+            ({1: 2, 3: 4}, 'a201020304'), ({'a': [1]}, 'a161618101'),
+        ]
+        for value, encoded in examples:
+            with self.subTest(value=value):
+                assert self.cbor.Dump(value).hex() == encoded
+                assert self.cbor.Load(bytes.fromhex(encoded)) == value
+
+    def test_load_only(self):
+        # Half and single precision floats, and a tagged value.
+        assert self.cbor.Load(bytes.fromhex('f93e00')) == 1.5
+        assert self.cbor.Load(bytes.fromhex('fa47c35000')) == 100000.0
+        assert self.cbor.Load(bytes.fromhex('c11a514b67b0')) == 1363896240
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            self.cbor.Load(bytes.fromhex('8201'))
+        with self.assertRaises(ValueError):
+            self.cbor.Load(bytes.fromhex('0000'))
+        with self.assertRaises(ValueError):
+            # Indefinite length array.
+            self.cbor.Load(bytes.fromhex('9f01ff'))
+        with self.assertRaises(ValueError):
+            self.cbor.Dump(1 << 64)
+        with self.assertRaises(TypeError):
+            self.cbor.Dump(object())
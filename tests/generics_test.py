@@ -1,3 +1,5 @@
+import concurrent.futures
+import threading
 import unittest
 
 import cara
@@ -43,3 +45,40 @@ class GenericsTest(unittest.TestCase):
             instance.__methods__['templated'], cara.TemplatedMethod)
         instance.templated[cara.Text]("text")
         assert inputs[-1] == "text"
+
+    def test_concurrent_instantiation(self):
+        value = cara.Struct('Value', 0x1234)
+        value.FinishDeclaration(fields=[])
+        barrier = threading.Barrier(8)
+
+        def Instantiate(_):
+            barrier.wait()
+            struct = GenericStruct[value]
+            # Only published finished.
+            return struct, struct.__fields__['list'].type
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            results = set(executor.map(Instantiate, range(8)))
+        assert len(results) == 1
+        (struct, list_type), = results
+        assert struct is GenericStruct[value]
+        assert list_type.sub_type is struct
+
+    def test_concurrent_dependent_instantiations(self):
+        value = cara.Struct('Value', 0x1234)
+        value.FinishDeclaration(fields=[])
+        barrier = threading.Barrier(8)
+
+        def Instantiate(i):
+            barrier.wait()
+            if i % 2:
+                # Instantiates GenericStruct[value] along the way.
+                nested = GenericStruct[value].Nested[value]
+                return nested.__fields__['second'].type
+            return GenericStruct[value]
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(Instantiate, range(8)))
+        # The nested ones refer to the same one everyone else got.
+        struct = GenericStruct[value]
+        assert all(result is struct for result in results)
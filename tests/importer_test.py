@@ -0,0 +1,74 @@
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from cara import importer
+
+SCHEMA = b'''\
+@0xdeadbeef00110002;
+using Basics = import "basics.capnp";
+using Cara = import "/capnp/cara.capnp";
+struct Outer { basic @0 :Basics.Basic; }
+'''
+
+
+class ImporterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.write('outer.capnp', SCHEMA)
+        self.write('basics.capnp', b'@0xdeadbeef00110003;')
+        self.compiler = importer.Compiler(
+            cache_dir=os.path.join(self.tmpdir, 'cache'))
+
+    def write(self, filename, contents):
+        with open(os.path.join(self.tmpdir, filename), 'wb') as file:
+            file.write(contents)
+
+    def test_module_name(self):
+        assert importer.ModuleName('/capnp/c++.capnp') == 'cxx_capnp'
+        assert importer.ModuleName('rpc-twoparty.capnp') == (
+            'rpc_twoparty_capnp')
+        assert importer.ModuleName('1st.capnp') == 'V1st_capnp'
+
+    def test_key(self):
+        outer = os.path.join(self.tmpdir, 'outer.capnp')
+        key = self.compiler.Key(outer)
+        assert self.compiler.Key(outer) == key
+        # Changing what it imports changes it.
+        self.write('basics.capnp', b'@0xdeadbeef00110004;')
+        assert self.compiler.Key(outer) != key
+        self.write('basics.capnp', b'using Missing = import "/missing.capnp";')
+        with self.assertRaisesRegex(ImportError, 'missing.capnp'):
+            self.compiler.Key(outer)
+
+    def test_finds_cached(self):
+        # As if it had been compiled before.
+        key = self.compiler.Key(os.path.join(self.tmpdir, 'outer.capnp'))
+        os.makedirs(os.path.join(self.compiler.cache_dir, key))
+        with open(os.path.join(self.compiler.cache_dir, key,
+                               'outer_capnp.py'), 'w') as module:
+            module.write('OUTER = 1\n')
+        finder = importer.Install(cache_dir=self.compiler.cache_dir)
+        self.addCleanup(sys.meta_path.remove, finder)
+        sys.path.insert(0, self.tmpdir)
+        self.addCleanup(sys.path.remove, self.tmpdir)
+        self.addCleanup(sys.modules.pop, 'outer_capnp', None)
+        assert importlib.import_module('outer_capnp').OUTER == 1
+        with self.assertRaises(ImportError):
+            importlib.import_module('inner_capnp')
+
+    @unittest.skipUnless(
+        shutil.which('capnp') and os.path.exists(importer.DefaultGenerator()),
+        'needs capnp and capnpc-cara')
+    def test_compile(self):
+        outputs = self.compiler.CompileAll([self.tmpdir], jobs=2)
+        output = outputs[os.path.join(self.tmpdir, 'outer.capnp')]
+        with open(output) as module:
+            assert 'Outer = cara.Struct' in module.read()
+        assert self.compiler.Compile(
+            os.path.join(self.tmpdir, 'outer.capnp')) == output
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import unittest
+
+from cara import cara_asyncio
+from cara import instrumentation
+from cara import remote
+from tests.basics_capnp import SimpleInterface
+from tests.cara_pseud_test_capnp import Inherit
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.recorder = instrumentation.Enable()
+        self.addCleanup(instrumentation.Disable)
+
+    @staticmethod
+    def struct_out(input):
+        return {'field': input}
+
+    def simple(self):
+        return SimpleInterface({'structOut': self.struct_out, 'structIn': None})
+
+    def test_disabled(self):
+        instrumentation.Disable()
+        self.simple().structOut(1)
+        assert instrumentation.Snapshot() == {}
+
+    def test_phases(self):
+        iface = SimpleInterface({
+            'structOut': self.struct_out,
+            'structIn': lambda basic: basic.field})
+        assert iface.structOut(3).field == 3
+        assert iface.structIn(field=4) == 4
+        phases = instrumentation.Snapshot()[('SimpleInterface', 'structOut')]
+        assert sorted(phases) == ['handler', 'params', 'results']
+        assert phases['handler']['count'] == 1
+        assert phases['handler']['errors'] == 0
+        assert sum(phases['results']['buckets'].values()) == 1
+
+    def test_error(self):
+        def fail(input):
+            raise ValueError(input)
+        iface = SimpleInterface({'structOut': fail, 'structIn': None})
+        with self.assertRaises(ValueError):
+            iface.structOut(1)
+        phases = instrumentation.Snapshot()[('SimpleInterface', 'structOut')]
+        assert phases['handler']['errors'] == 1
+        assert 'results' not in phases
+
+    def test_coroutine(self):
+        async def structOut(input):
+            await asyncio.sleep(0.002)
+            return self.struct_out(input)
+        iface = SimpleInterface({'structOut': structOut, 'structIn': None})
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        assert loop.run_until_complete(iface.structOut(2)).field == 2
+        handler = self.recorder.methods[('SimpleInterface', 'structOut')][
+            'handler']
+        assert handler.count == 1
+        assert handler.total >= 0.002
+        assert handler.Percentile(50) >= 0.002
+
+    def test_registered_future(self):
+        # Registers its futures for conversion.
+        cara_asyncio.setup_client(cara_asyncio.Client())
+
+        async def call():
+            future = cara_asyncio.PendingCall()
+            iface = SimpleInterface({
+                'structOut': lambda input: future, 'structIn': None})
+            result = iface.structOut(2)
+            # As the backend does when the response arrives.
+            future.set_result(future.convert({'field': 2}))
+            return await result
+        timed = asyncio.run(call())
+        instrumentation.Disable()
+        untimed = asyncio.run(call())
+        assert type(timed) is type(untimed) is type(self.simple().structOut(2))
+        assert timed == untimed
+        handler = self.recorder.methods[('SimpleInterface', 'structOut')][
+            'handler']
+        assert handler.count == 1
+
+    def test_declaring_interface(self):
+        class Impl(Inherit):
+            def superMethod(self):
+                pass
+
+            def third(self):
+                pass
+        Impl().superMethod()
+        Impl().third()
+        assert sorted(instrumentation.Snapshot()) == [
+            ('Inherit', 'third'), ('Super', 'superMethod')]
+
+    def test_server_call(self):
+        handler = remote.RemoteInterfaceServer()
+        local_id = handler.export(self.simple())
+        handler.call(local_id, SimpleInterface.id, 0, [5], {})
+        phases = instrumentation.Snapshot()[('SimpleInterface', 'structOut')]
+        assert phases['call']['count'] == 1
+        assert phases['call']['total'] >= phases['handler']['total']
+
+    def test_export(self):
+        exported = []
+        instrumentation.AddExporter(exported.append)
+        self.addCleanup(instrumentation.exporters.remove, exported.append)
+        self.simple().structOut(1)
+        with self.assertLogs(instrumentation.__name__, logging.INFO) as logs:
+            instrumentation.LoggingExporter()(instrumentation.Export(
+                reset=True))
+        assert len(exported) == 1
+        assert ('SimpleInterface', 'structOut') in exported[0]
+        assert 'SimpleInterface.structOut handler: 1 calls' in logs.output[0]
+        assert instrumentation.Snapshot() == {}
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_percentile(self):
+        histogram = instrumentation.Histogram()
+        assert histogram.Percentile(50) == 0.0
+        for _ in range(99):
+            histogram.Add(0.000003)
+        histogram.Add(1.5)
+        assert histogram.Percentile(50) == 4e-06
+        assert histogram.Percentile(100) == (1 << 21) / 1e6
+        assert histogram.ToDict()['buckets'] == {4: 99, 1 << 21: 1}
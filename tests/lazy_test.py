@@ -0,0 +1,76 @@
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import textwrap
+import unittest
+
+from cara import cara
+
+# What capnpc-cara generates with CARA_LAZY_MODULES=1, for a schema importing
+# basics.capnp.
+LAZY_MODULE = textwrap.dedent('''\
+    from cara import cara
+    from cara import lazy
+
+
+    def _load():
+      from cara.capnp import cara_capnp
+      from tests import basics_capnp
+      # Forward declarations:
+      Outer = cara.Struct(name="Outer", id=0x1a2b, qualname="lazy_capnp.Outer")
+      Outer.Inner = cara.Struct(name="Inner", id=0x1a2c, qualname="lazy_capnp.Outer.Inner")
+
+      # Finishing declarations:
+      Outer.FinishDeclaration(fields=[cara.Field(id=0, name="basic", type=basics_capnp.Basic, offset=0)], annotations=[cara_capnp.registerGlobally(cara.Void())], data_words=0, pointer_words=1)
+      Outer.Inner.FinishDeclaration(fields=[cara.Field(id=0, name="outer", type=Outer, offset=0)], data_words=0, pointer_words=1)
+
+      __annotations__ = []
+      return locals()
+
+
+    __all__ = ["Outer"]
+    lazy.Module(__name__, _load, registered=[0x1a2b])
+    ''')
+
+
+class LazyTest(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with open(os.path.join(tmpdir, 'lazy_capnp.py'), 'w') as module:
+            module.write(LAZY_MODULE)
+        sys.path.insert(0, tmpdir)
+        self.addCleanup(sys.path.remove, tmpdir)
+        self.addCleanup(sys.modules.pop, 'lazy_capnp', None)
+        self.addCleanup(cara.GlobalTypeRegistry.pop, 0x1a2b, None)
+        self.addCleanup(cara.GlobalTypeRegistry.deferred.pop, 0x1a2b, None)
+
+    def test_loads_on_first_use(self):
+        lazy_capnp = importlib.import_module('lazy_capnp')
+        assert 'Outer' not in vars(lazy_capnp)
+        assert lazy_capnp.Outer.Inner.__fields__['outer'].type is (
+            lazy_capnp.Outer)
+        assert 'Outer' in vars(lazy_capnp)
+        assert lazy_capnp.__annotations__ == []
+        with self.assertRaises(AttributeError):
+            lazy_capnp.Nope
+
+    def test_from_import(self):
+        from lazy_capnp import Outer
+        assert Outer({'basic': {'field': 1}}).basic.field == 1
+        assert 'Outer' in dir(sys.modules['lazy_capnp'])
+
+    def test_import_star(self):
+        namespace = {}
+        exec('from lazy_capnp import *', namespace)
+        assert namespace['Outer'] is sys.modules['lazy_capnp'].Outer
+
+    def test_registry(self):
+        lazy_capnp = importlib.import_module('lazy_capnp')
+        assert 0x1a2b in cara.GlobalTypeRegistry
+        assert 'Outer' not in vars(lazy_capnp)
+        assert cara.GlobalTypeRegistry[0x1a2b] is lazy_capnp.Outer
+        assert cara.GlobalTypeRegistry.get(0x1a2c) is None
@@ -0,0 +1,88 @@
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import cara
+from cara import loadgen
+from tests import basics_capnp, cara_asyncio_test_capnp
+from tests.basics_capnp import Basic, SemiAdvanced, SimpleInterface
+
+
+class SynthesizeTest(unittest.TestCase):
+
+    def test_struct(self):
+        value = loadgen.Synthesize(Basic, list_size=2)
+        assert value['field'] == 1
+        assert value['ints'] == [1, 1]
+        assert len(value['list']) == 2
+        # Nesting stops at the depth.
+        assert value['nested']['nested'] == {'field': 1}
+        Basic(value)
+
+    def test_union(self):
+        value = loadgen.Synthesize(SemiAdvanced)
+        assert 'unnamed' in value and 'unionField' not in value
+        assert len(value['namedUnion']) == 1
+        SemiAdvanced(value)
+
+    def test_void_union(self):
+        union = cara.Struct('VoidUnion', 0x5678)
+        union.FinishDeclaration(fields=[cara.Union(fields=[
+            cara.Field(id=0, name='none', type=cara.Void, discriminant=0),
+            cara.Field(id=1, name='some', type=cara.Int32, discriminant=1),
+        ])])
+        value = loadgen.Synthesize(union)
+        assert value == {'none': None}
+        assert 'none' in union(value)
+
+    def test_params(self):
+        _, method = SimpleInterface._get_method('structOut')
+        assert loadgen.SynthesizeParams(method) == {'input': 1}
+        _, method = SimpleInterface._get_method('structIn')
+        assert loadgen.SynthesizeParams(method)['field'] == 1
+
+    def test_find_method(self):
+        assert loadgen.FindMethod(basics_capnp, 'SimpleInterface.structIn') == (
+            SimpleInterface, 'structIn')
+        interface, _ = loadgen.FindMethod(
+            cara_asyncio_test_capnp, 'Person.UpdatePerson.rename')
+        assert interface is cara_asyncio_test_capnp.Person.UpdatePerson
+        with self.assertRaises(ValueError):
+            loadgen.FindMethod(basics_capnp, 'SimpleInterface.nope')
+
+
+class LoadgenTest(unittest.TestCase):
+
+    def run_main(self, *argv):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            status = loadgen.main(list(argv) + ['--json'])
+        return status, json.loads(output.getvalue())
+
+    def test_percentile(self):
+        latencies = list(range(1, 1001))
+        assert loadgen.Percentile(latencies, 50) == 500
+        assert loadgen.Percentile(latencies, 99.9) == 999
+        assert loadgen.Percentile([], 50) == 0.0
+
+    def test_echo(self):
+        status, report = self.run_main('--clients', '3', '--requests', '50')
+        assert status == 0
+        assert report['requests'] == 50 and report['errors'] == 0
+        assert report['p50'] <= report['p99'] <= report['max']
+        assert report['throughput'] > 0
+
+    def test_echo_asyncio(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        endpoint = 'unix://' + os.path.join(tmpdir, 'echo')
+        status, report = self.run_main(
+            '--echo-endpoint', endpoint, '--clients', '2', '--connections',
+            '1', '--requests', '20', '--params',
+            '{"message": {"id": 1, "text": "hi"}}')
+        assert status == 0
+        assert report['requests'] == 20
@@ -0,0 +1,48 @@
+import unittest
+
+import cara
+from cara import profiling
+from tests.basics_capnp import Basic
+
+
+class ConversionProfileTest(unittest.TestCase):
+
+    def test_by_type(self):
+        with profiling.ConversionProfile() as profile:
+            Basic({'list': [{'field': 1}, {'field': 2}], 'ints': [5, 6, 7]})
+        BasicList = Basic.__fields__['list'].type
+        assert profile.stats[Basic].conversions == 2
+        assert profile.stats[Basic].allocated == 2
+        assert profile.stats[BasicList].conversions == 1
+        assert profile.stats[cara.Int32].conversions == 5
+        # Ints pass through unchanged.
+        assert profile.stats[cara.Int32].allocated == 0
+        stats = profile.stats[BasicList]
+        assert stats.total >= stats.own
+        assert stats.total >= profile.stats[Basic].total
+
+    def test_only_inside(self):
+        with profiling.ConversionProfile() as profile:
+            pass
+        Basic({'field': 1})
+        assert not profile.stats
+        assert cara.cara._ConvertToType is profiling._convert
+
+    def test_one_at_a_time(self):
+        with profiling.ConversionProfile():
+            with self.assertRaises(RuntimeError):
+                with profiling.ConversionProfile():
+                    pass
+            assert cara.cara._ConvertToType is not profiling._convert
+        assert cara.cara._ConvertToType is profiling._convert
+
+    def test_report(self):
+        with profiling.ConversionProfile() as profile:
+            Basic({'list': [{'field': 1}]})
+        # The list's total includes converting everything in it.
+        lines = profile.Report(key='total', limit=2).splitlines()
+        assert len(lines) == 3
+        assert lines[0].split() == [
+            'type', 'conversions', 'allocated', 'total', '(s)', 'own', '(s)']
+        assert lines[1].split()[:3] == ['List[Basic]', '1', '1']
+        assert lines[2].split()[:3] == ['basics_capnp.Basic', '1', '1']
@@ -0,0 +1,164 @@
+import asyncio
+import concurrent.futures
+import unittest
+
+import cara
+from cara import remote
+from tests.cara_pseud_test_capnp import BazIface
+
+
+class RemoteInterfaceServerTest(unittest.TestCase):
+
+    def test_export_and_release(self):
+        handler = remote.RemoteInterfaceServer()
+        obj = object()
+        first = handler.export(obj)
+        second = handler.export(obj)
+        assert first != second
+        handler.release(first)
+        assert second in handler.objs and first not in handler.objs
+        handler.release(second)
+        # Releasing twice is harmless.
+        handler.release(second)
+        assert not handler.objs
+        assert handler.Stats() == {
+            'objects': 0, 'references': 0, 'answers': 0, 'streams': 0,
+            'exported': 2, 'released': 2, 'expired': 0}
+
+    def test_concurrent_exports(self):
+        handler = remote.RemoteInterfaceServer()
+
+        def ExportAndRelease(_):
+            for _ in range(100):
+                handler.release(handler.export(object()))
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            list(executor.map(ExportAndRelease, range(8)))
+        assert not handler.objs
+        assert handler.Stats()['exported'] == handler.Stats()['released'] == 800
+
+    def test_registered_never_released(self):
+        handler = remote.RemoteInterfaceServer()
+        handler.register(1, object())
+        handler.release(1)
+        assert 1 in handler.objs
+
+    def test_sweep(self):
+        handler = remote.RemoteInterfaceServer(ttl=10)
+        used = handler.export(object())
+        unused = handler.export(object())
+        handler.leases[unused] = 0
+        handler.leases[used] = 5
+        assert handler.Sweep(now=12) == 1
+        assert list(handler.objs) == [used]
+        assert handler.Stats()['expired'] == 1
+
+    def test_registered_outlive_ttl(self):
+        called = []
+
+        class BazIfaceImpl(BazIface):
+            def call(self, is_called):
+                called.append(is_called)
+
+        handler = remote.RemoteInterfaceServer(ttl=10)
+        handler.register(0, BazIfaceImpl())
+        handler.call(0, BazIface.id, 0, (True,), {})
+        with self.assertRaises(KeyError):
+            handler.call(7, BazIface.id, 0, (True,), {})
+        assert not handler.leases
+        assert handler.Sweep(now=float('inf')) == 0
+        handler.call(0, BazIface.id, 0, (False,), {})
+        assert called == [True, False]
+
+    def test_owner(self):
+        handler = remote.RemoteInterfaceServer(owner=3)
+        local_id = handler.export(object())
+        assert remote.ExportOwner(local_id) == 3
+        assert remote.ExportOwner(remote.RemoteInterfaceServer().export(
+            object())) is None
+        other = remote.RemoteInterfaceServer(owner=4)
+        with self.assertRaisesRegex(LookupError, 'owner 3'):
+            other.call(local_id, BazIface.id, 0, (), {})
+
+    def test_no_ttl(self):
+        handler = remote.RemoteInterfaceServer()
+        handler.export(object())
+        assert handler.Sweep(now=float('inf')) == 0
+        assert handler.objs
+
+
+class RemoteInterfaceClientTest(unittest.TestCase):
+
+    class Client(object):
+        def __init__(self):
+            self.calls = []
+
+        def call(self, *args):
+            self.calls.append(args)
+
+    def test_cached_stubs(self):
+        client = self.Client()
+        iface = remote.RemoteInterfaceClient(5, client, BazIface)
+        assert iface.call is iface.call
+        assert iface['call'] is iface.call
+        assert iface[BazIface.id, 0] is iface[BazIface.id, 0]
+        iface.call(True)
+        iface[BazIface.id, 0](False)
+        assert client.calls == [
+            (5, BazIface.id, 0, (True,), {}), (5, BazIface.id, 0, (False,), {})]
+        # Cached stubs don't change equality.
+        assert iface == remote.RemoteInterfaceClient(5, client, BazIface)
+
+    def test_missing_method(self):
+        iface = remote.RemoteInterfaceClient(5, self.Client(), BazIface)
+        with self.assertRaises(AttributeError):
+            iface.missing
+
+
+class ClientPoolTest(unittest.TestCase):
+
+    class Client(object):
+        def __init__(self):
+            self.release = asyncio.Event()
+
+        async def call(self):
+            await self.release.wait()
+
+    def test_coroutines(self):
+        async def main():
+            clients = [self.Client(), self.Client()]
+            pool = remote.ClientPool(clients)
+            call = pool.call()
+            assert pool.outstanding == [1, 0]
+            # The first client is busy, so the next call goes to the second.
+            pool.call()
+            assert pool.outstanding == [1, 1]
+            for client in clients:
+                client.release.set()
+            await call
+            await asyncio.sleep(0)
+            return pool.outstanding
+        assert asyncio.run(main()) == [0, 0]
+
+
+class PromiseTest(unittest.TestCase):
+
+    class Caller(object):
+        def __init__(self):
+            self.notified = []
+
+        def _Notify(self, *args):
+            self.notified.append(args)
+
+    def test_coroutine(self):
+        # What pseud 1.x's calls return.
+        async def call():
+            return 5
+
+        async def main():
+            caller = self.Caller()
+            promise = remote.Promise(call(), caller, 7, cara.Int32)
+            assert await promise == 5
+            await asyncio.sleep(0)
+            return caller.notified
+        assert asyncio.run(main()) == [('finish', 7)]
@@ -0,0 +1,103 @@
+import importlib
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import cara
+from cara import snapshot
+from cara import specialized
+from tests import basics_capnp
+from tests import generics_test_capnp
+
+MODULES = ['tests.basics_capnp', 'tests.generics_test_capnp',
+           'cara.capnp.cara_capnp', 'cara.capnp.schema_capnp']
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'schemas.snapshot')
+        snapshot.Save(self.path, [basics_capnp, generics_test_capnp])
+        # Imports them again, and puts everything back afterwards.
+        modules = {name: sys.modules.pop(name) for name in MODULES}
+        for name in MODULES:
+            package, _, attr = name.rpartition('.')
+            delattr(sys.modules[package], attr)
+        registry = dict(cara.GlobalTypeRegistry)
+        meta_path = list(sys.meta_path)
+
+        def Restore():
+            sys.meta_path[:] = meta_path
+            cara.GlobalTypeRegistry.clear()
+            cara.GlobalTypeRegistry.update(registry)
+            sys.modules.update(modules)
+            for name, module in modules.items():
+                package, _, attr = name.rpartition('.')
+                setattr(sys.modules[package], attr, module)
+        self.addCleanup(Restore)
+
+    def test_restores(self):
+        assert snapshot.Install(self.path)
+        restored = importlib.import_module('tests.basics_capnp')
+        assert restored is not basics_capnp
+        assert isinstance(restored.__spec__.loader, snapshot._Finder)
+        from cara.capnp import schema_capnp
+        assert restored.schema_capnp is schema_capnp
+        assert restored.Basic.__fields__['type'].type is schema_capnp.Type
+
+        basic = restored.Basic({'field': 1, 'list': [{'field': 2}]})
+        assert basic.list[0].field == 2
+        assert type(basic.list) is cara.List(restored.Basic)
+        assert cara.GlobalTypeRegistry[restored.Basic.id] is restored.Basic
+        assert restored.SemiAdvanced.__union_fields__ == (
+            basics_capnp.SemiAdvanced.__union_fields__)
+        assert list(restored.SimpleInterface.__methods__) == [
+            'structOut', 'structIn', 'multipleOut']
+
+    def test_generics(self):
+        assert snapshot.Install(self.path)
+        from tests.generics_test_capnp import GenericStruct
+        assert GenericStruct is not generics_test_capnp.GenericStruct
+        struct = GenericStruct[cara.Text]
+        # Instantiated before saving, so it's restored rather than made again.
+        assert struct in GenericStruct.__cache__.values
+        assert struct.__fields__['field'].type is struct
+        assert struct().defaulted == 'defaulteds'
+
+    def test_invalidated(self):
+        # As if basics.capnp was compiled again since.
+        with open(self.path, 'rb') as file:
+            format, version, files = pickle.load(file)
+            body = file.read()
+        filename, _ = files['tests.basics_capnp']
+        files['tests.basics_capnp'] = filename, 'changed'
+        with open(self.path, 'wb') as file:
+            pickle.dump((format, version, files), file)
+            file.write(body)
+        assert snapshot.Install(self.path)
+        restored = importlib.import_module('tests.basics_capnp')
+        assert not isinstance(restored.__spec__.loader, snapshot._Finder)
+        assert restored.Basic({'field': 1}).field == 1
+
+    def test_other_version(self):
+        with open(self.path, 'wb') as file:
+            pickle.dump((snapshot.FORMAT, 'other', {}), file)
+        assert not snapshot.Install(self.path)
+        assert not snapshot.Install(self.path + '.missing')
+
+    def test_other_module_version(self):
+        # As if cara was upgraded, changing a module other than cara.py.
+        hash = snapshot._Hash
+
+        def Changed(filename):
+            if filename == specialized.__file__:
+                return 'changed'
+            return hash(filename)
+        with mock.patch.object(snapshot, '_Hash', Changed):
+            assert not snapshot.Install(self.path)
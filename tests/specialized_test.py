@@ -0,0 +1,97 @@
+import unittest
+
+import cara
+from cara import profiling
+from cara import specialized
+from cara import wire
+from tests.basics_capnp import Basic
+
+
+def Declare():
+    outer = cara.Struct('Outer', 0x1234)
+    outer.FinishDeclaration(fields=[
+        cara.Union(fields=[
+            cara.Field(id=0, name='number', type=cara.Int32, discriminant=0),
+            cara.Field(id=1, name='name', type=cara.Text, discriminant=1),
+        ]),
+        cara.Field(id=2, name='text', type=cara.Text, default='default'),
+        cara.Field(id=3, name='basic', type=Basic),
+        cara.Field(id=4, name='basics', type=cara.List(Basic)),
+        # Named like a dict method.
+        cara.Field(id=5, name='keys', type=cara.Int32),
+        cara.Group(id=6, name='group', fields=[
+            cara.Field(id=0, name='first', type=cara.Text)]),
+    ])
+    return outer
+
+
+VALUE = {'number': 1, 'basic': {'field': 2}, 'basics': [{'field': 3}],
+         b'keys': 4, '6': {'first': 'a'}}
+
+
+class SpecializedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.generic = Declare()
+        self.outer = specialized.Specialize(Declare())
+
+    def test_same_as_generic(self):
+        generic = self.generic(VALUE)
+        outer = self.outer(VALUE)
+        assert outer.ToDict() == generic.ToDict()
+        assert outer.ToDict(True) == generic.ToDict(True) == {
+            'number': 1, 'basic': {'field': 2}, 'basics': [{'field': 3}],
+            'keys': 4, 'group': {'first': 'a'}}
+        assert outer.number == outer['number'] == outer[0] == 1
+        assert outer.text == 'default'
+        assert outer.basic.field == 2 and type(outer.basic) is Basic
+        assert outer['keys'] == 4 and callable(outer.keys)
+        assert outer.group.first == 'a'
+        assert 'first' in type(outer.group).__specialized__
+        assert outer.get('name', 'missing') == 'missing'
+        assert 'number' in outer and 'nope' not in outer
+
+    def test_set(self):
+        outer = self.outer(VALUE)
+        outer.name = 'name'
+        # The other union member is cleared.
+        assert 'number' not in outer and outer.name == 'name'
+        outer['basic'] = {'field': 5}
+        assert outer.basic == Basic({'field': 5})
+        with self.assertRaises(AttributeError):
+            outer.nope = 1
+        with self.assertRaises(KeyError):
+            outer['nope'] = 1
+        # Both union members given, the last one wins.
+        assert self.outer({'number': 1, 'name': 'b'}).ToDict() == {1: 'b'}
+
+    def test_profiled(self):
+        counts = []
+        for outer in (self.generic, self.outer):
+            with profiling.ConversionProfile() as profile:
+                outer(VALUE)
+            counts.append({
+                type: profile.stats[type].conversions
+                for type in (Basic, cara.List(Basic), cara.Int32, cara.Text)})
+        assert counts[0] == counts[1]
+        assert counts[1][Basic] == 2
+
+    def test_unknown_keys(self):
+        with self.assertRaises(KeyError):
+            self.outer({'nope': 1})
+        with self.assertRaises(AttributeError):
+            self.outer().nope
+
+    def test_views(self):
+        view = wire.Read(Basic, wire.Build(Basic, {'field': 1}))
+        specialized.Specialize(Basic)
+        try:
+            view = wire.Read(Basic, wire.Build(Basic, {'field': 1}))
+            assert view.field == 1
+            assert view.ToDict() == {0: 1}
+            with self.assertRaisesRegex(TypeError, 'read-only'):
+                view.field = 2
+        finally:
+            for name in Basic.__specialized__:
+                delattr(Basic, name)
+            del Basic.__specialized__
@@ -0,0 +1,110 @@
+import struct
+import unittest
+
+from cara import cara
+from cara import wire
+from tests.basics_capnp import Basic, SemiAdvanced
+
+BASIC = {'field': 1, 'list': [{'field': 2}, {'field': 3, 'ints': [4]}],
+         'ints': [5, 6, 7], 'nested': {'nested': {'field': 8}}}
+
+
+def Words(*words):
+    return struct.pack('<%dQ' % len(words), *words)
+
+
+class WireTest(unittest.TestCase):
+
+    def test_build(self):
+        # One segment of six words: the root pointer, then Basic's data word
+        # and four pointers.
+        assert wire.Build(Basic, {'field': 1}).hex() == (
+            '00000000' '06000000' '0000000001000400' '0100000000000000' +
+            '00' * 32)
+
+    def test_round_trip(self):
+        view = wire.Read(Basic, wire.Build(Basic, BASIC))
+        assert isinstance(view, Basic)
+        assert view == Basic(BASIC)
+        assert view.list[1].ints == [4]
+        assert view.nested.nested.field == 8
+        assert view.ToDict(with_field_names=True) == BASIC
+        assert type(Basic(view)) is Basic
+        # Not set, so the same as a struct without them.
+        assert 'type' not in view
+        assert view.nested.list == []
+
+    def test_lazy(self):
+        view = wire.Read(Basic, wire.Build(Basic, BASIC))
+        assert dict.keys(view) == set()
+        assert view.field == 1
+        assert list(dict.keys(view)) == [0]
+        assert len(view) == 4
+
+    def test_unions_and_groups(self):
+        value = SemiAdvanced({'namedGroup': {'first': 'a'},
+                              'namedUnion': {'that': 2},
+                              'unionField': b'\x00\xff'})
+        view = wire.Read(SemiAdvanced, wire.Build(SemiAdvanced, value))
+        assert view == value
+        assert view.namedGroup.first == 'a'
+        assert view.namedUnion.that == 2
+        assert 'this' not in view.namedUnion
+        assert 'unnamed' not in view and 'unionField' in view
+
+        # The first member is the active one unless another's set.
+        view = wire.Read(SemiAdvanced, wire.Build(SemiAdvanced, {}))
+        assert 'unnamed' in view and not view.unnamed
+
+    def test_data_is_not_copied(self):
+        data = wire.Build(SemiAdvanced, {'unionField': b'blob'})
+        view = wire.Read(SemiAdvanced, memoryview(data))
+        assert isinstance(view.unionField, memoryview)
+        assert view.unionField.obj is data
+        assert view.unionField == b'blob'
+
+    def test_read_only(self):
+        view = wire.Read(Basic, wire.Build(Basic, BASIC))
+        with self.assertRaises(TypeError):
+            view.field = 2
+        with self.assertRaises(TypeError):
+            view.list[0].pop('field')
+        copy = Basic(view)
+        copy.field = 2
+        assert view.field == 1
+
+    def test_far_pointers(self):
+        # The root is in the second segment, behind a landing pad.
+        data = struct.pack('<III', 1, 1, 2) + b'\0' * 4 + Words(
+            1 << 32 | 2, 0x0000000100000000, 7)
+        assert wire.Read(Basic, data).field == 7
+        # Twice as far, with the landing pad in the second segment pointing
+        # to the third.
+        data = struct.pack('<IIII', 2, 1, 2, 1) + Words(
+            1 << 32 | 6, 2 << 32 | 2, 0x0000000100000000, 9)
+        assert wire.Read(Basic, data).field == 9
+
+    def test_null_root(self):
+        view = wire.Read(Basic, struct.pack('<II', 0, 1) + Words(0))
+        assert view == Basic() and view.field is None
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            wire.Read(Basic, b'\0\0\0\0\x02\0\0\0' + Words(0))
+        with self.assertRaises(ValueError):
+            # The struct pointer points past the end of the segment.
+            wire.Read(Basic, struct.pack('<II', 0, 1) + Words(1 << 48))
+        text = struct.pack('<II', 0, 3) + Words(
+            1 << 48, 1 | 2 << 32 | 1 << 35, ord('a'))
+        field = cara.Field(0, 'text', cara.Text, offset=0)
+        text_struct = cara.Struct('TextStruct', 1)
+        text_struct.FinishDeclaration(
+            fields=[field], data_words=0, pointer_words=1)
+        with self.assertRaisesRegex(ValueError, 'NUL'):
+            wire.Read(text_struct, text).text
+        no_layout = cara.Struct('NoLayout', 2)
+        no_layout.FinishDeclaration(fields=[field])
+        with self.assertRaisesRegex(TypeError, 'no wire layout'):
+            wire.Build(no_layout, {'text': 'a'})
+        # But empty structs don't need one.
+        assert wire.Read(Basic, wire.Build(no_layout, {})) == Basic()